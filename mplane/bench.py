@@ -0,0 +1,142 @@
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+##
+# mPlane Protocol Reference Implementation
+# Information model benchmarks
+#
+# (c) 2013-2014 mPlane Consortium (http://www.ict-mplane.eu)
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Micro-benchmarks for the mPlane information model, comparing ways of
+filling in large Results, and the message formats. Run with::
+
+    python3 -m mplane.bench --rows 1000000
+    python3 -m mplane.bench --rows 1000000 --codecs
+
+"""
+
+import mplane.model
+import mplane.cbor
+
+import argparse
+import time
+from datetime import datetime, timedelta
+from ipaddress import ip_address
+
+BENCH_COLUMNS = ("start", "source.ip4", "octets.ip", "cpuload")
+
+def make_result():
+    """Returns an empty Result with one column of each typed primitive."""
+    cap = mplane.model.Capability(label="bench")
+    for column in BENCH_COLUMNS:
+        cap.add_result_column(column)
+    res = mplane.model.Result(
+            specification=mplane.model.Specification(capability=cap))
+    res.set_when("2015-01-01 ... 2015-01-02")
+    return res
+
+def make_rows(count):
+    """Returns count rows of values for the BENCH_COLUMNS."""
+    t0 = datetime(2015, 1, 1)
+    return [(t0 + timedelta(microseconds=i),
+             ip_address(0x0a000000 + (i & 0xffff)),
+             i * 1500,
+             (i % 100) / 100.0) for i in range(count)]
+
+def fill_by_cell(res, rows):
+    for (i, row) in enumerate(rows):
+        for (column, val) in zip(BENCH_COLUMNS, row):
+            res.set_result_value(column, val, i)
+
+def fill_by_row(res, rows):
+    res.append_rows(rows, columns=BENCH_COLUMNS)
+
+def fill_by_column(res, columns):
+    for (column, values) in zip(BENCH_COLUMNS, columns):
+        res.extend_column(column, values)
+
+def _time(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+def run(count):
+    """Runs the benchmarks on count rows; returns {name: seconds}."""
+    rows = make_rows(count)
+    columns = [[row[i] for row in rows] for i in range(len(BENCH_COLUMNS))]
+    timings = {}
+    for (name, fill, data) in (("set_result_value", fill_by_cell, rows),
+                               ("append_rows", fill_by_row, rows),
+                               ("extend_column", fill_by_column, columns)):
+        res = make_result()
+        timings[name] = _time(fill, res, data)
+        assert res.count_result_rows() == count
+    return timings
+
+def _decode_all(msg):
+    # parsed results decode their columns on first access
+    for column in msg._resultcolumns.values():
+        list(column)
+
+def run_codecs(count):
+    """
+    Encodes and decodes a Result of count rows in each message format;
+    returns {name: (bytes, encode seconds, decode seconds)}.
+
+    """
+    res = make_result()
+    fill_by_row(res, make_rows(count))
+    codecs = (("json", lambda: mplane.model.unparse_json(res).encode("utf-8"),
+               lambda b: mplane.model.parse_json(b.decode("utf-8"))),
+              ("json, compact",
+               lambda: mplane.model.unparse_json(res, compact=True).encode("utf-8"),
+               lambda b: mplane.model.parse_json(b.decode("utf-8"))),
+              ("json, streamed",
+               lambda: "".join(mplane.model.iter_unparse_json(res)).encode("utf-8"),
+               lambda b: mplane.model.parse_json_stream([b])),
+              ("cbor", lambda: mplane.model.unparse_cbor(res),
+               mplane.model.parse_cbor))
+    timings = {}
+    for (name, encode, decode) in codecs:
+        start = time.perf_counter()
+        data = encode()
+        encoded = time.perf_counter()
+        _decode_all(decode(data))
+        timings[name] = (len(data), encoded - start,
+                         time.perf_counter() - encoded)
+    return timings
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="mPlane model benchmarks")
+    parser.add_argument('--rows', metavar='count', dest='ROWS', type=int,
+                        default=1000000, help='Number of result rows')
+    parser.add_argument('--codecs', action='store_true', dest='CODECS',
+                        help='Compare message formats instead')
+    args = parser.parse_args()
+
+    mplane.model.initialize_registry()
+    if args.CODECS:
+        print("cbor2 %s" % ("installed" if mplane.cbor.cbor2 else
+                            "not installed, using the pure Python codec"))
+        for (name, (size, enc, dec)) in run_codecs(args.ROWS).items():
+            print("%-20s %12d bytes  encode %8.3f s  decode %8.3f s" %
+                  (name, size, enc, dec))
+    else:
+        timings = run(args.ROWS)
+        base = timings["set_result_value"]
+        for (name, seconds) in timings.items():
+            print("%-20s %8.3f s  %6.1fx" % (name, seconds, base / seconds))
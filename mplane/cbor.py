@@ -0,0 +1,308 @@
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+##
+# mPlane Protocol Reference Implementation
+# CBOR encoding for mPlane messages
+#
+# (c) 2013-2014 mPlane Consortium (http://www.ict-mplane.eu)
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Minimal CBOR (RFC 7049) codec for the binary encoding of mPlane
+messages (see :func:`mplane.model.unparse_cbor`).
+
+Besides the JSON types, it encodes byte strings, naive UTC datetimes
+as epoch timestamps (tag 1), and IP addresses as 4 or 16 byte strings
+(tags 52 and 54 of RFC 9164; tag 260 is also decoded). Encoding is
+done in pure Python, which is as fast as cbor2 for these types. The
+cbor2 package is used for decoding when it is installed, and the pure
+Python decoder otherwise. Decoded datetimes are naive UTC with the
+pure Python decoder, and aware UTC with cbor2; the information model
+accepts both.
+
+"""
+
+from datetime import datetime, timedelta, timezone
+from ipaddress import ip_address, IPv4Address, IPv6Address
+import struct
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+TAG_DATETIME_STRING = 0
+TAG_EPOCH = 1
+TAG_POSITIVE_BIGNUM = 2
+TAG_NEGATIVE_BIGNUM = 3
+TAG_IPV4 = 52
+TAG_IPV6 = 54
+TAG_NETWORK_ADDRESS = 260
+
+_EPOCH = datetime(1970, 1, 1)
+
+_BREAK = object()
+
+def dumps(obj):
+    """Returns the CBOR encoding of obj as bytes."""
+    out = bytearray()
+    _encode(obj, out)
+    return bytes(out)
+
+def loads(data):
+    """Decodes a CBOR data item from bytes."""
+    if cbor2 is not None:
+        return cbor2.loads(data)
+    decoder = _Decoder(data)
+    obj = decoder.decode()
+    if decoder.pos != len(decoder.data):
+        raise ValueError("Extra data after CBOR item")
+    return obj
+
+#
+# Encoding
+#
+
+def _head(major, n, out):
+    major <<= 5
+    if n < 24:
+        out.append(major | n)
+    elif n < 0x100:
+        out.append(major | 24)
+        out.append(n)
+    elif n < 0x10000:
+        out.append(major | 25)
+        out += n.to_bytes(2, "big")
+    elif n < 0x100000000:
+        out.append(major | 26)
+        out += n.to_bytes(4, "big")
+    else:
+        out.append(major | 27)
+        out += n.to_bytes(8, "big")
+
+def _encode_int(val, out):
+    if val >= 0:
+        if val < 0x10000000000000000:
+            _head(0, val, out)
+        else:
+            _head(6, TAG_POSITIVE_BIGNUM, out)
+            _encode_bytes(val.to_bytes((val.bit_length() + 7) // 8, "big"), out)
+    else:
+        val = -1 - val
+        if val < 0x10000000000000000:
+            _head(1, val, out)
+        else:
+            _head(6, TAG_NEGATIVE_BIGNUM, out)
+            _encode_bytes(val.to_bytes((val.bit_length() + 7) // 8, "big"), out)
+
+def _encode_float(val, out):
+    out.append(0xfb)
+    out += struct.pack(">d", val)
+
+def _encode_bytes(val, out):
+    _head(2, len(val), out)
+    out += val
+
+def _encode_str(val, out):
+    val = val.encode("utf-8")
+    _head(3, len(val), out)
+    out += val
+
+def _encode_list(val, out):
+    _head(4, len(val), out)
+    for item in val:
+        _encode(item, out)
+
+def _encode_dict(val, out):
+    _head(5, len(val), out)
+    for (key, item) in val.items():
+        _encode(key, out)
+        _encode(item, out)
+
+def _encode_bool(val, out):
+    out.append(0xf5 if val else 0xf4)
+
+def _encode_none(val, out):
+    out.append(0xf6)
+
+def _encode_datetime(val, out):
+    if val.tzinfo is not None:
+        val = val.astimezone(timezone.utc).replace(tzinfo=None)
+    delta = val - _EPOCH
+    _head(6, TAG_EPOCH, out)
+    if delta.microseconds:
+        _encode_float(delta.total_seconds(), out)
+    else:
+        _encode_int(delta.days * 86400 + delta.seconds, out)
+
+def _encode_ipv4(val, out):
+    _head(6, TAG_IPV4, out)
+    _encode_bytes(val.packed, out)
+
+def _encode_ipv6(val, out):
+    _head(6, TAG_IPV6, out)
+    _encode_bytes(val.packed, out)
+
+_encoders = {int: _encode_int,
+             float: _encode_float,
+             str: _encode_str,
+             bytes: _encode_bytes,
+             bytearray: _encode_bytes,
+             list: _encode_list,
+             tuple: _encode_list,
+             dict: _encode_dict,
+             bool: _encode_bool,
+             type(None): _encode_none,
+             datetime: _encode_datetime,
+             IPv4Address: _encode_ipv4,
+             IPv6Address: _encode_ipv6}
+
+def _encode(obj, out):
+    try:
+        encoder = _encoders[type(obj)]
+    except KeyError:
+        # subclasses, e.g. OrderedDict
+        for (cls, encoder) in _encoders.items():
+            if isinstance(obj, cls):
+                break
+        else:
+            raise TypeError("Cannot encode "+repr(obj)+" as CBOR")
+    encoder(obj, out)
+
+#
+# Decoding
+#
+
+class _Decoder(object):
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.pos = 0
+
+    def _take(self, n):
+        start = self.pos
+        self.pos += n
+        if self.pos > len(self.data):
+            raise ValueError("Truncated CBOR item")
+        return self.data[start:self.pos]
+
+    def _length(self, info):
+        # returns the argument of a head, or None for indefinite length
+        if info < 24:
+            return info
+        elif info == 24:
+            return self._take(1)[0]
+        elif info == 25:
+            return int.from_bytes(self._take(2), "big")
+        elif info == 26:
+            return int.from_bytes(self._take(4), "big")
+        elif info == 27:
+            return int.from_bytes(self._take(8), "big")
+        elif info == 31:
+            return None
+        raise ValueError("Malformed CBOR head")
+
+    def decode(self):
+        obj = self._decode()
+        if obj is _BREAK:
+            raise ValueError("Unexpected CBOR break")
+        return obj
+
+    def _decode(self):
+        initial = self._take(1)[0]
+        (major, info) = (initial >> 5, initial & 0x1f)
+        if major == 7:
+            return self._simple(info)
+        n = self._length(info)
+        if major == 0:
+            return n
+        elif major == 1:
+            return -1 - n
+        elif major in (2, 3):
+            if n is None:
+                chunks = []
+                while True:
+                    chunk = self._decode()
+                    if chunk is _BREAK:
+                        break
+                    chunks.append(chunk)
+                return (b"" if major == 2 else "").join(chunks)
+            val = self._take(n)
+            return val if major == 2 else val.decode("utf-8")
+        elif major == 4:
+            if n is None:
+                items = []
+                while True:
+                    item = self._decode()
+                    if item is _BREAK:
+                        return items
+                    items.append(item)
+            return [self.decode() for i in range(n)]
+        elif major == 5:
+            d = {}
+            if n is None:
+                while True:
+                    key = self._decode()
+                    if key is _BREAK:
+                        return d
+                    d[key] = self.decode()
+            for i in range(n):
+                key = self.decode()
+                d[key] = self.decode()
+            return d
+        elif n is None:
+            raise ValueError("Malformed CBOR tag")
+        else:
+            return self._tagged(n, self.decode())
+
+    def _simple(self, info):
+        if info == 20:
+            return False
+        elif info == 21:
+            return True
+        elif info in (22, 23):
+            return None
+        elif info == 25:
+            return struct.unpack(">e", self._take(2))[0]
+        elif info == 26:
+            return struct.unpack(">f", self._take(4))[0]
+        elif info == 27:
+            return struct.unpack(">d", self._take(8))[0]
+        elif info == 31:
+            return _BREAK
+        elif info < 24:
+            return info
+        elif info == 24:
+            return self._take(1)[0]
+        raise ValueError("Malformed CBOR simple value")
+
+    def _tagged(self, tag, val):
+        if tag == TAG_EPOCH:
+            return _EPOCH + timedelta(seconds=val)
+        elif tag == TAG_DATETIME_STRING:
+            val = datetime.fromisoformat(val.replace("Z", "+00:00"))
+            if val.tzinfo is not None:
+                val = val.astimezone(timezone.utc).replace(tzinfo=None)
+            return val
+        elif tag == TAG_POSITIVE_BIGNUM:
+            return int.from_bytes(val, "big")
+        elif tag == TAG_NEGATIVE_BIGNUM:
+            return -1 - int.from_bytes(val, "big")
+        elif tag in (TAG_IPV4, TAG_IPV6, TAG_NETWORK_ADDRESS) and \
+             isinstance(val, bytes) and len(val) in (4, 16):
+            return ip_address(val)
+        # unknown tags are ignored
+        return val
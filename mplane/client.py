@@ -23,18 +23,20 @@
 
 import mplane.model
 import mplane.utils
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import html.parser
 import urllib3
 if mplane.utils.versiontuple(urllib3.__version__) > mplane.utils.versiontuple("1.9"):
     urllib3.disable_warnings()
-from threading import Thread
+from threading import Thread, Lock, RLock
 import queue
 
 import tornado.web
 import tornado.httpserver
 import tornado.ioloop
+import tornado.locks
+import tornado.util
 
 CAPABILITY_PATH_ELEM = "capability"
 
@@ -46,6 +48,7 @@ DEFAULT_HOST = "127.0.0.1"
 DEFAULT_REGISTRATION_PATH = "register/capability"
 DEFAULT_SPECIFICATION_PATH = "show/specification"
 DEFAULT_RESULT_PATH = "register/result"
+DEFAULT_LONG_POLL_WAIT = 60
 
 class BaseClient(object):
     """
@@ -65,9 +68,13 @@ class BaseClient(object):
         self._receipt_labels = {}
         self._results = {}
         self._result_labels = {}
+        self._result_identities = {}
         self._supervisor = supervisor
         if self._supervisor:
             self._exporter = exporter
+        # messages are handled on several threads (e.g. the workers
+        # of a supervisor); this guards the state above
+        self._state_lock = RLock()
 
     def _add_capability(self, msg, identity):
         """
@@ -78,8 +85,10 @@ class BaseClient(object):
 
         """
 
-        # FIXME retoken on token collision with another identity
-        token = msg.get_token()
+        # components advertising identical capabilities get a
+        # token of their own for each identity
+        token = self._capability_token(msg, identity)
+        msg.set_token(token)
 
         self._capabilities[token] = msg
 
@@ -89,6 +98,13 @@ class BaseClient(object):
         if identity:
             self._capability_identities[token] = identity
 
+    def _capability_token(self, msg, identity):
+        token = msg.get_token()
+        if (identity and token in self._capabilities and
+            self._capability_identities.get(token, identity) != identity):
+            token = msg._mpcv_hash(astr=identity)
+        return token
+
     def _remove_capability(self, msg):
         token = msg.get_token()
         if token in self._capabilities:
@@ -106,7 +122,7 @@ class BaseClient(object):
         Internal use only; use handle_message instead.
 
         """
-        token = msg.get_token()
+        token = self._capability_token(msg, identity)
 
         # FIXME check identity, exception on mismatch
 
@@ -131,7 +147,8 @@ class BaseClient(object):
 
     def identity_for(self, token_or_label, receipt=False):
         """
-        Retrieve an identity given a capability token or label, or a receipt token.
+        Retrieve an identity given a capability token or label, or the
+        token of a receipt or result, i.e. of the component which replied.
 
         """
         if not receipt:
@@ -144,6 +161,8 @@ class BaseClient(object):
         else:
             if token_or_label in self._receipt_identities:
                 return self._receipt_identities[token_or_label]
+            elif token_or_label in self._result_identities:
+                return self._result_identities[token_or_label]
             else:
                 raise KeyError("no identity for receipt token " + token_or_label)
 
@@ -158,15 +177,19 @@ class BaseClient(object):
         Used to programmatically select capabilities matching an
         aggregation or other collection operation (e.g. at a supervisor).
 
+        Constraints are not compared yet; only schemas are.
+
         """
-        # FIXME write this, maybe refactor part back into model.
-        pass
+        schema_hash = schema_capability._schema_hash()
+        return [cap for cap in list(self._capabilities.values())
+                if cap._schema_hash() == schema_hash]
 
-    def _spec_for(self, cap_tol, when, params, relabel=None):
+    def _spec_for(self, cap_tol, when, params, relabel=None, token=None):
         """
         Given a capability token or label, a temporal scope, a dictionary 
-        of parameters, and an optional new label, derive a specification
-        ready for invocation, and return the capability and specification.
+        of parameters, and an optional new label and token, derive a
+        specification ready for invocation, and return the capability
+        and specification.
 
         Used internally by derived classes; use invoke_capability instead.
 
@@ -187,14 +210,19 @@ class BaseClient(object):
                     raise KeyError("missing parameter "+pname)
 
         # regenerate token based on parameters and temporal scope
-        spec.retoken()
+        if token:
+            spec.set_token(token)
+        else:
+            spec.retoken()
 
         # generate label
+        with self._state_lock:
+            ssn = self._ssn
+            self._ssn += 1
         if relabel:
             spec.set_label(relabel)
         else:
-            spec.set_label(cap.get_label() + "-" + str(self._ssn))
-        self._ssn += 1
+            spec.set_label(cap.get_label() + "-" + str(ssn))
 
         return (cap, spec)
 
@@ -243,10 +271,7 @@ class BaseClient(object):
                 # if the result is an envelope containing multijob
                 # results, keep the receipt until the multijob ends
                 (start, end) = msg.when().datetimes()
-                if end < datetime.utcnow():
-                    if self._supervisor:
-                        self._exporter.put_nowait([msg, identity])
-
+                if end is not None and end < datetime.utcnow():
                     receipt = self._receipts[msg.get_token()]
                     self._remove_receipt(receipt)
             else:
@@ -255,6 +280,8 @@ class BaseClient(object):
         except KeyError:
             pass
         self._results[msg.get_token()] = msg
+        if identity:
+            self._result_identities[msg.get_token()] = identity
 
         if not isinstance(msg, mplane.model.Exception):
             if msg.get_label():
@@ -268,6 +295,7 @@ class BaseClient(object):
         if token in self._results:
             label = self._results[token].get_label()
             del self._results[token]
+            self._result_identities.pop(token, None)
             if label and label in self._result_labels:
                 del self._result_labels[label]
 
@@ -298,10 +326,15 @@ class BaseClient(object):
         to inject messages into a client's state.
 
         """
+        with self._state_lock:
+            self._handle_message(msg, identity)
 
-        if (self._supervisor and
-            not isinstance(msg, mplane.model.Envelope)):
-            self._exporter.put_nowait([msg, identity])
+    def _handle_message(self, msg, identity):
+        # the supervisor gets every message, and the envelopes
+        # of multi-job results, once they are in client state
+        export = (self._supervisor and
+                  (not isinstance(msg, mplane.model.Envelope) or
+                   msg.get_token() in self._receipts))
 
         if isinstance(msg, mplane.model.Capability):
             self._add_capability(msg, identity)
@@ -318,14 +351,21 @@ class BaseClient(object):
                 self._handle_result(msg, identity)
             else:
                 for imsg in msg.messages():
-                    self.handle_message(imsg, identity)
+                    self._handle_message(imsg, identity)
         else:
             raise ValueError("Internal error: unknown message "+repr(msg))
 
+        if export:
+            self._exporter.put_nowait([msg, identity])
+
     def forget(self, token_or_label):
         """
         forget all receipts and results for the given token or label
         """
+        with self._state_lock:
+            self._forget(token_or_label)
+
+    def _forget(self, token_or_label):
         if token_or_label in self._result_labels:
             result = self._result_labels[token_or_label]
             del self._result_labels[token_or_label]
@@ -352,31 +392,43 @@ class BaseClient(object):
         """
         list all tokens for outstanding receipts
         """
-        return tuple(self._receipts.keys())
+        with self._state_lock:
+            return tuple(self._receipts.keys())
+
+    def receipts(self):
+        """
+        list all outstanding receipts
+        """
+        with self._state_lock:
+            return tuple(self._receipts.values())
 
     def receipt_labels(self):
         """
         list all labels for outstanding receipts
         """
-        return tuple(self._receipt_labels.keys())
+        with self._state_lock:
+            return tuple(self._receipt_labels.keys())
 
     def result_tokens(self):
         """
         list all tokens for stored results
         """
-        return tuple(self._results.keys())
+        with self._state_lock:
+            return tuple(self._results.keys())
 
     def result_labels(self):
         """
         list all labels for stored results
         """
-        return tuple(self._result_labels.keys())
+        with self._state_lock:
+            return tuple(self._result_labels.keys())
 
     def capability_tokens(self):
         """
         list all tokens for stored capabilities
         """
-        return tuple(self._capabilities.keys())
+        with self._state_lock:
+            return tuple(self._capabilities.keys())
 
     def capability_labels(self):
         """
@@ -409,15 +461,34 @@ class HttpInitiatorClient(BaseClient):
     """
 
     def __init__(self, tls_state, default_url=None,
-                 supervisor=False, exporter=None):
+                 supervisor=False, exporter=None,
+                 message_format=mplane.utils.FORMAT_JSON,
+                 compression=None):
         """
         initialize a client with a given 
-        default URL an a given TLS state
+        default URL an a given TLS state;
+        messages are sent in the given message_format
+        (see mplane.utils), which is asked for in replies,
+        and compressed as given by a mplane.utils.HttpCompression
         """
         super().__init__(tls_state, supervisor=supervisor,
                         exporter=exporter)
 
         self._default_url = default_url
+        self._format = message_format
+        self._accept = {}
+        if message_format != mplane.utils.FORMAT_JSON:
+            self._accept["Accept"] = mplane.utils.message_media_type(message_format)
+        if compression is None:
+            compression = mplane.utils.HttpCompression()
+        self._compression = compression
+
+        # URLs of the components capabilities were retrieved from,
+        # and specifications were sent to, by token; ETags of the
+        # capability URLs retrieved
+        self._capability_urls = {}
+        self._spec_urls = {}
+        self._etags = {}
 
         # specification serial number
         # used to create labels programmatically
@@ -429,9 +500,11 @@ class HttpInitiatorClient(BaseClient):
         else:
             self._default_url = url
 
-    def send_message(self, msg, dst_url=None):
+    def send_message(self, msg, dst_url=None, timeout=None):
         """
-        send a message, store any result in client state.
+        send a message, store any result in client state;
+        the optional timeout (seconds, or a urllib3.Timeout)
+        applies to the HTTP request.
 
         """
         # figure out where to send the message
@@ -443,7 +516,8 @@ class HttpInitiatorClient(BaseClient):
 
         pool = self._tls_state.pool_for(dst_url.scheme, dst_url.host, dst_url.port)
 
-        headers = {"Content-Type": "application/x-mplane+json"}
+        headers = {"Content-Type": mplane.utils.message_media_type(self._format)}
+        headers.update(self._accept)
         if self._tls_state.forged_identity():
             headers[FORGED_DN_HEADER] = self._tls_state.forged_identity()
 
@@ -452,18 +526,42 @@ class HttpInitiatorClient(BaseClient):
         else:
             path = "/"
 
-        res = pool.urlopen('POST', path,
-                           body=mplane.model.unparse_json(msg).encode("utf-8"),
-                           headers=headers)
-        if (res.status == 200 and 
-            res.getheader("Content-Type") == "application/x-mplane+json"):
-            component_identity = self._tls_state.extract_peer_identity(dst_url)
-            self.handle_message(mplane.model.parse_json(res.data.decode("utf-8")), component_identity)
-        else:
-            # Didn't get an mPlane reply. What now?
-            pass
-
-    def result_for(self, token_or_label):
+        body = self._compression.encode_request(
+                    mplane.utils.unparse_message(msg, self._format),
+                    headers, dst_url.host, dst_url.port)
+        try:
+            res = pool.urlopen('POST', path, body=body,
+                               headers=headers, preload_content=False,
+                               timeout=timeout)
+        except urllib3.exceptions.HTTPError:
+            # the component may come back with another certificate
+            self._tls_state.forget_peer_identity(dst_url)
+            raise
+        try:
+            self._compression.learn(res, dst_url.host, dst_url.port)
+            reply = None
+            if (res.status == 200 and 
+                mplane.utils.is_mplane_message(res.getheader("Content-Type"))):
+                component_identity = self._tls_state.extract_response_identity(res, dst_url)
+                if mplane.utils.is_mplane_cbor(res.getheader("Content-Type")):
+                    reply = mplane.model.parse_cbor(res.read())
+                else:
+                    reply = mplane.model.parse_json_stream(
+                                res.stream(mplane.model.JSON_CHUNK_SIZE))
+            else:
+                # Didn't get an mPlane reply. What now?
+                res.drain_conn()
+        except Exception:
+            # leave no unread body on the connection for the next request
+            res.drain_conn()
+            raise
+        finally:
+            # hand the connection back to the pool, even if reading failed
+            res.release_conn()
+        if reply is not None:
+            self.handle_message(reply, component_identity)
+
+    def result_for(self, token_or_label, timeout=None):
         """
         return a result for the token if available;
         attempt to redeem the receipt for the token otherwise;
@@ -488,8 +586,10 @@ class HttpInitiatorClient(BaseClient):
         elif isinstance(rr, mplane.model.Exception):
             return rr
 
-        # if we're here, we have a receipt. try to redeem it.
-        self.send_message(mplane.model.Redemption(receipt=rr))
+        # if we're here, we have a receipt. try to redeem it
+        # at the component the specification was sent to.
+        self.send_message(mplane.model.Redemption(receipt=rr),
+                          self._spec_urls.get(rr.get_token()), timeout)
 
         # see if we got a result
         if token_or_label in self._result_labels:
@@ -500,19 +600,27 @@ class HttpInitiatorClient(BaseClient):
             # Nope. Return the receipt.
             return rr
 
-    def invoke_capability(self, cap_tol, when, params, relabel=None):
+    def invoke_capability(self, cap_tol, when, params, relabel=None, token=None):
         """
         Given a capability token or label, a temporal scope, a dictionary 
-        of parameters, and an optional new label, derive a specification
-        and send it to the appropriate destination.
+        of parameters, and an optional new label and token, derive a
+        specification and send it to the appropriate destination.
 
         """
-        (cap, spec) = self._spec_for(cap_tol, when, params, relabel)
+        (cap, spec) = self._spec_for(cap_tol, when, params, relabel, token)
         spec.validate()
-        dst_url = urllib3.util.Url(scheme=self._default_url.scheme,
-                                   host=self._default_url.host,
-                                   port=self._default_url.port,
+        # send it to the component the capability came from
+        cap_url = self._capability_urls.get(cap.get_token(), self._default_url)
+        dst_url = urllib3.util.Url(scheme=cap_url.scheme,
+                                   host=cap_url.host,
+                                   port=cap_url.port,
                                    path=cap.get_link())
+        with self._state_lock:
+            self._spec_urls[spec.get_token()] = urllib3.util.Url(
+                                       scheme=cap_url.scheme,
+                                       host=cap_url.host,
+                                       port=cap_url.port,
+                                       path=self._default_url.path)
         self.send_message(spec, dst_url)
         return spec
 
@@ -520,24 +628,24 @@ class HttpInitiatorClient(BaseClient):
         # get the receipt
         rr = super().result_for(cap_tol)
         interrupt = mplane.model.Interrupt(specification=rr)
-        dst_url = urllib3.util.Url(scheme=self._default_url.scheme,
-                                   host=self._default_url.host,
-                                   port=self._default_url.port,
-                                   path=self._default_url.path)
+        dst_url = self._spec_urls.get(rr.get_token(), self._default_url)
         self.send_message(interrupt, dst_url)
 
-    def retrieve_capabilities(self, url, urlchain=[], pool=None, identity=None):
+    def retrieve_capabilities(self, url, urlchain=[], pool=None, identity=None,
+                              timeout=None):
         """
         connect to the given URL, retrieve and process the 
-        capabilities/withdrawals found there
+        capabilities/withdrawals found there; pages which have
+        not changed since they were last retrieved are skipped.
         """
 
         # detect loops in capability links
         if url in urlchain:
             return
 
-        if not self._default_url:
-            self.set_default_url(url)
+        with self._state_lock:
+            if not self._default_url:
+                self.set_default_url(url)
 
         if isinstance(url, str):
             url = urllib3.util.parse_url(url)
@@ -556,23 +664,46 @@ class HttpInitiatorClient(BaseClient):
             path = url.path
         else:
             path = "/"
-        res = pool.request('GET', path)
+        headers = dict(self._accept)
+        self._compression.encode_request(None, headers, url.host, url.port)
+        etag_key = (pool.host, pool.port, path)
+        if etag_key in self._etags:
+            headers["If-None-Match"] = self._etags[etag_key]
+        try:
+            res = pool.request('GET', path, headers=headers, timeout=timeout)
+        except urllib3.exceptions.HTTPError:
+            self._tls_state.forget_peer_identity(url)
+            raise
 
         if res.status == 200:
+            if res.getheader("ETag") is not None:
+                with self._state_lock:
+                    self._etags[etag_key] = res.getheader("ETag")
             ctype = res.getheader("Content-Type")
-            if ctype == "application/x-mplane+json":
+            if mplane.utils.is_mplane_message(ctype):
                 # Probably an envelope. Process the message.
-                self.handle_message(
-                    mplane.model.parse_json(res.data.decode("utf-8")), identity)
+                msg = mplane.utils.parse_message(res.data, ctype)
+                # so that no invocation sees the capabilities without their URL
+                with self._state_lock:
+                    self.handle_message(msg, identity)
+                    self._note_capability_urls(msg, urlchain[0] if urlchain else url)
             elif ctype == "text/html":
                 # Treat as a list of links to capability messages.
-                parser = CrawlParser(strict=False)
+                parser = CrawlParser()
                 parser.feed(res.data.decode("utf-8"))
                 parser.close()
                 for capurl in parser.urls:
                     self.retrieve_capabilities(url=capurl, 
                                                urlchain=urlchain + [url],
-                                               pool=pool, identity=identity)
+                                               pool=pool, identity=identity,
+                                               timeout=timeout)
+
+    def _note_capability_urls(self, msg, url):
+        if isinstance(msg, mplane.model.Envelope):
+            for imsg in msg.messages():
+                self._note_capability_urls(imsg, url)
+        elif isinstance(msg, mplane.model.Capability):
+            self._capability_urls[msg.get_token()] = url
 
 class HttpListenerClient(BaseClient):
     """
@@ -606,8 +737,16 @@ class HttpListenerClient(BaseClient):
         if "result-path" in config["client"]:
             result_path = config["client"]["result-path"]
 
-        # Outgoing messages per component identifier
+        # longest time a specification request is held open
+        # waiting for messages, when the component asks for it
+        self._long_poll_wait = config.getfloat("client", "long_poll_wait",
+                                               fallback=DEFAULT_LONG_POLL_WAIT)
+
+        # Outgoing messages per component identifier, and the
+        # (io_loop, event) of long polls waiting for them
         self._outgoing = {}
+        self._outgoing_waiters = {}
+        self._outgoing_lock = Lock()
 
         # specification serial number
         # used to create labels programmatically
@@ -624,8 +763,9 @@ class HttpListenerClient(BaseClient):
             (r"/" + specification_path + "/", SpecificationHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
             (r"/" + result_path, ResultHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
             (r"/" + result_path + "/", ResultHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
-        ])
-        http_server = tornado.httpserver.HTTPServer(self._tornado_application, ssl_options=tls_state.get_ssl_options())
+        ], transforms=[mplane.utils.HttpCompression.from_config(config, "client").transform()])
+        http_server = tornado.httpserver.HTTPServer(self._tornado_application, ssl_options=tls_state.server_context(),
+                                                    decompress_request=True)
 
         # run the server
         http_server.listen(listen_port, listen_host)
@@ -645,14 +785,49 @@ class HttpListenerClient(BaseClient):
             tornado.ioloop.IOLoop.instance().start()
 
     def _push_outgoing(self, identity, msg):
-        if identity not in self._outgoing:
-            self._outgoing[identity] = []
-        self._outgoing[identity].append(msg)
+        with self._outgoing_lock:
+            if identity not in self._outgoing:
+                self._outgoing[identity] = []
+            self._outgoing[identity].append(msg)
+            waiters = self._outgoing_waiters.pop(identity, [])
 
-    def invoke_capability(self, cap_tol, when, params, relabel=None, callback_when=None):
+        # wake up pending long polls on their own loop
+        for (io_loop, event) in waiters:
+            io_loop.add_callback(event.set)
+
+    def _pop_outgoing(self, identity):
+        with self._outgoing_lock:
+            return self._outgoing.pop(identity, [])
+
+    async def _wait_outgoing(self, identity, event, wait):
+        """
+        Waits until messages are queued for identity, event is set,
+        or wait seconds (at most long_poll_wait) have passed.
+
+        """
+        wait = min(wait, self._long_poll_wait)
+        with self._outgoing_lock:
+            if identity in self._outgoing or wait <= 0:
+                return
+            waiter = (tornado.ioloop.IOLoop.current(), event)
+            self._outgoing_waiters.setdefault(identity, []).append(waiter)
+        try:
+            await event.wait(timeout=timedelta(seconds=wait))
+        except tornado.util.TimeoutError:
+            pass
+        finally:
+            with self._outgoing_lock:
+                waiters = self._outgoing_waiters.get(identity, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._outgoing_waiters[identity]
+
+    def invoke_capability(self, cap_tol, when, params, relabel=None, callback_when=None,
+                          token=None):
         """
         Given a capability token or label, a temporal scope, a dictionary 
-        of parameters, and an optional new label, derive a specification
+        of parameters, and an optional new label and token, derive a specification
         and queue it for retrieval by the appropriate identity (i.e., the
         one associated with the capability).
 
@@ -661,7 +836,7 @@ class HttpListenerClient(BaseClient):
         schedule the next callback.
         """
         # grab cap, spec, and identity
-        (cap, spec) = self._spec_for(cap_tol, when, params, relabel)
+        (cap, spec) = self._spec_for(cap_tol, when, params, relabel, token)
         identity = self.identity_for(cap.get_token())
 
         callback_cap = None
@@ -705,14 +880,23 @@ class MPlaneHandler(tornado.web.RequestHandler):
 
     """
 
-    def _respond_message(self, msg):
+    async def _respond_message(self, msg):
         """
-        Returns an HTTP response containing a JSON message
+        Returns an HTTP response containing a JSON message,
+        written and flushed a chunk at a time; in compact
+        JSON or CBOR if the request's Accept header asks for it
 
         """
+        fmt = mplane.utils.reply_format(self.request.headers.get("Accept"))
         self.set_status(200)
-        self.set_header("Content-Type", "application/x-mplane+json")
-        self.write(mplane.model.unparse_json(msg))
+        self.set_header("Content-Type", mplane.utils.message_media_type(fmt))
+        if fmt == mplane.utils.FORMAT_CBOR:
+            self.write(mplane.model.unparse_cbor(msg))
+        else:
+            compact = (fmt == mplane.utils.FORMAT_COMPACT_JSON)
+            for chunk in mplane.model.iter_unparse_json(msg, compact=compact):
+                self.write(chunk)
+                await self.flush()
         self.finish()
 
     def _respond_plain_text(self, code, text = None):
@@ -737,7 +921,43 @@ class MPlaneHandler(tornado.web.RequestHandler):
             self.write(text)
         self.finish()
 
-class RegistrationHandler(MPlaneHandler):
+@tornado.web.stream_request_body
+class MPlaneStreamHandler(MPlaneHandler):
+    """
+    Abstract tornado RequestHandler that parses an mPlane message
+    POSTed to it while the body is being received. CBOR messages
+    are parsed once received.
+
+    """
+
+    def prepare(self):
+        self._parser = None
+        self._cbor_chunks = None
+        content_type = self.request.headers["Content-Type"]
+        if mplane.utils.is_mplane_json(content_type):
+            self._parser = mplane.model.MessageParser()
+        elif mplane.utils.is_mplane_cbor(content_type):
+            self._cbor_chunks = []
+
+    def data_received(self, chunk):
+        if self._parser is not None:
+            self._parser.feed(chunk)
+        elif self._cbor_chunks is not None:
+            self._cbor_chunks.append(chunk)
+
+    def _received_message(self):
+        """
+        Returns the message POSTed, or None if the body was not
+        an mPlane message
+
+        """
+        if self._parser is not None:
+            return self._parser.close()
+        elif self._cbor_chunks is not None:
+            return mplane.model.parse_cbor(b"".join(self._cbor_chunks))
+        return None
+
+class RegistrationHandler(MPlaneStreamHandler):
     """
     Handles the probes that want to register to this supervisor
     Each capability is registered indipendently
@@ -750,9 +970,8 @@ class RegistrationHandler(MPlaneHandler):
 
     def post(self):
         # unwrap json message from body
-        if (self.request.headers["Content-Type"] == "application/x-mplane+json"):
-            env = mplane.model.parse_json(self.request.body.decode("utf-8"))
-        else:
+        env = self._received_message()
+        if env is None:
             self._respond_plain_text(400, "Invalid format")
             return
 
@@ -773,16 +992,31 @@ class RegistrationHandler(MPlaneHandler):
 class SpecificationHandler(MPlaneHandler):
     """
     Exposes the specifications, that will be periodically pulled by the
-    components
+    components. A component sending "Prefer: wait=<seconds>" (RFC 7240)
+    gets a long poll: if no specification is pending, the request is
+    held open until one is, or the wait is over.
 
     """
     def initialize(self, listenerclient, tlsState):
         self._listenerclient = listenerclient
         self._tls = tlsState
+        self._wakeup = None
+        self._closed = False
 
-    def get(self):
+    async def get(self):
         identity = self._tls.extract_peer_identity(self.request)
-        specs = self._listenerclient._outgoing.pop(identity, [])
+        specs = self._listenerclient._pop_outgoing(identity)
+        wait = mplane.utils.preferred_wait(self.request.headers.get("Prefer"))
+        if wait is not None:
+            self.set_header("Preference-Applied", "wait=%d" %
+                            min(wait, self._listenerclient._long_poll_wait))
+            if not specs:
+                self._wakeup = tornado.locks.Event()
+                await self._listenerclient._wait_outgoing(identity, self._wakeup, wait)
+                if self._closed:
+                    # leave the messages for the next poll
+                    return
+                specs = self._listenerclient._pop_outgoing(identity)
         env = mplane.model.Envelope()
         for spec in specs:
             env.append_message(spec)
@@ -790,9 +1024,14 @@ class SpecificationHandler(MPlaneHandler):
                 print("Specification " + spec.get_label() + " successfully pulled by " + identity)
             else:
                 print("Interrupt " + spec.get_token() + " successfully pulled by " + identity)
-        self._respond_json_text(200, mplane.model.unparse_json(env))
+        await self._respond_message(env)
 
-class ResultHandler(MPlaneHandler):
+    def on_connection_close(self):
+        self._closed = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+class ResultHandler(MPlaneStreamHandler):
     """
     Receives results of specifications
 
@@ -804,9 +1043,8 @@ class ResultHandler(MPlaneHandler):
 
     def post(self):
         # unwrap json message from body
-        if (self.request.headers["Content-Type"] == "application/x-mplane+json"):
-            env = mplane.model.parse_json(self.request.body.decode("utf-8"))
-        else:
+        env = self._received_message()
+        if env is None:
             self._respond_plain_text(400, "Invalid format")
             return
 
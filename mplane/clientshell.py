@@ -44,6 +44,8 @@ class ClientShell(cmd.Cmd):
 
         # boot the model
         mplane.model.initialize_registry(config["client"]["registry_uri"])
+        mplane.model.set_token_digest(config.get("client", "token_digest",
+                                                 fallback=mplane.model.DIGEST_MD5))
 
         super().__init__()
         tls_state = mplane.tls.TlsState(config)
@@ -61,7 +63,8 @@ class ClientShell(cmd.Cmd):
                                                             tls_state=tls_state)
         elif config["client"]["workflow"] == "client-initiated":
             self.workflow = "client-initiated"
-            self._client = mplane.client.HttpInitiatorClient(tls_state=tls_state)
+            self._client = mplane.client.HttpInitiatorClient(tls_state=tls_state,
+                                compression=mplane.utils.HttpCompression.from_config(config, "client"))
         else:
             raise ValueError("workflow setting in " + args.CONF + " can only be 'client-initiated' or 'component-initiated'")
 
@@ -31,27 +31,43 @@ import importlib
 import configparser
 import tornado.web
 import tornado.httpserver
-from datetime import datetime
+import tornado.ioloop
+import tornado.concurrent
+import tornado.gen
+import tornado.util
+from datetime import datetime, timedelta
 import time
 import argparse
 from time import sleep
 import urllib3
 if mplane.utils.versiontuple(urllib3.__version__) > mplane.utils.versiontuple("1.9"):
     urllib3.disable_warnings()
-from threading import Thread
+from threading import Thread, Condition
+import collections
+import tempfile
+import traceback
 import json
 
-SLEEP_QUANTUM = 0.250
 CAPABILITY_PATH_ELEM = "capability"
 SPECIFICATION_PATH_ELEM = "/"
 
+DEFAULT_IDLE_TIME = 5
+DEFAULT_LONG_POLL_WAIT = 30
+DEFAULT_UPLINK_BATCH_SIZE = 32
+DEFAULT_UPLINK_QUEUE_ROWS = 1000000
+DEFAULT_UPLINK_MAX_BACKOFF = 60
+DEFAULT_UPLINK_MAX_RETRIES = 10
+
 class BaseComponent(object):
 
     def __init__(self, config):
         self.config = config
         # FIXME use registry preload
         mplane.model.initialize_registry(self.config["component"]["registry_uri"])
+        mplane.model.set_token_digest(self.config.get("component", "token_digest",
+                                                      fallback=mplane.model.DIGEST_MD5))
         self.tls = mplane.tls.TlsState(self.config)
+        self.compression = mplane.utils.HttpCompression.from_config(self.config, "component")
         self.scheduler = mplane.scheduler.Scheduler(config)
         for service in self._services():
             service.set_capability_link(SPECIFICATION_PATH_ELEM)
@@ -63,10 +79,20 @@ class BaseComponent(object):
             if section.startswith("module_"):
                 module = importlib.import_module(self.config[section]["module"])
                 kwargs = {}
+                max_concurrency = None
+                run_in_process = False
                 for arg in self.config[section]:
-                    if not arg.startswith("module"):
+                    if arg == "max_concurrency":
+                        max_concurrency = self.config.getint(section, arg)
+                    elif arg == "run_in_process":
+                        run_in_process = self.config.getboolean(section, arg)
+                    elif not arg.startswith("module"):
                         kwargs[arg] = self.config[section][arg]
                 for service in module.services(**kwargs):
+                    if max_concurrency is not None:
+                        service.set_max_concurrency(max_concurrency)
+                    if run_in_process:
+                        service.set_run_in_process()
                     services.append(service)
         return services
 
@@ -76,12 +102,19 @@ class ListenerHttpComponent(BaseComponent):
         port = config.getint("component", "listen-port")
         super(ListenerHttpComponent, self).__init__(config)
 
+        # run asynchronous services on the loop serving HTTP
+        if io_loop is not None:
+            self.scheduler.set_event_loop(io_loop)
+        else:
+            self.scheduler.set_event_loop(tornado.ioloop.IOLoop.instance())
+
         application = tornado.web.Application([
             (r"/", MessagePostHandler, {'scheduler': self.scheduler, 'tlsState': self.tls}),
             (r"/"+CAPABILITY_PATH_ELEM, DiscoveryHandler, {'scheduler': self.scheduler, 'tlsState': self.tls}),
             (r"/"+CAPABILITY_PATH_ELEM+"/.*", DiscoveryHandler, {'scheduler': self.scheduler, 'tlsState': self.tls})
-        ])
-        http_server = tornado.httpserver.HTTPServer(application, ssl_options=self.tls.get_ssl_options())
+        ], transforms=[self.compression.transform()])
+        http_server = tornado.httpserver.HTTPServer(application, ssl_options=self.tls.server_context(),
+                                                    decompress_request=True)
         http_server.listen(port)
         comp_t = Thread(target=self.listen_in_background(io_loop))
         comp_t.setDaemon(True)
@@ -98,10 +131,19 @@ class MPlaneHandler(tornado.web.RequestHandler):
     handler to respond with an mPlane Message.
 
     """
-    def _respond_message(self, msg):
+    async def _respond_message(self, msg):
+        # in the format the client accepts; large JSON results are
+        # written and flushed a chunk at a time
+        fmt = mplane.utils.reply_format(self.request.headers.get("Accept"))
         self.set_status(200)
-        self.set_header("Content-Type", "application/x-mplane+json")
-        self.write(mplane.model.unparse_json(msg))
+        self.set_header("Content-Type", mplane.utils.message_media_type(fmt))
+        if fmt == mplane.utils.FORMAT_CBOR:
+            self.write(mplane.model.unparse_cbor(msg))
+        else:
+            compact = (fmt == mplane.utils.FORMAT_COMPACT_JSON)
+            for chunk in mplane.model.iter_unparse_json(msg, compact=compact):
+                self.write(chunk)
+                await self.flush()
         self.finish()
 
 class DiscoveryHandler(MPlaneHandler):
@@ -116,14 +158,14 @@ class DiscoveryHandler(MPlaneHandler):
         self.scheduler = scheduler
         self.tls = tlsState
 
-    def get(self):
+    async def get(self):
         # capabilities
         path = self.request.path.split("/")[1:]
         if path[0] == CAPABILITY_PATH_ELEM:
             if (len(path) == 1 or path[1] is None):
                 self._respond_capability_links()
             else:
-                self._respond_capability(path[1])
+                await self._respond_capability(path[1])
         else:
             # FIXME how do we tell tornado we don't want to handle this?
             raise ValueError("I only know how to handle /"+CAPABILITY_PATH_ELEM+" URLs via HTTP GET")
@@ -138,8 +180,16 @@ class DiscoveryHandler(MPlaneHandler):
         self.write("</body></html>")
         self.finish()
 
-    def _respond_capability(self, key):
-        self._respond_message(self.scheduler.capability_for_key(key))
+    async def _respond_capability(self, key):
+        # capability keys are tokens, so they tag the content; the
+        # reply is streamed, which tornado cannot tag by itself
+        fmt = mplane.utils.reply_format(self.request.headers.get("Accept"))
+        self.set_header("Etag", '"' + key + '-' + fmt + '"')
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+        await self._respond_message(self.scheduler.capability_for_key(key))
 
 class MessagePostHandler(MPlaneHandler):
     """
@@ -168,10 +218,11 @@ class MessagePostHandler(MPlaneHandler):
         self.write("</body></html>")
         self.finish()
 
-    def post(self):
+    async def post(self):
         # unwrap json message from body
-        if (self.request.headers["Content-Type"] == "application/x-mplane+json"):
-            msg = mplane.model.parse_json(self.request.body.decode("utf-8"))
+        content_type = self.request.headers["Content-Type"]
+        if mplane.utils.is_mplane_message(content_type):
+            msg = mplane.utils.parse_message(self.request.body, content_type)
         else:
             # FIXME how do we tell tornado we don't want to handle this?
             raise ValueError("I only know how to handle mPlane JSON messages via HTTP POST")
@@ -179,20 +230,206 @@ class MessagePostHandler(MPlaneHandler):
         # hand message to scheduler
         reply = self.scheduler.process_message(self.tls.extract_peer_identity(self.request), msg)
 
-        # wait for immediate delay
+        # wait for immediate delay, serving other requests meanwhile
         if self.immediate_ms > 0 and \
            isinstance(msg, mplane.model.Specification) and \
            isinstance(reply, mplane.model.Receipt):
             job = self.scheduler.job_for_message(reply)
-            wait_start = datetime.utcnow()
-            while (datetime.utcnow() - wait_start).total_seconds() * 1000 < self.immediate_ms:
-                time.sleep(SLEEP_QUANTUM)
-                if job.failed() or job.finished():
-                    reply = job.get_reply()
-                    break
+            done = tornado.concurrent.Future()
+            io_loop = tornado.ioloop.IOLoop.current()
+
+            def job_done(job):
+                # called on the thread finishing the job
+                io_loop.add_callback(lambda: done.done() or done.set_result(None))
+
+            job.add_done_callback(job_done)
+            try:
+                await tornado.gen.with_timeout(
+                        timedelta(milliseconds=self.immediate_ms), done)
+            except tornado.util.TimeoutError:
+                pass
+            if job.failed() or job.finished():
+                reply = job.get_reply()
 
         # return reply
-        self._respond_message(reply)
+        await self._respond_message(reply)
+
+class ResultUplink(object):
+    """
+    Queue of replies (receipts, results and exceptions) to return to
+    a Client/Supervisor, so that jobs never wait for the network.
+
+    A sender thread passes the queued replies to post(msg), which
+    returns the HTTP response, in Envelopes of up to batch_size
+    replies; a single reply is sent as it is. Posts failing with a
+    connection error or a server error are retried with exponential
+    backoff, from backoff up to max_backoff seconds, up to max_retries
+    times; then, or on any other error, the batch is dropped.
+    report(replies, res) is called for each batch sent.
+
+    Replies are kept in memory up to queue_rows result rows (each
+    reply counting at least one); beyond that, and until the memory
+    queue has drained, they are spilled, one JSON line each, to the
+    file spill_path (a temporary file by default) and read back in
+    order.
+
+    """
+    def __init__(self, post, report=None,
+                 batch_size=DEFAULT_UPLINK_BATCH_SIZE,
+                 queue_rows=DEFAULT_UPLINK_QUEUE_ROWS,
+                 spill_path=None,
+                 backoff=1,
+                 max_backoff=DEFAULT_UPLINK_MAX_BACKOFF,
+                 max_retries=DEFAULT_UPLINK_MAX_RETRIES):
+        self._post = post
+        self._report = report
+        self._batch_size = batch_size
+        self._queue_rows = queue_rows
+        self._spill_path = spill_path
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._max_retries = max_retries
+
+        self._cond = Condition()
+        self._queue = collections.deque()
+        self._rows = 0
+        self._sending = 0
+        self._spill_file = None
+        self._spilled = 0
+        self._spill_read = 0
+
+        t = Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    @classmethod
+    def from_config(cls, config, post, report=None):
+        """
+        Creates an uplink configured by the uplink_batch_size,
+        uplink_queue_rows, uplink_spill_file, uplink_max_backoff and
+        uplink_max_retries keys of the component section
+
+        """
+        return cls(post, report,
+                   batch_size=config.getint("component", "uplink_batch_size",
+                                            fallback=DEFAULT_UPLINK_BATCH_SIZE),
+                   queue_rows=config.getint("component", "uplink_queue_rows",
+                                            fallback=DEFAULT_UPLINK_QUEUE_ROWS),
+                   spill_path=config.get("component", "uplink_spill_file",
+                                         fallback=None),
+                   max_backoff=config.getint("component", "uplink_max_backoff",
+                                             fallback=DEFAULT_UPLINK_MAX_BACKOFF),
+                   max_retries=config.getint("component", "uplink_max_retries",
+                                             fallback=DEFAULT_UPLINK_MAX_RETRIES))
+
+    def put(self, msg):
+        """ Queues a reply to send; never blocks on the network """
+        rows = _reply_rows(msg)
+        with self._cond:
+            if self._spilled or (self._queue and
+                                 self._rows + rows > self._queue_rows):
+                self._spill(msg)
+            else:
+                self._queue.append((msg, rows))
+                self._rows += rows
+            self._cond.notify()
+
+    def pending(self):
+        """ Returns the number of replies not sent yet """
+        with self._cond:
+            return len(self._queue) + self._spilled + self._sending
+
+    def spilled(self):
+        """ Returns the number of replies waiting in the spill file """
+        with self._cond:
+            return self._spilled
+
+    def _spill(self, msg):
+        if self._spill_file is None:
+            if self._spill_path:
+                self._spill_file = open(self._spill_path, "w+b")
+            else:
+                self._spill_file = tempfile.TemporaryFile()
+        self._spill_file.seek(0, 2)
+        self._spill_file.write(mplane.model.unparse_json(msg, compact=True).encode("utf-8"))
+        self._spill_file.write(b"\n")
+        self._spilled += 1
+
+    def _unspill(self):
+        # read spilled replies back while there is room in memory
+        self._spill_file.seek(self._spill_read)
+        while self._spilled and (not self._queue or self._rows < self._queue_rows):
+            msg = mplane.model.parse_json(self._spill_file.readline().decode("utf-8"))
+            rows = _reply_rows(msg)
+            self._queue.append((msg, rows))
+            self._rows += rows
+            self._spilled -= 1
+        self._spill_read = self._spill_file.tell()
+        if not self._spilled:
+            self._spill_file.seek(0)
+            self._spill_file.truncate()
+            self._spill_read = 0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._spilled:
+                    self._cond.wait()
+                if self._spilled:
+                    self._unspill()
+                batch = []
+                while self._queue and len(batch) < self._batch_size:
+                    (msg, rows) = self._queue.popleft()
+                    self._rows -= rows
+                    batch.append(msg)
+                self._sending = len(batch)
+
+            try:
+                if len(batch) == 1:
+                    msg = batch[0]
+                else:
+                    msg = mplane.model.Envelope()
+                    for reply in batch:
+                        msg.append_message(reply)
+                res = self._send(msg)
+                if res is None:
+                    print("Dropped " + str(len(batch)) + " replies to Client/Supervisor")
+                elif self._report is not None:
+                    self._report(batch, res)
+            except Exception:
+                print("Error returning " + str(len(batch)) + " replies to Client/Supervisor:")
+                traceback.print_exc()
+            finally:
+                with self._cond:
+                    self._sending = 0
+
+    def _send(self, msg):
+        """
+        Posts a message, retrying on connection and server errors;
+        returns the response, or None once max_retries are exhausted
+
+        """
+        backoff = self._backoff
+        for attempt in range(self._max_retries + 1):
+            if attempt > 0:
+                print("Retrying in " + str(backoff) + " seconds")
+                sleep(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
+            try:
+                res = self._post(msg)
+                if res.status < 500:
+                    return res
+                print("Client/Supervisor said: " + str(res.status) + " - " + res.data.decode("utf-8"))
+            except urllib3.exceptions.HTTPError as e:
+                print("Error returning results to Client/Supervisor: " + str(e))
+        return None
+
+def _reply_rows(msg):
+    if isinstance(msg, mplane.model.Envelope):
+        return max(sum(_reply_rows(m) for m in msg.messages()), 1)
+    elif isinstance(msg, mplane.model.Result):
+        return max(msg.count_result_rows(), 1)
+    return 1
 
 class InitiatorHttpComponent(BaseComponent):
 
@@ -217,7 +454,24 @@ class InitiatorHttpComponent(BaseComponent):
         if not self.result_path.startswith("/"):
             self.result_path = "/" + self.result_path
 
+        # format to send messages in, and to ask for in replies
+        self._format = mplane.utils.message_format(self.config, "component")
+        self._headers = {"content-type": mplane.utils.message_media_type(self._format)}
+        if self._format != mplane.utils.FORMAT_JSON:
+            self._headers["accept"] = mplane.utils.message_media_type(self._format)
+
+        # how long the Client/Supervisor may hold a request for
+        # specifications open, 0 to poll every idle time instead
+        self._long_poll_wait = self.config.getint("component", "long_poll_wait",
+                                                  fallback=DEFAULT_LONG_POLL_WAIT)
+
         self.pool = self.tls.pool_for(self.url.scheme, self.url.host, self.url.port)
+
+        # receipts and results are returned in the background
+        self._uplink = ResultUplink.from_config(self.config,
+                            lambda msg: self._post_message(self.result_path, msg),
+                            self._report_replies)
+
         self.register_to_client()
 
         # periodically poll the Client/Supervisor for Specifications
@@ -225,6 +479,25 @@ class InitiatorHttpComponent(BaseComponent):
         t = Thread(target=self.check_for_specs)
         t.start()
 
+    def _post_message(self, path, msg):
+        """
+        Posts a message to the Client/Supervisor, compressed
+        if it accepts it, and returns the response
+
+        """
+        headers = dict(self._headers)
+        body = self.compression.encode_request(
+                    mplane.utils.unparse_message(msg, self._format),
+                    headers, self.url.host, self.url.port)
+        try:
+            res = self.pool.urlopen('POST', path, body=body, headers=headers)
+        except urllib3.exceptions.HTTPError:
+            # the Client/Supervisor may come back with another certificate
+            self.tls.forget_peer_identity(self.url)
+            raise
+        self.compression.learn(res, self.url.host, self.url.port)
+        return res
+
     def register_to_client(self, caps=None):
         """
         Sends a list of capabilities to the Client, in order to register them
@@ -264,9 +537,7 @@ class InitiatorHttpComponent(BaseComponent):
             env.append_message(callback_cap)
 
         # send the envelope to the client
-        res = self.pool.urlopen('POST',self.registration_path,
-                    body=mplane.model.unparse_json(env).encode("utf-8"),
-                    headers={"content-type": "application/x-mplane+json"})
+        res = self._post_message(self.registration_path, env)
 
         # handle response message
         if res.status == 200:
@@ -287,35 +558,58 @@ class InitiatorHttpComponent(BaseComponent):
         Poll the client for specifications
 
         """
+        headers = dict(self._headers)
+        self.compression.encode_request(None, headers, self.url.host, self.url.port)
+        timeout = None
+        if self._long_poll_wait > 0:
+            # ask the Client/Supervisor to hold the request until
+            # there are specifications, and keep reading until then
+            headers["Prefer"] = "wait=%d" % self._long_poll_wait
+            timeout = urllib3.Timeout(connect=DEFAULT_IDLE_TIME,
+                                      read=self._long_poll_wait + DEFAULT_IDLE_TIME)
         while(True):
             # FIXME configurable default idle time.
-            self.idle_time = 5
+            self.idle_time = DEFAULT_IDLE_TIME
+            long_poll = False
             # send a request for specifications
-            res = self.pool.request('GET', self.specification_path)
+            try:
+                res = self.pool.request('GET', self.specification_path,
+                                        headers=headers, timeout=timeout)
+            except urllib3.exceptions.HTTPError as e:
+                print("Error polling Client/Supervisor for Specifications: " + str(e))
+                self.tls.forget_peer_identity(self.url)
+                sleep(self.idle_time)
+                continue
+            self.compression.learn(res, self.url.host, self.url.port)
+            # the request may have been sent on a new connection
+            self._client_identity = self.tls.extract_peer_identity(self.url)
             if res.status == 200:
+                # the Client/Supervisor long polls, so poll again
+                # right away unless a callback says otherwise
+                long_poll = res.getheader("Preference-Applied") is not None
 
                 # specs retrieved: split them if there is more than one
-                env = mplane.model.parse_json(res.data.decode("utf-8"))
+                env = mplane.utils.parse_message(res.data, res.getheader("Content-Type"))
                 for spec in env.messages():
                     # handle callbacks
                     if spec.get_label()  == "callback":
                         self.idle_time = spec.when().timer_delays()[1]
+                        long_poll = False
                         break
 
                     # hand spec to scheduler
                     reply = self.scheduler.process_message(self._client_identity, spec, callback=self.return_results)
 
                     # send receipt to the Client/Supervisor
-                    res = self.pool.urlopen('POST', self.result_path,
-                            body=mplane.model.unparse_json(reply).encode("utf-8"),
-                            headers={"content-type": "application/x-mplane+json"})
+                    self._uplink.put(reply)
 
             # not registered on supervisor, need to re-register
             elif res.status == 428:
                 print("\nRe-registering capabilities on Client/Supervisor")
                 self.register_to_supervisor()
 
-            sleep(self.idle_time)
+            if not long_poll:
+                sleep(self.idle_time)
 
     def return_results(self, receipt):
         """
@@ -330,26 +624,36 @@ class InitiatorHttpComponent(BaseComponent):
             job.failed() is not True):
             return
 
-        # send result to the Client/Supervisor
-        res = self.pool.urlopen('POST', self.result_path,
-                body=mplane.model.unparse_json(reply).encode("utf-8"),
-                headers={"content-type": "application/x-mplane+json"})
+        # queue result for the Client/Supervisor
+        self._uplink.put(reply)
 
-        # handle response
-        if isinstance(reply, mplane.model.Envelope):
-            for msg in reply.messages():
-                label = msg.get_label()
-                break
-        else:
-            if isinstance(reply, mplane.model.Exception):
-                print("Exception for " + reply.get_token() + " successfully returned!")
-                return
+    def _report_replies(self, replies, res):
+        """
+        Reports the outcome of returning a batch of replies
 
-            label = reply.get_label()
-        if res.status == 200:
-            print("Result for " + label + " successfully returned!")
-        else:
-            print("Error returning Result for " + label)
+        """
+        for reply in replies:
+            if isinstance(reply, mplane.model.Envelope):
+                # named after the envelope or its first message
+                label = reply.get_label()
+                for msg in reply.messages():
+                    label = msg.get_label()
+                    break
+                if label is None:
+                    label = str(reply.get_token())
+            elif isinstance(reply, mplane.model.Receipt):
+                continue
+            elif isinstance(reply, mplane.model.Exception):
+                if res.status == 200:
+                    print("Exception for " + reply.get_token() + " successfully returned!")
+                continue
+            else:
+                label = reply.get_label()
+            if res.status == 200:
+                print("Result for " + label + " successfully returned!")
+            else:
+                print("Error returning Result for " + label)
+        if res.status != 200:
             print("Client/Supervisor said: " + str(res.status) + " - " + res.data.decode("utf-8"))
         pass
 
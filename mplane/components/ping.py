@@ -28,6 +28,7 @@ the mPlane reference implementation.
 """
 
 import re
+import asyncio
 import subprocess
 import collections
 from datetime import datetime
@@ -77,7 +78,7 @@ def _ping_process(progname, sipaddr, dipaddr, period=None, count=None):
 
     print("running " + " ".join(ping_argv))
 
-    return subprocess.Popen(ping_argv, stdout=subprocess.PIPE)
+    return asyncio.create_subprocess_exec(*ping_argv, stdout=subprocess.PIPE)
 
 def _ping4_process(sipaddr, dipaddr, period=None, count=None):
     return _ping_process(_ping4cmd, sipaddr, dipaddr, period, count)
@@ -139,7 +140,7 @@ def ping6_singleton_capability(ipaddr):
     cap.add_result_column("delay.twoway.icmp.us")
     return cap
 
-class PingService(mplane.scheduler.Service):
+class PingService(mplane.scheduler.AsyncService):
     def __init__(self, cap):
         # verify the capability is acceptable
         if not ((cap.has_parameter("source.ip4") or 
@@ -154,7 +155,7 @@ class PingService(mplane.scheduler.Service):
             raise ValueError("capability not acceptable")
         super(PingService, self).__init__(cap)
 
-    def run(self, spec, check_interrupt):
+    async def run(self, spec):
          # unpack parameters
         period = int(spec.when().period().total_seconds())
         duration = spec.when().duration().total_seconds()
@@ -166,30 +167,31 @@ class PingService(mplane.scheduler.Service):
         if spec.has_parameter("destination.ip4"):
             sipaddr = spec.get_parameter_value("source.ip4")
             dipaddr = spec.get_parameter_value("destination.ip4")
-            ping_process = _ping4_process(sipaddr, dipaddr, period, count)
+            ping_process = await _ping4_process(sipaddr, dipaddr, period, count)
         elif spec.has_parameter("destination.ip6"):
             sipaddr = spec.get_parameter_value("source.ip6")
             dipaddr = spec.get_parameter_value("destination.ip6")
-            ping_process = _ping6_process(sipaddr, dipaddr, period, count)
+            ping_process = await _ping6_process(sipaddr, dipaddr, period, count)
         else:
             raise ValueError("Missing destination")
 
-        # read output from ping
+        # read output from ping until done or interrupted
         pings = []
-        for line in ping_process.stdout:
-            if check_interrupt():
-                break
-            oneping = _parse_ping_line(line.decode("utf-8"))
-            if oneping is not None:
-                print("ping "+repr(oneping))
-                pings.append(oneping)
+        try:
+            async for line in ping_process.stdout:
+                oneping = _parse_ping_line(line.decode("utf-8"))
+                if oneping is not None:
+                    print("ping "+repr(oneping))
+                    pings.append(oneping)
+        except asyncio.CancelledError:
+            pass
  
         # shut down and reap
         try:
             ping_process.kill()
         except OSError:
             pass
-        ping_process.wait()
+        await ping_process.wait()
 
         # derive a result from the specification
         res = mplane.model.Result(specification=spec)
@@ -200,11 +202,10 @@ class PingService(mplane.scheduler.Service):
         # are we returning aggregates or raw numbers?
         if res.has_result_column("delay.twoway.icmp.us"):
             # raw numbers
-            for i, oneping in enumerate(pings):
-                res.set_result_value("delay.twoway.icmp.us", oneping.usec, i)
+            res.extend_column("delay.twoway.icmp.us",
+                              [oneping.usec for oneping in pings])
             if res.has_result_column("time"):
-                for i, oneping in enumerate(pings):
-                    res.set_result_value("time", oneping.time, i)
+                res.extend_column("time", [oneping.time for oneping in pings])
         else:
             # aggregates. single row.
             if res.has_result_column("delay.twoway.icmp.us.min"):
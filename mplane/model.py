@@ -309,16 +309,25 @@ The client receives the Envelope and decomposes the encapsulated messages:
 """
 
 try:
-    from ipaddress import ip_address
+    from ipaddress import ip_address, IPv4Address, IPv6Address
 except ImportError:
-    from ipaddr import IPAddress as ip_address
+    from ipaddr import IPAddress as ip_address, IPv4Address, IPv6Address
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from datetime import datetime, timedelta, timezone
 from copy import copy, deepcopy
+from array import array
 import urllib.request
 import urllib.parse
 import collections
+import collections.abc
+import codecs
 import functools
+import itertools
 import operator
 import hashlib
 import json
@@ -327,6 +336,7 @@ import re
 import os
 
 from mplane.utils import normalize_path
+import mplane.cbor
 
 #######################################################################
 # String constants for protocol framing
@@ -345,6 +355,10 @@ INNER_WHEN_SEP_END = " } "
 CONSTRAINT_ALL = "*"
 VALUE_NONE = "*"
 
+# rows unparsed at a time, and characters per chunk of streamed JSON
+RESULT_ROW_BATCH = 1024
+JSON_CHUNK_SIZE = 65536
+
 TIME_PAST = "past"
 TIME_NOW = "now"
 TIME_FUTURE = "future"
@@ -371,6 +385,7 @@ KEY_WHEN = "when"
 KEY_REGISTRY = "registry"
 KEY_LABEL = "label"
 KEY_CONTENTS = "contents"
+KEY_QUEUE_POSITION = "queue-position"
 
 KEY_MONTHS = "months"
 KEY_DAYS = "days"
@@ -516,6 +531,9 @@ class _PastTime:
     def __repr__(self):
         return "mplane.model.time_past"
 
+    def __reduce__(self):
+        return "time_past"
+
     def strftime(self, ign):
         return str(self)
 
@@ -533,6 +551,9 @@ class _NowTime:
     def __repr__(self):
         return "mplane.model.time_now"
 
+    def __reduce__(self):
+        return "time_now"
+
     def strftime(self, ign):
         return str(self)
 
@@ -550,6 +571,9 @@ class _FutureTime:
     def __repr__(self):
         return "mplane.model.time_future"
 
+    def __reduce__(self):
+        return "time_future"
+
     def strftime(self, ign):
         return str(self)
 
@@ -1262,6 +1286,10 @@ class _Primitive(object):
     def __repr__(self):
         return "<special mplane primitive "+self.name+">"
 
+    def __reduce__(self):
+        # pickle primitives by reference to the module-level instances
+        return "prim_"+self.name
+
     def parse(self, sval):
         """
         Converts a string to a value; default implementation
@@ -1287,6 +1315,15 @@ class _Primitive(object):
         else:
             return str(val)
 
+    def to_native(self, val):
+        """
+        Converts a value to the value written by binary encodings
+        (see :func:`mplane.model.unparse_cbor`); default implementation
+        returns the value itself, None for no value.
+
+        """
+        return val
+
 class _StringPrimitive(_Primitive):
     """
     Represents a string. Uses the default implementation.
@@ -1424,11 +1461,21 @@ class _TimePrimitive(_Primitive):
         return "mplane.model.prim_time"
 
     def parse(self, valstr):
+        if valstr == VALUE_NONE:
+            return None
         return parse_time(valstr)
 
     def unparse(self, val):
+        if val is None:
+            return VALUE_NONE
         return unparse_time(val)
 
+    def to_native(self, val):
+        # special past/now/future times are written as strings
+        if val is None or isinstance(val, datetime):
+            return val
+        return self.unparse(val)
+
 prim_string = _StringPrimitive()
 prim_natural = _NaturalPrimitive()
 prim_real = _RealPrimitive()
@@ -1499,6 +1546,10 @@ class Element(object):
         self._desc = desc
         self._qualname = namespace + ANCHOR_SEP + name
 
+    def _copy(self):
+        # copy for a statement's copy-on-write element storage
+        return copy(self)
+
     def __str__(self):
         return self._name
 
@@ -2031,6 +2082,321 @@ class Metavalue(Element):
     def _as_tuple(self):
         return (self._name, self._prim.unparse(self._val))
 
+#######################################################################
+# Result column storage
+#######################################################################
+
+_EPOCH = datetime(1970, 1, 1)
+
+class _Unrepresentable(ValueError):
+    """Raised by column storage for a value it cannot encode."""
+    pass
+
+class _ArrayStorage(object):
+    """
+    Compact storage for the values of a ResultColumn whose primitive
+    has a fixed-width native representation. Values are kept encoded
+    in an array.array, with one flag byte per value which is 0 for
+    null (None) values.
+
+    Behaves like the list it replaces: supports len(), iteration,
+    indexing and slicing (returning lists), item assignment within
+    its length, append() and del. Values which cannot be encoded raise
+    _Unrepresentable; the ResultColumn then falls back to a list.
+
+    """
+    typecode = None
+    dtype = None
+
+    def __init__(self):
+        super().__init__()
+        self._data = array(self.typecode)
+        self._flags = bytearray()
+
+    def _encode(self, val):
+        """Returns (raw value, nonzero flag) for a value."""
+        raise NotImplementedError()
+
+    def _decode(self, raw, flag):
+        raise NotImplementedError()
+
+    def _index(self, key):
+        if key < 0:
+            key += len(self._flags)
+        if key < 0 or key >= len(self._flags):
+            raise IndexError("column index out of range")
+        return key
+
+    def __len__(self):
+        return len(self._flags)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self._flags)))]
+        key = self._index(key)
+        flag = self._flags[key]
+        if flag:
+            return self._decode(self._data[key], flag)
+        return None
+
+    def __setitem__(self, key, val):
+        key = self._index(key)
+        if val is None:
+            self._data[key] = 0
+            self._flags[key] = 0
+        else:
+            (raw, flag) = self._encode(val)
+            self._data[key] = raw
+            self._flags[key] = flag
+
+    def __delitem__(self, key):
+        del self._data[key]
+        del self._flags[key]
+
+    def __iter__(self):
+        decode = self._decode
+        for (raw, flag) in zip(self._data, self._flags):
+            yield decode(raw, flag) if flag else None
+
+    def append(self, val):
+        if val is None:
+            self._data.append(0)
+            self._flags.append(0)
+        else:
+            (raw, flag) = self._encode(val)
+            self._data.append(raw)
+            self._flags.append(flag)
+
+    def extend(self, values, types=None):
+        """
+        Appends a list of values; types is the set of their types, if
+        known. Either all of them are appended, or _Unrepresentable is
+        raised and the storage is left unchanged.
+
+        """
+        if types is None:
+            types = set(map(type, values))
+        data = self._bulk_encode(values, types)
+        if data is not None:
+            self._data.extend(data)
+            self._flags.extend(b"\x01" * len(values))
+        else:
+            # nulls or mixed types: encode one by one
+            other = self.__class__()
+            for val in values:
+                other.append(val)
+            self._data.extend(other._data)
+            self._flags.extend(other._flags)
+
+    def _bulk_encode(self, values, types):
+        """
+        Returns an array of the encoded values if none of them is null
+        and they can be encoded in one go, otherwise None.
+
+        """
+        return None
+
+    def extend_nulls(self, count):
+        """Appends count null values."""
+        self._data.frombytes(bytes(count * self._data.itemsize))
+        self._flags.extend(bytes(count))
+
+    def clear(self):
+        del self._data[:]
+        del self._flags[:]
+
+    def copy(self):
+        other = self.__class__()
+        other._data = array(self.typecode, self._data)
+        other._flags = bytearray(self._flags)
+        return other
+
+    def _numpy_data(self):
+        return numpy.frombuffer(self._data, dtype=self.dtype).copy()
+
+    def _numpy_mask(self):
+        return numpy.frombuffer(bytes(self._flags), dtype=numpy.uint8) == 0
+
+class _NaturalStorage(_ArrayStorage):
+    """Stores natural values as 64-bit integers."""
+    typecode = 'q'
+    dtype = 'int64'
+
+    def _encode(self, val):
+        if not isinstance(val, int) or isinstance(val, bool) or \
+           not -2**63 <= val < 2**63:
+            raise _Unrepresentable(val)
+        return (val, 1)
+
+    def _bulk_encode(self, values, types):
+        if types == {int}:
+            try:
+                return array(self.typecode, values)
+            except OverflowError:
+                pass
+        return None
+
+    def _decode(self, raw, flag):
+        return raw
+
+class _RealStorage(_ArrayStorage):
+    """Stores real values as 64-bit floats."""
+    typecode = 'd'
+    dtype = 'float64'
+
+    def _encode(self, val):
+        if not isinstance(val, (float, int)) or isinstance(val, bool):
+            raise _Unrepresentable(val)
+        return (float(val), 1)
+
+    def _bulk_encode(self, values, types):
+        if types == {float} or types == {float, int}:
+            return array(self.typecode, values)
+        return None
+
+    def _decode(self, raw, flag):
+        return raw
+
+class _TimeStorage(_ArrayStorage):
+    """
+    Stores UTC datetimes as 64-bit microseconds since the epoch. Aware
+    datetimes are stored, and returned, as naive UTC datetimes.
+
+    """
+    typecode = 'q'
+    dtype = 'datetime64[us]'
+
+    def _encode(self, val):
+        if not isinstance(val, datetime):
+            # the special past/now/future times
+            raise _Unrepresentable(val)
+        if val.tzinfo is not None:
+            val = val.astimezone(timezone.utc).replace(tzinfo=None)
+        delta = val - _EPOCH
+        return ((delta.days * 86400 + delta.seconds) * 1000000 +
+                delta.microseconds, 1)
+
+    def _bulk_encode(self, values, types):
+        if types == {datetime}:
+            if any(map(operator.attrgetter("tzinfo"), values)):
+                values = [val.astimezone(timezone.utc).replace(tzinfo=None)
+                          if val.tzinfo is not None else val
+                          for val in values]
+            return array(self.typecode,
+                         [(d.days * 86400 + d.seconds) * 1000000 +
+                          d.microseconds for d in map(_EPOCH.__rsub__, values)])
+        return None
+
+    def _decode(self, raw, flag):
+        return _EPOCH + timedelta(microseconds=raw)
+
+class _AddressStorage(_ArrayStorage):
+    """
+    Stores IPv4 and IPv6 addresses as 128-bit integers, 16 bytes each:
+    the low 64 bits in the data array, the high 64 bits in a second
+    array. The flag holds the IP version.
+
+    """
+    typecode = 'Q'
+    dtype = object
+
+    def __init__(self):
+        super().__init__()
+        self._high = array(self.typecode)
+
+    def _encode(self, val):
+        if type(val) is IPv4Address:
+            return ((0, int(val)), 4)
+        elif type(val) is IPv6Address and not getattr(val, "scope_id", None):
+            i = int(val)
+            return ((i >> 64, i & 0xffffffffffffffff), 6)
+        raise _Unrepresentable(val)
+
+    def _decode(self, raw, flag):
+        if flag == 4:
+            return IPv4Address(raw[1])
+        return IPv6Address((raw[0] << 64) | raw[1])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self._flags)))]
+        key = self._index(key)
+        flag = self._flags[key]
+        if flag:
+            return self._decode((self._high[key], self._data[key]), flag)
+        return None
+
+    def __setitem__(self, key, val):
+        key = self._index(key)
+        if val is None:
+            ((high, low), flag) = ((0, 0), 0)
+        else:
+            ((high, low), flag) = self._encode(val)
+        self._high[key] = high
+        self._data[key] = low
+        self._flags[key] = flag
+
+    def __delitem__(self, key):
+        del self._high[key]
+        super().__delitem__(key)
+
+    def __iter__(self):
+        decode = self._decode
+        for (raw, flag) in zip(zip(self._high, self._data), self._flags):
+            yield decode(raw, flag) if flag else None
+
+    def append(self, val):
+        if val is None:
+            ((high, low), flag) = ((0, 0), 0)
+        else:
+            ((high, low), flag) = self._encode(val)
+        self._high.append(high)
+        self._data.append(low)
+        self._flags.append(flag)
+
+    def extend(self, values, types=None):
+        if types is None:
+            types = set(map(type, values))
+        if types == {IPv4Address}:
+            self._data.extend(map(int, values))
+            self._high.frombytes(bytes(8 * len(values)))
+            self._flags.extend(b"\x04" * len(values))
+            return
+        encoded = [self._encode(val) if val is not None else ((0, 0), 0)
+                   for val in values]
+        self._high.extend(raw[0] for (raw, flag) in encoded)
+        self._data.extend(raw[1] for (raw, flag) in encoded)
+        self._flags.extend(bytes(flag for (raw, flag) in encoded))
+
+    def extend_nulls(self, count):
+        self._high.frombytes(bytes(8 * count))
+        super().extend_nulls(count)
+
+    def clear(self):
+        del self._high[:]
+        super().clear()
+
+    def copy(self):
+        other = super().copy()
+        other._high = array(self.typecode, self._high)
+        return other
+
+    def _numpy_data(self):
+        return numpy.array([v for v in self], dtype=object)
+
+_column_storage = {
+    "natural": _NaturalStorage,
+    "real": _RealStorage,
+    "time": _TimeStorage,
+    "address": _AddressStorage
+}
+
+def _new_column_storage(prim):
+    try:
+        return _column_storage[prim.name]()
+    except KeyError:
+        return []
+
 class ResultColumn(Element):
     """
     A ResultColumn is an element which can take an array of values.
@@ -2038,37 +2404,124 @@ class ResultColumn(Element):
     Results it has one or more values, such that all the ResultColumns
     in the Result have the same number of values.
 
+    Values of natural, real, time and address columns are stored
+    compactly, encoded in typed arrays; other columns, and columns
+    given a value which does not fit the typed storage, use a list.
+
+    Columns of a Result parsed from a dictionary keep their values as
+    received, and only decode them when they are first accessed.
+
     """
     def __init__(self, parent_element):
         super().__init__(parent_element._name, parent_element._prim)
-        self._vals = []
+        self._values = _new_column_storage(self._prim)
+        # (rows, index) of the undecoded values, see Result._from_dict()
+        self._raw = None
+        # True while the values are those received in the raw rows
+        self._pristine = False
+
+    @property
+    def _vals(self):
+        if self._raw is not None:
+            self._decode_raw()
+        return self._values
+
+    @_vals.setter
+    def _vals(self, vals):
+        self._values = vals
+
+    def _set_raw(self, rows, index):
+        self._raw = (rows, index)
+        self._pristine = True
+
+    def _decode_raw(self):
+        (rows, index) = self._raw
+        self._raw = None
+        parse = self._prim.parse
+        try:
+            values = [row[index] for row in rows]
+        except IndexError:
+            # short rows leave the value null
+            values = [row[index] if index < len(row) else None for row in rows]
+        values = [parse(val) if isinstance(val, str) else val
+                  for val in values]
+        if isinstance(self._values, list):
+            self._values.extend(values)
+            return
+        try:
+            self._values.extend(values)
+        except _Unrepresentable:
+            self._values = list(self._values)
+            self._values.extend(values)
 
     def __repr__(self):
         return "<ResultColumn "+str(self)+" "+repr(self._prim)+\
                " with "+str(len(self))+" values>"
 
     def __len__(self):
-        return len(self._vals)
+        if self._raw is not None:
+            return len(self._raw[0])
+        return len(self._values)
 
     def __getitem__(self, key):
         return self._vals[key]
 
     def __setitem__(self, key, val):
+        self._pristine = False
+
         # Automatically parse strings
         if isinstance(val, str):
             val = self._prim.parse(val)
 
         # Automatically extend column to fit
-        while len(self) < key:
-            self._vals.append(None)
+        if len(self) < key:
+            if isinstance(self._vals, list):
+                self._vals.extend([None] * (key - len(self)))
+            else:
+                self._vals.extend_nulls(key - len(self))
 
         # Append or replace value
-        if len(self) == key:
-            self._vals.append(val)
-        else:
-            self._vals[key] = val
+        try:
+            if len(self) == key:
+                self._vals.append(val)
+            else:
+                self._vals[key] = val
+        except _Unrepresentable:
+            self._vals = list(self._vals)
+            self.__setitem__(key, val)
+
+    def extend(self, values, start=None):
+        """
+        Appends values to this column; strings are parsed. If start is
+        given, the column is first padded with nulls up to that row.
+
+        """
+        self._pristine = False
+        values = list(values)
+        types = set(map(type, values))
+        if str in types:
+            parse = self._prim.parse
+            values = [parse(val) if isinstance(val, str) else val
+                      for val in values]
+            types = set(map(type, values))
+
+        if start is not None and len(self) < start:
+            if isinstance(self._vals, list):
+                self._vals.extend([None] * (start - len(self)))
+            else:
+                self._vals.extend_nulls(start - len(self))
+
+        if isinstance(self._vals, list):
+            self._vals.extend(values)
+            return
+        try:
+            self._vals.extend(values, types)
+        except _Unrepresentable:
+            self._vals = list(self._vals)
+            self._vals.extend(values)
 
     def __delitem__(self, key):
+        self._pristine = False
         del(self._vals[key])
 
     def __iter__(self):
@@ -2076,7 +2529,72 @@ class ResultColumn(Element):
 
     def clear(self):
         """ Clears values. """
-        self._vals.clear()
+        self._pristine = False
+        self._raw = None
+        self._values.clear()
+
+    def to_numpy(self):
+        """
+        Returns the values of this column as a NumPy array: int64 for
+        natural, float64 for real, datetime64[us] for time columns, and
+        an object array otherwise. If the column has null values, returns
+        a masked array with these masked. Requires NumPy.
+
+        """
+        if numpy is None:
+            raise ImportError("ResultColumn.to_numpy() requires numpy")
+        if isinstance(self._vals, list):
+            data = numpy.array(self._vals, dtype=object)
+            mask = numpy.array([v is None for v in self._vals], dtype=bool)
+        else:
+            data = self._vals._numpy_data()
+            mask = self._vals._numpy_mask()
+        if mask.any():
+            return numpy.ma.masked_array(data, mask=mask)
+        return data
+
+    def _copy(self):
+        # undecoded values stay undecoded; the raw rows are never changed
+        column = copy(self)
+        column._values = self._values.copy()
+        return column
+
+#######################################################################
+# Statement digests
+#######################################################################
+
+DIGEST_MD5 = "md5"
+DIGEST_BLAKE2B = "blake2b"
+
+_digests = {
+    DIGEST_MD5: hashlib.md5,
+    DIGEST_BLAKE2B: lambda b: hashlib.blake2b(b, digest_size=16)
+}
+
+_digest_name = DIGEST_MD5
+_digest = hashlib.md5
+
+def set_token_digest(name=DIGEST_MD5):
+    """
+    Selects the digest used for schema hashes and default tokens.
+    The default, "md5", is compatible with tokens generated by other
+    mPlane implementations; "blake2b" is faster, and yields tokens of
+    the same length, but which will not match those computed by peers
+    using MD5. Use it only where all parties agree on the digest.
+
+    """
+    global _digest_name
+    global _digest
+    if name not in _digests:
+        raise ValueError("Unknown token digest "+repr(name))
+    _digest_name = name
+    _digest = _digests[name]
+
+def token_digest():
+    """Returns the name of the digest used for schema hashes and tokens."""
+    return _digest_name
+
+_COW_FIELDS = ("_params", "_metadata", "_resultcolumns")
 
 class Statement(object):
     """
@@ -2092,6 +2610,9 @@ class Statement(object):
     def __init__(self, dictval=None, verb=VERB_MEASURE, label=None, token=None, when=None, reguri=None):
         super().__init__()
         # Make a blank statement
+        self._hashes = {}
+        # names of element dicts shared with another statement
+        self._cow = set()
         self._version = MPLANE_VERSION
         self._params = collections.OrderedDict()
         self._metadata = collections.OrderedDict()
@@ -2105,6 +2626,7 @@ class Statement(object):
         if dictval is not None:
             # Fill in from dictionary
             self._from_dict(dictval)
+            self._invalidate_hashes()
         else:
             # Fill in from defaults
             self._verb = verb
@@ -2122,6 +2644,47 @@ class Statement(object):
                     self._reguri = uri
                     break
 
+    def __copy__(self):
+        """
+        Returns a shallow copy of this statement, which shares its
+        parameters, metadata and result columns with this one until
+        either of them changes them.
+
+        """
+        other = self.__class__.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        other._hashes = {}
+        other._share_from(self)
+        return other
+
+    def _share_from(self, statement):
+        """
+        Takes over the parameters, metadata and result columns of
+        another statement. The element dicts are shared, not copied:
+        the first statement to change one copies it (and its elements)
+        for itself, see _writable().
+
+        """
+        self._params = statement._params
+        self._metadata = statement._metadata
+        self._resultcolumns = statement._resultcolumns
+        self._cow = set(_COW_FIELDS)
+        statement._cow.update(_COW_FIELDS)
+
+    def _writable(self, field):
+        """
+        Returns the named element dict of this statement (one of
+        _params, _metadata or _resultcolumns) for changing, first
+        copying it if it is shared with another statement.
+
+        """
+        d = getattr(self, field)
+        if field in self._cow:
+            d = collections.OrderedDict((k, e._copy()) for (k, e) in d.items())
+            setattr(self, field, d)
+            self._cow.discard(field)
+        return d
+
     def __repr__(self):
         return "<"+self.kind_str()+": "+self._verb+self._label_repr()+\
                " when "+str(self._when)+\
@@ -2153,9 +2716,10 @@ class Statement(object):
 
     def add_parameter(self, elem_name, constraint=constraint_all, val=None):
         """Programatically adds a parameter to this Statement."""
-        self._params[elem_name] = Parameter(element(elem_name, reguri=self._reguri),
+        self._writable("_params")[elem_name] = Parameter(element(elem_name, reguri=self._reguri),
                                             constraint=constraint,
                                             val = val)
+        self._invalidate_hashes()
 
     def has_parameter(self, elem_name):
         """Returns True if the statement has a parameter with the given name."""
@@ -2191,8 +2755,9 @@ class Statement(object):
 
     def set_parameter_value(self, elem_name, value):
         """Programatically sets a value for a parameter on this Statement."""
-        elem = self._params[elem_name]
+        elem = self._writable("_params")[elem_name]
         elem.set_value(value)
+        self._invalidate_hashes()
 
     def can_set_parameter_value(self, elem_name, value):
         """Determines whether a given Parameter can take a value."""
@@ -2208,7 +2773,8 @@ class Statement(object):
 
     def add_metadata(self, elem_name, val):
         """Programatically adds a metadata element to this Statement."""
-        self._metadata[elem_name] = Metavalue(element(elem_name, reguri=self._reguri), val)
+        self._writable("_metadata")[elem_name] = Metavalue(element(elem_name, reguri=self._reguri), val)
+        self._invalidate_hashes()
 
     def has_metadata(self, elem_name):
         """Returns True if the statement has a metadata element with the given name."""
@@ -2224,7 +2790,8 @@ class Statement(object):
 
     def add_result_column(self, elem_name):
         """Programatically adds a result column to this Statement."""
-        self._resultcolumns[elem_name] = ResultColumn(element(elem_name, reguri=self._reguri))
+        self._writable("_resultcolumns")[elem_name] = ResultColumn(element(elem_name, reguri=self._reguri))
+        self._invalidate_hashes()
 
     def has_result_column(self, elem_name):
         """Returns True if the statement has results column with the given name."""
@@ -2264,6 +2831,7 @@ class Statement(object):
     def set_export(self, export):
         """Sets the Statement's export URL."""
         self._export = export
+        self._invalidate_hashes()
 
     def get_label(self):
         """Returns the Statement's label."""
@@ -2292,6 +2860,34 @@ class Statement(object):
             raise ValueError("Cannot set temporal scope "+str(when)+
                              " within "+str(self._when))
         self._when = when
+        self._invalidate_hashes()
+
+    def _invalidate_hashes(self):
+        """
+        Forgets the cached digests of this statement. Called by the
+        mutators; code changing _params, _metadata, _resultcolumns or
+        _when directly must call it as well.
+
+        """
+        self._hashes.clear()
+
+    def _cached_hash(self, kind, astr, build):
+        """
+        Returns the digest of build() for the given kind of hash, cached
+        per digest algorithm. Hashes salted with an additional string are
+        computed every time: their strings are open-ended, and caching
+        them would grow the cache for as long as the statement lives.
+
+        """
+        if astr:
+            return _digest(build().encode('utf-8')).hexdigest()
+        key = (kind, _digest_name)
+        try:
+            return self._hashes[key]
+        except KeyError:
+            hstr = _digest(build().encode('utf-8')).hexdigest()
+            self._hashes[key] = hstr
+            return hstr
 
     def _schema_hash(self, lim=None):
         """
@@ -2299,10 +2895,11 @@ class Statement(object):
         and result columns (the schema) of this statement.
 
         """
-        sstr = self._reguri + \
-               " p " + " ".join(sorted(self._params.keys())) + \
-               " r " + " ".join(sorted(self._resultcolumns.keys()))
-        hstr = hashlib.md5(sstr.encode('utf-8')).hexdigest()
+        def build():
+            return self._reguri + \
+                   " p " + " ".join(sorted(self._params.keys())) + \
+                   " r " + " ".join(sorted(self._resultcolumns.keys()))
+        hstr = self._cached_hash("s", None, build)
         if lim is not None:
             return hstr[:lim]
         else:
@@ -2315,15 +2912,17 @@ class Statement(object):
         of this statement. Used as a specification key.
 
         """
-        spk = sorted(self._params.keys())
-        spv = [self._params[k].unparse(self._params[k].get_value()) for k in spk]
-        tstr = self._reguri + self._verb + " w " + str(self._when) +\
-               " pk " + " ".join(spk) + \
-               " pv " + " ".join(spv) + \
-               " r " + " ".join(sorted(self._resultcolumns.keys()))
-        if astr:
-            tstr += astr
-        hstr = hashlib.md5(tstr.encode('utf-8')).hexdigest()
+        def build():
+            spk = sorted(self._params.keys())
+            spv = [self._params[k].unparse(self._params[k].get_value()) for k in spk]
+            tstr = self._reguri + self._verb + " w " + str(self._when) +\
+                   " pk " + " ".join(spk) + \
+                   " pv " + " ".join(spv) + \
+                   " r " + " ".join(sorted(self._resultcolumns.keys()))
+            if astr:
+                tstr += astr
+            return tstr
+        hstr = self._cached_hash("pv", astr, build)
         if lim is not None:
             return hstr[:lim]
         else:
@@ -2337,21 +2936,23 @@ class Statement(object):
         Used as a complete token for statements.
 
         """
-        spk = sorted(self._params.keys())
-        spc = [str(self._params[k]._constraint) for k in spk]
-        spv = [self._params[k].unparse(self._params[k].get_value()) for k in spk]
-        smk = sorted(self._metadata.keys())
-        smv = [self._metadata[k].unparse(self._metadata[k].get_value()) for k in smk]
-        tstr = self._reguri + self._verb + \
-               " w " + str(self._when) + \
-               " pk " + " ".join(spk) + \
-               " pc " + " ".join(spc) + " pv " + " ".join(spv) + \
-               " mk " + " ".join(smk) + " mv " + " ".join(smv) + \
-               " r " + " ".join(sorted(self._resultcolumns.keys())) + \
-               " ex " + str(self._export)
-        if astr:
-            tstr += astr
-        hstr = hashlib.md5(tstr.encode('utf-8')).hexdigest()
+        def build():
+            spk = sorted(self._params.keys())
+            spc = [str(self._params[k]._constraint) for k in spk]
+            spv = [self._params[k].unparse(self._params[k].get_value()) for k in spk]
+            smk = sorted(self._metadata.keys())
+            smv = [self._metadata[k].unparse(self._metadata[k].get_value()) for k in smk]
+            tstr = self._reguri + self._verb + \
+                   " w " + str(self._when) + \
+                   " pk " + " ".join(spk) + \
+                   " pc " + " ".join(spc) + " pv " + " ".join(spv) + \
+                   " mk " + " ".join(smk) + " mv " + " ".join(smv) + \
+                   " r " + " ".join(sorted(self._resultcolumns.keys())) + \
+                   " ex " + str(self._export)
+            if astr:
+                tstr += astr
+            return tstr
+        hstr = self._cached_hash("mpcv", astr, build)
         if lim is not None:
             return hstr[:lim]
         else:
@@ -2376,18 +2977,44 @@ class Statement(object):
     def _default_token(self):
       return self._mpcv_hash()
 
+    def _iter_result_rows(self):
+        """
+        Yields result rows as lists of strings, unparsing a batch of
+        rows of each column at a time.
+
+        """
+        count = self.count_result_rows()
+        columns = list(self._resultcolumns.values())
+        for start in range(0, count, RESULT_ROW_BATCH):
+            stop = min(start + RESULT_ROW_BATCH, count)
+            cells = []
+            for col in columns:
+                unparse = col._prim.unparse
+                strs = [unparse(val) for val in col[start:stop]]
+                strs.extend([VALUE_NONE] * (stop - start - len(strs)))
+                cells.append(strs)
+            yield from map(list, zip(*cells))
+
     def _result_rows(self):
-        rows = []
-        for row_index in range(self.count_result_rows()):
-            row = []
-            rows.append(row)
-            for col in self._resultcolumns.values():
-                try:
-                    valstr = col._prim.unparse(col[row_index])
-                except IndexError:
-                    valstr = VALUE_NONE
-                row.append(valstr)
-        return rows
+        return list(self._iter_result_rows())
+
+    def _native_result_rows(self):
+        """
+        Returns result rows as lists of values for binary encodings,
+        as converted by each column's primitive.
+
+        """
+        count = self.count_result_rows()
+        cells = []
+        for col in self._resultcolumns.values():
+            to_native = col._prim.to_native
+            if type(col._prim).to_native is _Primitive.to_native:
+                vals = list(col)
+            else:
+                vals = [to_native(val) for val in col]
+            vals.extend([None] * (count - len(vals)))
+            cells.append(vals)
+        return list(map(list, zip(*cells)))
 
     def to_dict(self, token_only=False):
         """
@@ -2396,6 +3023,10 @@ class Statement(object):
         argument of the appropriate statement constructor.
 
         """
+        return self._to_dict(self._result_rows)
+
+    def _to_dict(self, result_rows):
+        # result_rows builds the value of the resultvalues key
         self.validate()
         d = collections.OrderedDict()
         d[self.kind_str()] = self._verb
@@ -2429,7 +3060,7 @@ class Statement(object):
         if self.count_result_columns() > 0:
             d[KEY_RESULTS] = [k for k in self._resultcolumns.keys()]
             if self.count_result_rows() > 0:
-                d[KEY_RESULTVALUES] = self._result_rows()
+                d[KEY_RESULTVALUES] = result_rows()
 
         return d
 
@@ -2488,9 +3119,54 @@ class Statement(object):
                 self.add_result_column(v)
 
     def _clear_constraints(self):
-        for param in self._params.values():
+        for param in self._writable("_params").values():
             param._clear_constraint()
 
+    def __getstate__(self):
+        """
+        Returns a compact picklable state for this Statement, used to
+        pass statements between processes (see
+        :class:`mplane.scheduler.JobExecutor`). Elements are reduced to
+        their names and looked up again in the registry on unpickling,
+        so the registry must be available on the other side.
+
+        """
+        state = self.__dict__.copy()
+        state["_hashes"] = {}
+        state["_cow"] = set()
+        state.pop("_raw_rows", None)
+        state["_params"] = tuple((p._name, str(p._constraint), p._val)
+                                 for p in self._params.values())
+        state["_metadata"] = tuple((m._name, m._val)
+                                   for m in self._metadata.values())
+        state["_resultcolumns"] = tuple((c._name, c._vals)
+                                        for c in self._resultcolumns.values())
+        if state.get("_when") is not None:
+            state["_when"] = str(self._when)
+        return state
+
+    def __setstate__(self, state):
+        params = state.pop("_params")
+        metadata = state.pop("_metadata")
+        columns = state.pop("_resultcolumns")
+        self.__dict__.update(state)
+        if isinstance(self.__dict__.get("_when"), str):
+            self._when = When(self._when)
+
+        reguri = self.__dict__.get("_reguri")
+        self._params = collections.OrderedDict()
+        for (name, constraint, val) in params:
+            self._params[name] = Parameter(element(name, reguri=reguri),
+                                           constraint=constraint, val=val)
+        self._metadata = collections.OrderedDict()
+        for (name, val) in metadata:
+            self._metadata[name] = Metavalue(element(name, reguri=reguri), val)
+        self._resultcolumns = collections.OrderedDict()
+        for (name, vals) in columns:
+            column = ResultColumn(element(name, reguri=reguri))
+            column._vals = vals
+            self._resultcolumns[name] = column
+
 class Capability(Statement):
     """
     A Capability represents something an mPlane component can do.
@@ -2567,9 +3243,7 @@ class Specification(Statement):
             # Build a statement from a capabilitiy
             self._verb = capability._verb
             self._label = capability._label
-            self._metadata = capability._metadata
-            self._params = deepcopy(capability._params)
-            self._resultcolumns = deepcopy(capability._resultcolumns)
+            self._share_from(capability)
             self._reguri = capability._reguri
 
             # inherit from capability only when necessary
@@ -2577,8 +3251,9 @@ class Specification(Statement):
                 self._when = capability._when
 
             # now set values we know we can
-            for param in self._params.values():
+            for param in self._writable("_params").values():
                 param.set_single_value()
+            self._invalidate_hashes()
 
     def _more_repr(self):
         return " p(v)/m/r "+str(self.count_parameters())+"("+\
@@ -2636,11 +3311,10 @@ class Specification(Statement):
         relative temporal scope and schedule.
         """
         if self._when.is_repeated():
-            subspec = deepcopy(self)  # Brian does not like that but he said it is okay
-
-            iter = self._when.iterator()
-            while 1:
-                subspec._when = next(iter)
+            # each subspec is a copy sharing this specification's elements
+            for when in self._when.iterator():
+                subspec = copy(self)
+                subspec._when = when
                 subspec.retoken(True)
                 yield subspec
         else:
@@ -2654,14 +3328,15 @@ class Result(Statement):
 
     Note, tits token is generally inherited from the respective specification.
     """
+    # rows as received by _from_dict(), until a column is modified
+    _raw_rows = None
+
     def __init__(self, dictval=None, specification=None, verb=VERB_MEASURE, label=None, token=None, when=None):
         super().__init__(dictval=dictval, verb=verb, label=label, token=token, when=when)
         if dictval is None and specification is not None:
             self._verb = specification._verb
             self._label = specification._label
-            self._metadata = specification._metadata
-            self._params = deepcopy(specification._params)
-            self._resultcolumns = deepcopy(specification._resultcolumns)
+            self._share_from(specification)
             # assign token from specification
             self._token = specification.get_token()
             # allow parameters to take values other than constrained
@@ -2669,6 +3344,7 @@ class Result(Statement):
             # inherit from specification only when necessary
             if when is not None:
                 self._when = specification._when
+            self._invalidate_hashes()
 
 
     def _more_repr(self):
@@ -2703,18 +3379,81 @@ class Result(Statement):
         """
         super()._from_dict(d)
 
-        column_key = list(self._resultcolumns.keys())
-
         if KEY_RESULTVALUES in d:
-            for i, row in enumerate(d[KEY_RESULTVALUES]):
-                for j, val in enumerate(row):
-                    self._resultcolumns[column_key[j]][i] = val
+            # decode each column on first access
+            rows = d[KEY_RESULTVALUES]
+            self._raw_rows = rows
+            columns = self._writable("_resultcolumns").values()
+            for (j, column) in enumerate(columns):
+                column._set_raw(rows, j)
+
+    def _passthrough(self):
+        return self._raw_rows is not None and \
+           all(column._pristine for column in self._resultcolumns.values())
+
+    def _result_rows(self):
+        # an unchanged parsed result is serialized as it was received
+        if self._passthrough():
+            return self._raw_rows
+        return super()._result_rows()
+
+    def _iter_result_rows(self):
+        if self._passthrough():
+            return iter(self._raw_rows)
+        return super()._iter_result_rows()
 
     def set_result_value(self, elem_name, val, row_index=0):
         """
         Sets a single result value.
         """
-        self._resultcolumns[elem_name][row_index] = val
+        self._writable("_resultcolumns")[elem_name][row_index] = val
+
+    def _columns_for(self, names):
+        columns = self._writable("_resultcolumns")
+        try:
+            return [columns[name] for name in names]
+        except KeyError as e:
+            raise ValueError(repr(self)+" has no result column "+str(e))
+
+    def append_rows(self, rows, columns=None):
+        """
+        Appends rows of result values after the last row of this Result.
+        Each row is a sequence of values, in the order of the given result
+        column names (by default, all result columns in schema order);
+        columns not given are left null in the new rows. Much faster than
+        calling set_result_value() for each value.
+
+        """
+        if columns is None:
+            columns = list(self._resultcolumns.keys())
+        targets = self._columns_for(columns)
+
+        rows = list(rows)
+        if set(map(len, rows)) - {len(targets)}:
+            raise ValueError("rows must have "+str(len(targets))+" values")
+
+        start = self.count_result_rows()
+        for (i, column) in enumerate(targets):
+            column.extend(map(operator.itemgetter(i), rows), start)
+
+    def extend_column(self, elem_name, values):
+        """
+        Appends values to a single result column, after its last value.
+
+        """
+        self._columns_for([elem_name])[0].extend(values)
+
+    def result_column_values(self, elem_name):
+        """
+        Returns the values of a single result column as a list, padded
+        with None to the number of result rows.
+
+        """
+        if elem_name not in self._resultcolumns:
+            raise ValueError(repr(self)+" has no result column "+elem_name)
+        values = list(self._resultcolumns[elem_name])
+        values.extend([None] * (self.count_result_rows() - len(values)))
+        return values
 
     def schema_dict_iterator(self):
         """
@@ -2815,10 +3554,9 @@ class _StatementNotification(Statement):
             self._label = statement._label
             self._verb = statement._verb
             self._when = statement._when
-            self._metadata = statement._metadata
-            self._params = deepcopy(statement._params)
-            self._resultcolumns = deepcopy(statement._resultcolumns)
+            self._share_from(statement)
             self._token = statement.get_token()
+            self._invalidate_hashes()
 
     def __repr__(self):
         return "<"+self.kind_str()+": "+self._label_repr()+self.get_token()+">"
@@ -2844,11 +3582,39 @@ class Receipt(_StatementNotification):
     result will not be available in a reasonable amount of time; or to confirm
     a Specification """
     def __init__(self, dictval=None, specification=None, token=None):
+        self._queue_position = None
         super().__init__(dictval=dictval, statement=specification, token=token)
 
     def kind_str(self):
         return KIND_RECEIPT
 
+    def get_queue_position(self):
+        """
+        Returns the position of the receipted job in the component's
+        run queue (1 for the next job to run), or None if the job is
+        not waiting to be run.
+
+        """
+        return self._queue_position
+
+    def set_queue_position(self, position):
+        """Sets the run queue position; None or 0 clears it."""
+        if position:
+            self._queue_position = int(position)
+        else:
+            self._queue_position = None
+
+    def to_dict(self, token_only=False):
+        d = super().to_dict(token_only)
+        if self._queue_position is not None:
+            d[KEY_QUEUE_POSITION] = self._queue_position
+        return d
+
+    def _from_dict(self, d):
+        super()._from_dict(d)
+        if KEY_QUEUE_POSITION in d:
+            self.set_queue_position(d[KEY_QUEUE_POSITION])
+
     def validate(self):
         """
         Checks that this is a valid Receipt; performes the same checks as for a Specification.
@@ -2961,11 +3727,15 @@ class Envelope(object):
         return KIND_ENVELOPE
 
     def to_dict(self, token_only=False):
+        return self._to_dict([m.to_dict(token_only=token_only)
+                              for m in self.messages()])
+
+    def _to_dict(self, contents):
         d = {}
         d[self.kind_str()] = self._content_type
         d[KEY_VERSION] = self._version
 
-        d[KEY_CONTENTS] = [m.to_dict(token_only=token_only) for m in self.messages()]
+        d[KEY_CONTENTS] = contents
 
         if self._token is not None:
             d[KEY_TOKEN] = self._token
@@ -3047,16 +3817,304 @@ def parse_json(jstr):
     """
     return message_from_dict(json.loads(jstr))
 
-def unparse_json(msg, token_only=False):
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class MessageParser(object):
+    """
+    Incremental parser for an mPlane message in JSON. Pass the message
+    to feed() as bytes, in chunks as they arrive, and call close() to
+    get the message.
+
+    Statements are built from their headers as they complete; the
+    values of a Result are decoded straight into its columns, a batch
+    of rows at a time, so a large Result (or an Envelope of them) never
+    exists as a whole dictionary or string. Rows are only streamed when
+    the registry and results keys precede the resultvalues key, as they
+    do in JSON written by :func:`unparse_json`; otherwise the Result is
+    built from its dictionary as by :func:`parse_json`.
+
+    """
+    def __init__(self):
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        # unparsed characters needed before parsing is resumed
+        self._wait = 0
+        self._closed = False
+        self._msg = None
+        self._parse = self._message()
+        next(self._parse)
+
+    def feed(self, data):
+        """Parses the next chunk of bytes of the message."""
+        self._buf = self._buf[self._pos:] + self._text.decode(data)
+        self._pos = 0
+        self._resume()
+
+    def close(self):
+        """Parses the end of the message, and returns the message."""
+        self._buf = self._buf[self._pos:] + \
+                    self._text.decode(b"", final=True)
+        self._pos = 0
+        self._closed = True
+        self._resume()
+        if self._parse is not None or \
+           _WHITESPACE.match(self._buf, self._pos).end() < len(self._buf):
+            raise ValueError("Malformed mPlane message")
+        return self._msg
+
+    def _resume(self):
+        if self._parse is None or \
+           (len(self._buf) - self._pos < self._wait and not self._closed):
+            return
+        try:
+            self._parse.send(None)
+        except StopIteration as stop:
+            self._msg = stop.value
+            self._parse = None
+
+    def _skip(self):
+        # skips whitespace, returns the next character
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if self._closed:
+                raise ValueError("Truncated mPlane message")
+            self._wait = 1
+            yield
+
+    def _expect(self, chars):
+        char = yield from self._skip()
+        if char not in chars:
+            raise ValueError("Unexpected "+repr(char)+" in mPlane message")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        # decodes a JSON value ending before the end of the buffer; a
+        # value at the end may be a truncated number
+        while True:
+            yield from self._skip()
+            try:
+                (val, end) = self._json.raw_decode(self._buf, self._pos)
+                if end < len(self._buf) or self._closed:
+                    self._pos = end
+                    return val
+            except ValueError:
+                if self._closed:
+                    raise
+            # wait for the unparsed text to double, to parse in linear time
+            self._wait = 2 * (len(self._buf) - self._pos)
+            yield
+
+    def _message(self):
+        yield from self._expect("{")
+        d = {}
+        result = None
+        contents = None
+        if (yield from self._skip()) == "}":
+            self._pos += 1
+        else:
+            while True:
+                key = yield from self._value()
+                yield from self._expect(":")
+                if key == KEY_CONTENTS:
+                    contents = yield from self._contents()
+                elif key == KEY_RESULTVALUES and KIND_RESULT in d and \
+                     KEY_REGISTRY in d and KEY_RESULTS in d:
+                    result = Result(dictval={KIND_RESULT: d[KIND_RESULT],
+                                             KEY_REGISTRY: d[KEY_REGISTRY],
+                                             KEY_RESULTS: d[KEY_RESULTS]})
+                    yield from self._rows(result)
+                else:
+                    d[key] = yield from self._value()
+                if (yield from self._expect(",}")) == "}":
+                    break
+
+        if contents is not None:
+            d[KEY_CONTENTS] = []
+        msg = message_from_dict(d)
+        if contents is not None:
+            for content in contents:
+                msg.append_message(content)
+        if result is not None:
+            msg._writable("_resultcolumns").update(result._resultcolumns)
+        return msg
+
+    def _contents(self):
+        yield from self._expect("[")
+        contents = []
+        if (yield from self._skip()) == "]":
+            self._pos += 1
+            return contents
+        while True:
+            contents.append((yield from self._message()))
+            if (yield from self._expect(",]")) == "]":
+                return contents
+
+    def _rows(self, result):
+        yield from self._expect("[")
+        if (yield from self._skip()) == "]":
+            self._pos += 1
+            return
+        rows = []
+        while True:
+            rows.append((yield from self._value()))
+            if (yield from self._expect(",]")) == "]":
+                break
+            if len(rows) >= RESULT_ROW_BATCH:
+                self._append_rows(result, rows)
+                rows = []
+        self._append_rows(result, rows)
+
+    def _append_rows(self, result, rows):
+        # short rows leave the missing values null
+        width = result.count_result_columns()
+        if any(len(row) < width for row in rows):
+            rows = [row + [VALUE_NONE] * (width - len(row)) for row in rows]
+        result.append_rows(rows)
+
+def parse_json_stream(chunks):
+    """
+    Parse an mPlane message in JSON from an iterable of chunks of bytes
+    (e.g. a streamed HTTP response) using a :class:`MessageParser`.
+
+    """
+    parser = MessageParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+def unparse_json(msg, token_only=False, compact=False):
     """
     Transform an mPlane message into a JSON object representing it. If
     token_only is True, uses tokens only for message types for which that is
     appropriate (i.e. Reciepts, Redemptions, Withdrawals, and Interrupts).
 
+    By default the JSON is indented, with keys sorted, for readability.
+    If compact is True, it is written without whitespace, with keys in
+    the order the message lists them, for smaller and faster messages
+    on the wire; either form is parsed by :func:`parse_json`.
+
     """
+    if compact:
+        return json.dumps(msg.to_dict(token_only=token_only),
+                          separators=(',',':'))
     return json.dumps(msg.to_dict(token_only=token_only),
                       sort_keys=True, indent=2, separators=(',',': '))
 
+def _stream_dict(msg, token_only, native=False):
+    # as msg.to_dict(), with generators in place of result rows,
+    # or with native result values
+    if isinstance(msg, Envelope):
+        return msg._to_dict([_stream_dict(m, token_only, native)
+                             for m in msg.messages()])
+    elif isinstance(msg, Statement) and \
+         type(msg).to_dict is Statement.to_dict:
+        if native:
+            return msg._to_dict(msg._native_result_rows)
+        return msg._to_dict(msg._iter_result_rows)
+    else:
+        return msg.to_dict(token_only=token_only)
+
+def _iter_json(obj, depth, compact):
+    # yields the pieces of obj as encoded by unparse_json()
+    if compact:
+        (pad, inner, colon) = ("", "", ":")
+    else:
+        pad = "\n" + "  " * depth
+        (inner, colon) = (pad + "  ", ": ")
+    if isinstance(obj, dict) and obj:
+        sep = "{"
+        for key in (obj if compact else sorted(obj)):
+            yield sep + inner + json.dumps(key) + colon
+            yield from _iter_json(obj[key], depth + 1, compact)
+            sep = ","
+        yield pad + "}"
+    elif isinstance(obj, list) and \
+         any(isinstance(item, (dict, collections.abc.Iterator)) for item in obj):
+        sep = "["
+        for item in obj:
+            yield sep + inner
+            yield from _iter_json(item, depth + 1, compact)
+            sep = ","
+        yield pad + "]"
+    elif isinstance(obj, collections.abc.Iterator):
+        # encoded a batch of rows at a time, without the batch's brackets
+        sep = "["
+        while True:
+            batch = list(itertools.islice(obj, RESULT_ROW_BATCH))
+            if not batch:
+                break
+            if compact:
+                text = json.dumps(batch, separators=(',',':'))
+            else:
+                text = json.dumps(batch, sort_keys=True, indent=2,
+                                  separators=(',',': ')).replace("\n", pad)
+            yield sep + text[1:-1-len(pad)]
+            sep = ","
+        yield "[]" if sep == "[" else pad + "]"
+    elif compact:
+        yield json.dumps(obj, separators=(',',':'))
+    else:
+        yield json.dumps(obj, sort_keys=True, indent=2,
+                         separators=(',',': ')).replace("\n", pad)
+
+def iter_unparse_json(msg, token_only=False, compact=False,
+                      chunk_size=JSON_CHUNK_SIZE):
+    """
+    Transform an mPlane message into a JSON object representing it, as
+    :func:`unparse_json`, yielding the JSON text in chunks of about
+    chunk_size characters, or of RESULT_ROW_BATCH result rows if longer.
+    Result rows are unparsed as they are written, so the whole text of
+    a large Result is never held in memory.
+
+    """
+    chunk = []
+    length = 0
+    for piece in _iter_json(_stream_dict(msg, token_only), 0, compact):
+        chunk.append(piece)
+        length += len(piece)
+        if length >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield "".join(chunk)
+
+def parse_cbor(data):
+    """
+    Parse an mPlane message in CBOR from bytes, as written by
+    :func:`unparse_cbor`, and return the message.
+
+    """
+    msg = message_from_dict(mplane.cbor.loads(data))
+    # the rows hold native values, so are never passed through to JSON
+    for result in _results_in(msg):
+        result._raw_rows = None
+    return msg
+
+def unparse_cbor(msg, token_only=False):
+    """
+    Transform an mPlane message into CBOR bytes representing it; see
+    :mod:`mplane.cbor`. The message is encoded as the dictionary
+    written by :func:`unparse_json`, except that result values are
+    native values of their primitive: naturals, reals and booleans as
+    CBOR numbers and booleans, times as epoch timestamps, addresses as
+    4 or 16 byte strings, and missing values as null.
+
+    """
+    return mplane.cbor.dumps(_stream_dict(msg, token_only, native=True))
+
+def _results_in(msg):
+    if isinstance(msg, Envelope):
+        for content in msg.messages():
+            yield from _results_in(content)
+    elif isinstance(msg, Result):
+        yield msg
+
 def parse_yaml(ystr):
     return mplane.model.message_from_dict(yaml.load(ystr))
 
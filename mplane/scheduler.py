@@ -30,9 +30,155 @@ results within the mPlane reference component.
 
 from datetime import datetime
 import threading
+import asyncio
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import multiprocessing
+import time
 import mplane.model
 import mplane.azn
 
+class TimerDispatcher(object):
+    """
+    A TimerDispatcher fires delayed calls (job starts, interrupts and
+    MultiJob sub-job scheduling) from a single thread driven by a
+    priority queue of deadlines, so that the number of threads used
+    for timing stays constant no matter how many jobs are scheduled.
+
+    Callbacks run on the dispatcher thread, and should therefore
+    return quickly; long-running work should be handed off to
+    another thread.
+
+    """
+    def __init__(self):
+        super(TimerDispatcher, self).__init__()
+        self._heap = []
+        self._cancelled = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def schedule(self, delay, fn, *args):
+        """
+        Call fn(*args) on the dispatcher thread after delay seconds.
+        Returns an entry which can be passed to cancel().
+
+        """
+        entry = [time.monotonic() + max(delay, 0), next(self._seq), fn, args]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch,
+                                                name="mplane-timer")
+                self._thread.daemon = True
+                self._thread.start()
+            # wake the dispatcher if the new entry is the earliest
+            if self._heap[0] is entry:
+                self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        """Cancel a call previously returned by schedule()."""
+        with self._cond:
+            if entry[2] is None:
+                # already fired or cancelled
+                return
+            entry[2] = None
+            self._cancelled += 1
+            # drop cancelled entries once they outnumber the live ones
+            if self._cancelled * 2 > len(self._heap):
+                self._heap = [e for e in self._heap if e[2] is not None]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+                self._cond.notify()
+
+    def pending(self):
+        """Returns the number of calls waiting to be fired."""
+        with self._cond:
+            return len(self._heap) - self._cancelled
+
+    def stop(self):
+        """Stop the dispatcher thread, dropping all pending calls."""
+        with self._cond:
+            self._stopped = True
+            self._heap.clear()
+            self._cancelled = 0
+            self._cond.notify()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                if self._stopped:
+                    return
+                entry = heapq.heappop(self._heap)
+                (deadline, seq, fn, args) = entry
+                if fn is None:
+                    self._cancelled -= 1
+                    continue
+                # mark it fired, so cancelling it has no effect
+                entry[2] = None
+            try:
+                fn(*args)
+            except Exception as e:
+                print("Exception in timer callback "+repr(fn)+": "+str(e))
+
+_default_dispatcher = None
+_default_executor = None
+_default_lock = threading.Lock()
+
+def default_dispatcher():
+    """
+    Returns the dispatcher used by Jobs and MultiJobs which are
+    not bound to a Scheduler.
+
+    """
+    global _default_dispatcher
+    with _default_lock:
+        if _default_dispatcher is None:
+            _default_dispatcher = TimerDispatcher()
+        return _default_dispatcher
+
+def default_executor():
+    """
+    Returns the executor used by Jobs which are not bound to a Scheduler.
+
+    """
+    global _default_executor
+    with _default_lock:
+        if _default_executor is None:
+            _default_executor = JobExecutor()
+        return _default_executor
+
+DEFAULT_POOL_SIZE = 16
+
+# interrupt flags shared with the worker processes, one per slot
+_process_interrupt_flags = None
+
+def _init_process(registries, base_registry, token_digest, interrupt_flags):
+    # runs once in each worker process started by a JobExecutor
+    global _process_interrupt_flags
+    mplane.model._registries.update(registries)
+    mplane.model._base_registry = base_registry
+    mplane.model.set_token_digest(token_digest)
+    _process_interrupt_flags = interrupt_flags
+
+def _run_in_process(service, specification, slot):
+    # runs in a worker process; the service, specification and
+    # returned result cross the process boundary pickled
+    return service.run(specification,
+                       lambda: _process_interrupt_flags[slot] != 0)
+
 class Service(object):
     """
     A Service binds some runnable code to an 
@@ -43,6 +189,9 @@ class Service(object):
     and implement run().
 
     """
+    _max_concurrency = None
+    _run_in_process = False
+
     def __init__(self, capability):
         super(Service, self).__init__()
         self._capability = capability
@@ -62,11 +211,21 @@ class Service(object):
         should stop; if this function returns True, the implementation should 
         terminate its processing in an orderly fashion and return its results.
 
-        Each method will be called within its own thread and/or process. 
+        Each call is made on one of the scheduler's worker threads,
+        or in a worker process if run_in_process() is True.
 
         """
         raise NotImplementedError("Cannot instantiate an abstract Service")
 
+    def partial_reply(self, specification):
+        """
+        Returns the results gathered so far by a running job for the
+        given specification, to reply with instead of a receipt, or
+        None (the default) if the service has none to give.
+
+        """
+        return None
+
     def capability(self):
         """Returns the capability belonging to this service"""
         return self._capability
@@ -75,11 +234,319 @@ class Service(object):
         """Sets the link section in the capability schema"""
         self._capability.set_link(link)
 
+    def max_concurrency(self):
+        """
+        Returns the maximum number of jobs for this service which may
+        run at the same time, or None if the service is only limited
+        by the size of the scheduler's worker pool.
+
+        """
+        return self._max_concurrency
+
+    def set_max_concurrency(self, limit):
+        """
+        Limits the number of jobs for this service which may run at
+        the same time; further jobs wait in the scheduler's queue.
+        None or 0 removes the limit.
+
+        """
+        if limit:
+            self._max_concurrency = int(limit)
+        else:
+            self._max_concurrency = None
+
+    def run_in_process(self):
+        """
+        Returns True if jobs for this service are run in a separate
+        worker process instead of a worker thread.
+
+        """
+        return self._run_in_process
+
+    def set_run_in_process(self, enable=True):
+        """
+        Run jobs for this service in the scheduler's process pool, so
+        that CPU-bound work does not hold the interpreter lock of the
+        component. The service object, specification and result are
+        pickled to cross the process boundary, so the service must
+        not hold unpicklable state (open files, sockets, locks), and
+        its class must be importable by module name.
+
+        """
+        self._run_in_process = bool(enable)
+
     def __repr__(self):
         return "<Service for "+repr(self._capability)+">"
 
+class AsyncService(Service):
+    """
+    An AsyncService is a Service whose run() is a coroutine, executed
+    on the scheduler's shared event loop instead of in a worker thread.
+    Use it for services which spend most of their time waiting on
+    I/O, such as subprocesses or sockets.
+
+    Thread-based Services and AsyncServices can be registered with the
+    same scheduler.
 
-class Job(object):
+    """
+    async def run(self, specification):
+        """
+        Run this service given a specification which matches the
+        capability, and return a mplane.model.Result derived therefrom.
+
+        There is no check_interrupt function: when the job is
+        interrupted, asyncio.CancelledError is raised inside the
+        coroutine at the point where it is waiting. The implementation
+        should catch it, stop its processing in an orderly fashion and
+        return the results it has gathered so far.
+
+        """
+        raise NotImplementedError("Cannot instantiate an abstract AsyncService")
+
+class JobExecutor(object):
+    """
+    A JobExecutor runs Jobs on a bounded pool of reused worker threads.
+
+    Jobs are run in the order they are submitted, except that a job is
+    skipped over (but keeps its place in the queue) while its service
+    is already running as many jobs as its max_concurrency() allows.
+
+    Jobs for an AsyncService do not use a worker thread; they are run
+    as tasks on an event loop, by default a private loop running in
+    its own thread, or the loop given to set_event_loop().
+
+    Jobs for a service with run_in_process() set are handed by their
+    worker thread to a pool of worker processes, started on first use
+    with process_pool_size processes (default: one per CPU).
+
+    """
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, process_pool_size=None):
+        super(JobExecutor, self).__init__()
+        self._pool_size = max(int(pool_size), 1)
+        self._queue = []
+        self._running = collections.Counter()
+        self._cond = threading.Condition()
+        self._workers = 0
+        self._idle = 0
+        self._loop = None
+        self._process_pool_size = process_pool_size
+        self._processes = None
+        self._process_slots = {}
+        self._free_slots = None
+        self._interrupt_flags = None
+
+    def set_event_loop(self, loop):
+        """
+        Run AsyncService jobs on the given asyncio event loop or
+        Tornado IOLoop. Must be called before the first such job
+        is submitted.
+
+        """
+        with self._cond:
+            self._loop = getattr(loop, "asyncio_loop", loop)
+
+    def _event_loop(self):
+        # called with self._cond held
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            loop_thread = threading.Thread(target=self._loop.run_forever,
+                                           name="mplane-async")
+            loop_thread.daemon = True
+            loop_thread.start()
+        return self._loop
+
+    def _process_pool(self):
+        # called with self._cond held
+        if self._processes is None:
+            # spawn rather than fork: this process is multithreaded
+            context = multiprocessing.get_context("spawn")
+            # at most one process job per worker thread at a time
+            self._interrupt_flags = context.RawArray('b', self._pool_size)
+            self._free_slots = list(range(self._pool_size))
+            self._processes = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self._process_pool_size,
+                    mp_context=context,
+                    initializer=_init_process,
+                    initargs=(mplane.model._registries,
+                              mplane.model._base_registry,
+                              mplane.model.token_digest(),
+                              self._interrupt_flags))
+        return self._processes
+
+    def run_in_process(self, job):
+        """
+        Run a job's service in a worker process, and return its
+        result. Blocks the calling worker thread until the job is done.
+
+        """
+        with self._cond:
+            pool = self._process_pool()
+            slot = self._free_slots.pop()
+            self._process_slots[job] = slot
+            self._interrupt_flags[slot] = 1 if job._check_interrupt() else 0
+        try:
+            future = pool.submit(_run_in_process, job.service,
+                                 job.specification, slot)
+            return future.result()
+        finally:
+            with self._cond:
+                del self._process_slots[job]
+                self._free_slots.append(slot)
+
+    def interrupt_process(self, job):
+        """Signals a job running in a worker process to stop."""
+        with self._cond:
+            slot = self._process_slots.get(job)
+            if slot is not None:
+                self._interrupt_flags[slot] = 1
+
+    def pool_size(self):
+        """Returns the maximum number of worker threads."""
+        return self._pool_size
+
+    def submit(self, job):
+        """Queue a job to be run by the next free worker."""
+        with self._cond:
+            self._queue.append(job)
+            if job.is_async():
+                self._start_async_jobs()
+            elif self._idle == 0 and self._workers < self._pool_size:
+                self._workers += 1
+                worker = threading.Thread(target=self._work,
+                                          name="mplane-worker-" +
+                                               str(self._workers))
+                worker.daemon = True
+                worker.start()
+            else:
+                self._cond.notify_all()
+
+    def queue_position(self, job):
+        """
+        Returns the 1-based position of a job in the queue,
+        or 0 if the job is not waiting to be run.
+
+        """
+        with self._cond:
+            try:
+                return self._queue.index(job) + 1
+            except ValueError:
+                return 0
+
+    def queue_length(self):
+        """Returns the number of jobs waiting to be run."""
+        with self._cond:
+            return len(self._queue)
+
+    def running(self, service=None):
+        """
+        Returns the number of jobs currently running, optionally
+        only those for a given service.
+
+        """
+        with self._cond:
+            if service is None:
+                return sum(self._running.values())
+            return self._running[service]
+
+    def _next_job(self, asynchronous=False):
+        for (i, job) in enumerate(self._queue):
+            if job.is_async() != asynchronous:
+                continue
+            limit = job.service.max_concurrency()
+            if limit is None or self._running[job.service] < limit:
+                del self._queue[i]
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                    job = self._next_job()
+                self._running[job.service] += 1
+            try:
+                job._run()
+            except Exception as e:
+                print("Exception in worker for "+repr(job)+": "+str(e))
+            finally:
+                with self._cond:
+                    self._running[job.service] -= 1
+                    if self._running[job.service] <= 0:
+                        del self._running[job.service]
+                    # a concurrency slot was freed; let workers rescan
+                    self._cond.notify_all()
+
+    def _start_async_jobs(self):
+        # called with self._cond held
+        job = self._next_job(asynchronous=True)
+        while job is not None:
+            self._running[job.service] += 1
+            self._event_loop().call_soon_threadsafe(self._start_task, job)
+            job = self._next_job(asynchronous=True)
+
+    def _start_task(self, job):
+        # called on the event loop thread
+        task = self._loop.create_task(job._run_async())
+        task.add_done_callback(lambda t: self._task_done(job, t))
+        job._set_task(self._loop, task)
+
+    def _task_done(self, job, task):
+        # called on the event loop thread
+        if task.cancelled():
+            # interrupted before the coroutine got to run
+            job._interrupted()
+        with self._cond:
+            self._running[job.service] -= 1
+            if self._running[job.service] <= 0:
+                del self._running[job.service]
+            self._start_async_jobs()
+
+
+class _Completion(object):
+    """
+    Keeps the callbacks to be called once a Job or MultiJob is done,
+    i.e. once it has its final result or exception.
+
+    """
+    def __init__(self):
+        super(_Completion, self).__init__()
+        self._done = False
+        self._done_callbacks = []
+        self._done_lock = threading.Lock()
+
+    def add_done_callback(self, fn):
+        """
+        Arrange for fn(job) to be called once this job is done; if it
+        already is, fn is called immediately. The callback runs on
+        whichever thread completes the job, so it should only hand off
+        work (e.g. with IOLoop.add_callback()) and return.
+
+        """
+        with self._done_lock:
+            if not self._done:
+                self._done_callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set_done(self):
+        with self._done_lock:
+            if self._done:
+                return
+            self._done = True
+            callbacks = self._done_callbacks
+            self._done_callbacks = []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                print("Exception in done callback for "+repr(self)+": "+str(e))
+
+
+class Job(_Completion):
     """
     A Job binds some running code to an mPlane.model.Specification 
     within a component. A Job can be thought of as a specific 
@@ -100,8 +567,11 @@ class Job(object):
     specification = None
     receipt = None
     _interrupt = None
+    _loop = None
+    _task = None
 
-    def __init__(self, service, specification, session=None, callback=None):
+    def __init__(self, service, specification, session=None, callback=None,
+                 dispatcher=None, executor=None):
         super(Job, self).__init__()
         self.service = service
         self.session = session
@@ -109,32 +579,79 @@ class Job(object):
         self.receipt = mplane.model.Receipt(specification=specification)
         self._interrupt = threading.Event()
         self._callback = callback
+        if dispatcher is None:
+            dispatcher = default_dispatcher()
+        self._dispatcher = dispatcher
+        if executor is None:
+            executor = default_executor()
+        self._executor = executor
 
     def __repr__(self):
         return "<Job for "+repr(self.specification)+">"
 
+    def is_async(self):
+        """Returns True if this job's service is an AsyncService."""
+        return isinstance(self.service, AsyncService)
+
     def _run(self):
         self._started_at = datetime.utcnow()
         try:
-            self.result = self.service.run(self.specification, 
-                                           self._check_interrupt)
+            if self.service.run_in_process():
+                self.result = self._executor.run_in_process(self)
+            else:
+                self.result = self.service.run(self.specification, 
+                                               self._check_interrupt)
         except Exception as e:
-            self.exception = mplane.model.Exception(
-                            token=self.specification.get_token(), 
-                            errmsg=str(e))
-            print("Got exception in _run(), returning "+str(self.exception))
-            self._exception_at = datetime.utcnow()
+            self._set_exception(str(e))
         self._ended_at = datetime.utcnow()
+        self._set_done()
 
         if self._callback:
             self._callback(self.receipt)
 
+    async def _run_async(self):
+        self._started_at = datetime.utcnow()
+        try:
+            self.result = await self.service.run(self.specification)
+        except asyncio.CancelledError:
+            self._set_exception("Interrupted")
+        except Exception as e:
+            self._set_exception(str(e))
+        self._ended_at = datetime.utcnow()
+        self._set_done()
+
+        if self._callback:
+            # keep callback I/O off the event loop
+            self._loop.run_in_executor(None, self._callback, self.receipt)
+
+    def _set_task(self, loop, task):
+        self._loop = loop
+        self._task = task
+        if self._interrupt.is_set():
+            task.cancel()
+
+    def _interrupted(self):
+        # the task was cancelled before _run_async() got to run
+        if self.result is None and self.exception is None:
+            self._set_exception("Interrupted")
+            self._ended_at = datetime.utcnow()
+            self._set_done()
+            if self._callback:
+                self._loop.run_in_executor(None, self._callback, self.receipt)
+
+    def _set_exception(self, errmsg):
+        self.exception = mplane.model.Exception(
+                        token=self.specification.get_token(), 
+                        errmsg=errmsg)
+        print("Got exception in _run(), returning "+str(self.exception))
+        self._exception_at = datetime.utcnow()
+
     def _check_interrupt(self):
         return self._interrupt.is_set()
 
     def _schedule_now(self):
-        # spawn a thread to run the service
-        threading.Thread(target=self._run).start()
+        # hand the job to the worker pool
+        self._executor.submit(self)
         
     def schedule(self):
         """
@@ -149,22 +666,32 @@ class Job(object):
         if start_delay is None:
             return
 
-        # start interrupt timer
+        # start interrupt timer, dropped once the job is done so that
+        # it does not keep the job and its result until it would fire
         if end_delay is not None and not hasattr(self.service, 'relay'):
-            threading.Timer(end_delay, self.interrupt).start()
+            timer = self._dispatcher.schedule(end_delay, self.interrupt)
+            self.add_done_callback(lambda job: self._dispatcher.cancel(timer))
             print("Will interrupt "+repr(self)+" after "+str(end_delay)+" sec")
 
         # start start timer
         if start_delay > 0:            
             print("Scheduling "+repr(self)+" after "+str(start_delay)+" sec")
-            threading.Timer(start_delay, self._schedule_now).start()
+            self._dispatcher.schedule(start_delay, self._schedule_now)
         else:
             print("Scheduling "+repr(self)+" immediately")
             self._schedule_now()
 
     def interrupt(self):
-        """Interrupt this job."""
+        """
+        Interrupt this job. The job's service will see check_interrupt()
+        return True or, for an AsyncService, have its coroutine cancelled.
+
+        """
         self._interrupt.set()
+        if self._task is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        elif self.service.run_in_process():
+            self._executor.interrupt_process(self)
 
     def failed(self):
         """A job only fails if it is finished and has no results"""
@@ -191,10 +718,15 @@ class Job(object):
         elif self.finished():
             return self.result
         else:
+            partial = self.service.partial_reply(self.specification)
+            if partial is not None:
+                return partial
+            self.receipt.set_queue_position(
+                    self._executor.queue_position(self))
             return self.receipt
 
 
-class MultiJob(object):
+class MultiJob(_Completion):
     """
     A MultiJob spawns multiple jobs determined by its schedule.
 
@@ -211,8 +743,10 @@ class MultiJob(object):
     _scheduling_finished = False
     _subspec_iterator = None
 
-    def __init__(self, service, specification, session=None, max_results=0, callback=None):
+    def __init__(self, service, specification, session=None, max_results=0,
+                 callback=None, dispatcher=None, executor=None):
         super(MultiJob, self).__init__()
+        self.jobs = []
         self.service = service
         self.session = session
         self.specification = specification
@@ -223,6 +757,10 @@ class MultiJob(object):
         self._subspec_iterator = specification.subspec_iterator()
         self._max_results = int(max_results)
         self._callback = callback
+        if dispatcher is None:
+            dispatcher = default_dispatcher()
+        self._dispatcher = dispatcher
+        self._executor = executor
 
     def __repr__(self):
         return "<MultiJob for "+repr(self.specification)+">"
@@ -234,9 +772,12 @@ class MultiJob(object):
         new_job = Job(service=self.service,
                       specification=self._subspec,
                       session=self.session,
-                      callback=self._job_callback)
+                      callback=self._job_callback,
+                      dispatcher=self._dispatcher,
+                      executor=self._executor)
 
         self.jobs.append(new_job)
+        new_job.add_done_callback(self._job_done)
         new_job.schedule()
 
         self._next_job()
@@ -248,20 +789,20 @@ class MultiJob(object):
         try:
             self._subspec = next(self._subspec_iterator)
         except StopIteration:
-            self._scheduling_finished = True
+            self._finish_scheduling()
             return
 
         (start_delay, end_delay) = self._subspec.when().timer_delays()
 
         # if no start_delay for the next run was found we should stop this MultiJob
         if start_delay is None:
-            self._scheduling_finished = True
+            self._finish_scheduling()
             return
 
         # start start timer
         if start_delay > 0:
             print("Scheduling "+repr(self._subspec)+" from "+repr(self)+" after "+str(start_delay)+" sec")
-            threading.Timer(start_delay, self._schedule_job).start()
+            self._dispatcher.schedule(start_delay, self._schedule_job)
         else:
             print("Scheduling "+repr(self._subspec)+" from "+repr(self)+" immediately")
             self._schedule_job()
@@ -277,12 +818,13 @@ class MultiJob(object):
 
         # if no start_delay for the next run was found we should stop this MultiJob
         if start_delay is None:
-            self._scheduling_finished = True
+            self._finish_scheduling()
             return
 
-        # start interrupt timer
+        # start interrupt timer, dropped once all jobs are done
         if end_delay is not None:
-            threading.Timer(end_delay, self.interrupt).start()
+            timer = self._dispatcher.schedule(end_delay, self.interrupt)
+            self.add_done_callback(lambda job: self._dispatcher.cancel(timer))
             print("Will interrupt "+repr(self)+" after "+str(end_delay)+" sec")
 
         # begin scheduling of all jobs
@@ -336,6 +878,16 @@ class MultiJob(object):
         if self._callback:
             self._callback(self.receipt)
 
+    def _finish_scheduling(self):
+        self._scheduling_finished = True
+        self._job_done(None)
+
+    def _job_done(self, job):
+        # done once no further sub-jobs will be started and all have run
+        if self._scheduling_finished and \
+           all(job.failed() or job.finished() for job in list(self.jobs)):
+            self._set_done()
+
 
 class Scheduler(object):
     """
@@ -353,16 +905,37 @@ class Scheduler(object):
 
             if "component" not in config.sections():
                 self._max_results = 0
+                pool_size = DEFAULT_POOL_SIZE
+                process_pool_size = None
             else:
                 # get max results to store
                 self._max_results = config.getint("component", "scheduler_max_results")
+                # get number of worker threads running jobs
+                pool_size = config.getint("component", "scheduler_pool_size",
+                                          fallback=DEFAULT_POOL_SIZE)
+                # get number of worker processes for run_in_process services
+                process_pool_size = config.getint("component",
+                                                  "scheduler_process_pool_size",
+                                                  fallback=None)
         else:
             self._max_results = 0
+            pool_size = DEFAULT_POOL_SIZE
+            process_pool_size = None
             self.azn = mplane.azn.Authorization()
 
         self.services = []
         self.jobs = {}
         self._capability_cache = {}
+        # schema hash -> services with that schema, in registration order
+        self._service_index = collections.defaultdict(list)
+        # services may be added (e.g. by a supervisor) while jobs are submitted
+        self._services_lock = threading.Lock()
+
+        # single thread firing all start, interrupt and sub-job timers
+        self._dispatcher = TimerDispatcher()
+
+        # bounded pool of reused threads running the jobs
+        self._executor = JobExecutor(pool_size, process_pool_size)
 
     def process_message(self, user, msg, session=None, callback=None):
         """
@@ -403,12 +976,23 @@ class Scheduler(object):
 
         return reply
 
+    def set_event_loop(self, loop):
+        """
+        Run AsyncService jobs on the given asyncio event loop or Tornado
+        IOLoop; by default, the scheduler starts a private event loop
+        thread when the first such job is submitted.
+
+        """
+        self._executor.set_event_loop(loop)
+
     def add_service(self, service):
         """Add a service to this Scheduler"""
         print("Added "+repr(service))
-        self.services.append(service)
         cap = service.capability()
-        self._capability_cache[cap.get_token()] = cap
+        with self._services_lock:
+            self.services.append(service)
+            self._capability_cache[cap.get_token()] = cap
+            self._service_index[cap._schema_hash()].append(service)
 
     def capability_keys(self):
         """
@@ -416,13 +1000,15 @@ class Scheduler(object):
         provided by this scheduler's services.
 
         """
-        return self._capability_cache.keys()
+        with self._services_lock:
+            return list(self._capability_cache.keys())
 
     def capability_for_key(self, key):
         """
         Return a capability for a given key.
         """
-        return self._capability_cache[key]
+        with self._services_lock:
+            return self._capability_cache[key]
 
     def submit_job(self, user, specification, session=None, callback=None):
         """
@@ -431,9 +1017,12 @@ class Scheduler(object):
         a new Job to execute the statement. 
 
         """
-        # linearly search the available services
-        for service in self.services:
-            if specification.fulfills(service.capability()):
+        # only services with the same schema can fulfill the specification;
+        # of these, find the first whose temporal scope it follows
+        with self._services_lock:
+            candidates = list(self._service_index.get(specification._schema_hash(), ()))
+        for service in candidates:
+            if specification.when().follows(service.capability().when()):
                 if self.azn.check(service.capability(), user):
                     # Found. Create a new job.
                     print(repr(service)+" matches "+repr(specification))
@@ -445,12 +1034,16 @@ class Scheduler(object):
                                            specification=specification,
                                            session=session,
                                            max_results=self._max_results,
-                                           callback=callback)
+                                           callback=callback,
+                                           dispatcher=self._dispatcher,
+                                           executor=self._executor)
                     else:
                         new_job = Job(service=service,
                                       specification=specification,
                                       session=session,
-                                      callback=callback)
+                                      callback=callback,
+                                      dispatcher=self._dispatcher,
+                                      executor=self._executor)
 
                     # Key by the receipt's token, and return
                     job_key = new_job.receipt.get_token()
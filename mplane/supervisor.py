@@ -29,21 +29,318 @@ import mplane.tls
 
 import argparse
 import configparser
+import collections
+import concurrent.futures
+import fnmatch
 import queue
 import re
 import tornado.web
 from time import sleep
+from datetime import datetime
+import time
 import threading
+import traceback
 from threading import Thread
 
+# how often a relay waiting for a result checks for interrupts
+RELAY_INTERRUPT_INTERVAL = 1
+
+DEFAULT_DISPATCH_WORKERS = 4
+
+DEFAULT_PENDING_TTL = 300
+DEFAULT_PENDING_MAX_EARLY = 10000
+
+DEFAULT_FANOUT_CONCURRENCY = 16
+DEFAULT_FANOUT_TIMEOUT = 30
+FANOUT_LABEL_SUFFIX = "-fanout"
+FANOUT_IDENTITY_COLUMN = "probe.DN"
+
+# (column name glob, reductions) pairs, the first matching a column applies;
+# a column with several reductions is split into one column for each
+DEFAULT_REDUCTIONS = (("delay.*.us", "min,mean,max,count"),
+                      ("time", "max"),
+                      ("delay.*.min", "min"),
+                      ("delay.*.mean", "mean"),
+                      ("delay.*.max", "max"),
+                      ("delay.*.count", "sum"),
+                      ("bytes.*", "sum"),
+                      ("octets.*", "sum"),
+                      ("packets.*", "sum"))
+
+DEFAULT_POLL_INTERVAL = 5
+DEFAULT_POLL_CONCURRENCY = 16
+DEFAULT_POLL_TIMEOUT = 10
+DEFAULT_POLL_MAX_BACKOFF = 300
+
+class Dispatcher(object):
+    """
+    Pool of worker threads passing the [msg, identity] items of a
+    queue to handler(msg, identity), blocking while it is empty.
+    Counts the messages handled and failed, and the queue depth.
+
+    """
+    def __init__(self, messages, handler, workers=DEFAULT_DISPATCH_WORKERS):
+        self._messages = messages
+        self._handler = handler
+        self._lock = threading.Lock()
+        self._handled = 0
+        self._failed = 0
+        self._max_depth = 0
+        self._last_stats = (time.monotonic(), 0)
+        self._threads = []
+        for i in range(workers):
+            t = Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            [msg, identity] = self._messages.get()
+            depth = self._messages.qsize() + 1
+            try:
+                self._handler(msg, identity)
+                failed = 0
+            except Exception:
+                print("Error handling message from " + str(identity) + ":")
+                traceback.print_exc()
+                failed = 1
+            with self._lock:
+                self._handled += 1
+                self._failed += failed
+                self._max_depth = max(self._max_depth, depth)
+
+    def stats(self):
+        """
+        Returns a dictionary of counters: messages handled and failed,
+        current and highest queue depth, and messages handled per
+        second since the previous call.
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            (then, handled_then) = self._last_stats
+            self._last_stats = (now, self._handled)
+            return {"workers": len(self._threads),
+                    "handled": self._handled,
+                    "failed": self._failed,
+                    "queue_depth": self._messages.qsize(),
+                    "max_queue_depth": self._max_depth,
+                    "rate": (self._handled - handled_then) / max(now - then, 1e-9)}
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+class PendingResultTable(object):
+    """
+    Results (or exceptions) awaited by relayed specifications, as
+    futures keyed by the identity of the component and the token of
+    the forwarded specification. Only futures a caller asked for are
+    resolved; messages arriving before they are awaited are kept for
+    up to ttl seconds, and at most max_early of them.
+
+    """
+    def __init__(self, ttl=DEFAULT_PENDING_TTL, max_early=DEFAULT_PENDING_MAX_EARLY):
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._early = collections.OrderedDict()
+        self._ttl = ttl
+        self._max_early = max_early
+
+    def __len__(self):
+        with self._lock:
+            return len(self._futures) + len(self._early)
+
+    def future(self, identity, token):
+        """
+        Returns the future for a token, e.g. to wait for several at
+        once; discard() it once done
+
+        """
+        with self._lock:
+            key = (identity, token)
+            if key not in self._futures:
+                future = concurrent.futures.Future()
+                if key in self._early:
+                    future.set_result(self._early.pop(key)[0])
+                self._futures[key] = future
+            return self._futures[key]
+
+    def complete(self, identity, msg):
+        """ Hands a result or exception from a component to its waiter """
+        token = msg.get_token()
+        if token is None:
+            return
+        key = (identity, token)
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                # keep it for a waiter to come, within bounds
+                self._early.pop(key, None)
+                self._early[key] = (msg, time.monotonic())
+                self._expire()
+                return
+        if not future.done():
+            future.set_result(msg)
+
+    def _expire(self):
+        deadline = time.monotonic() - self._ttl
+        while self._early:
+            (key, (msg, arrived)) = next(iter(self._early.items()))
+            if arrived >= deadline and len(self._early) <= self._max_early:
+                break
+            del self._early[key]
+
+    def wait(self, identity, token, timeout=None):
+        """
+        Returns the result or exception for a token; raises
+        concurrent.futures.TimeoutError if none arrives in time
+
+        """
+        msg = self.future(identity, token).result(timeout)
+        self.discard(identity, token)
+        return msg
+
+    def discard(self, identity, token):
+        with self._lock:
+            self._futures.pop((identity, token), None)
+
+class ComponentPoller(object):
+    """
+    Polls the components of a client-initiated workflow for their
+    capabilities, and redeems receipts, from a pool of up to
+    concurrency threads, each request timing out after timeout
+    seconds. Components are polled every interval seconds; one which
+    fails is retried after a delay doubling up to max_backoff, without
+    holding back the others. A receipt is redeemed once the end of its
+    temporal scope has passed, then every interval until it yields a
+    result; receipts without an end are redeemed every interval.
+
+    """
+    def __init__(self, client, urls,
+                 interval=DEFAULT_POLL_INTERVAL,
+                 concurrency=DEFAULT_POLL_CONCURRENCY,
+                 timeout=DEFAULT_POLL_TIMEOUT,
+                 max_backoff=DEFAULT_POLL_MAX_BACKOFF):
+        self._client = client
+        self._urls = list(urls)
+        self._interval = interval
+        self._timeout = timeout
+        self._max_backoff = max_backoff
+        self._executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._next_poll = {}
+        self._failures = {}
+        # first sight and last redemption of outstanding receipts
+        self._receipt_seen = {}
+        self._last_redeemed = {}
+
+    @classmethod
+    def from_config(cls, client, urls, config):
+        """
+        Creates a poller configured by the poll_interval, poll_concurrency,
+        poll_timeout and poll_max_backoff keys of the client section
+
+        """
+        return cls(client, urls,
+                   interval=config.getfloat("client", "poll_interval",
+                                            fallback=DEFAULT_POLL_INTERVAL),
+                   concurrency=config.getint("client", "poll_concurrency",
+                                             fallback=DEFAULT_POLL_CONCURRENCY),
+                   timeout=config.getfloat("client", "poll_timeout",
+                                           fallback=DEFAULT_POLL_TIMEOUT),
+                   max_backoff=config.getfloat("client", "poll_max_backoff",
+                                               fallback=DEFAULT_POLL_MAX_BACKOFF))
+
+    def run(self):
+        """ Polls forever """
+        while True:
+            self.poll()
+            sleep(min(self._interval, 1))
+
+    def poll(self):
+        """
+        Starts the polls and redemptions which are due and not
+        already running, and returns without waiting for them
+
+        """
+        now = time.monotonic()
+        for url in self._urls:
+            with self._lock:
+                # polls of a component never overlap, however long they take
+                if (("url", url) in self._in_flight or
+                    self._next_poll.get(url, 0) > now):
+                    continue
+                self._next_poll[url] = float("inf")
+            self._submit(("url", url), self._poll_component, url)
+
+        utcnow = datetime.utcnow()
+        receipts = dict((receipt.get_token(), receipt)
+                        for receipt in self._client.receipts())
+        for token in list(self._receipt_seen):
+            if token not in receipts:
+                del self._receipt_seen[token]
+                self._last_redeemed.pop(token, None)
+        for (token, receipt) in receipts.items():
+            if self._redeemable(token, receipt, utcnow, now):
+                self._last_redeemed[token] = now
+                self._submit(("receipt", token), self._redeem, token)
+
+    def _redeemable(self, token, receipt, utcnow, now):
+        seen = self._receipt_seen.setdefault(token, utcnow)
+        if now - self._last_redeemed.get(token, now - self._interval) < self._interval:
+            return False
+        when = receipt.when()
+        if when is not None:
+            (start, end) = when.datetimes(tzero=seen)
+            if end is not None and utcnow < end:
+                return False
+        return True
+
+    def _submit(self, key, fn, arg):
+        with self._lock:
+            if key in self._in_flight:
+                return
+            self._in_flight.add(key)
+
+        def done(future):
+            with self._lock:
+                self._in_flight.discard(key)
+
+        self._executor.submit(fn, arg).add_done_callback(done)
+
+    def _poll_component(self, url):
+        try:
+            self._client.retrieve_capabilities(url, timeout=self._timeout)
+            failures = 0
+            delay = self._interval
+        except Exception as e:
+            failures = self._failures.get(url, 0) + 1
+            delay = min(self._interval * 2 ** failures, self._max_backoff)
+            print(str(url) + " unreachable (" + str(e) + "). Retrying in " +
+                  str(int(delay)) + " seconds")
+        # the next poll is due once this one is done
+        with self._lock:
+            self._failures[url] = failures
+            self._next_poll[url] = time.monotonic() + delay
+
+    def _redeem(self, token):
+        try:
+            self._client.result_for(token, timeout=self._timeout)
+        except Exception as e:
+            print("Error redeeming receipt " + token + ": " + str(e))
+
 class RelayService(mplane.scheduler.Service):
 
-    def __init__(self, cap, identity, client, lock, messages):
+    def __init__(self, cap, identity, client, pending):
         self.relay = True
         self._identity = identity
         self._client = client
-        self._lock = lock
-        self._messages = messages
+        self._pending = pending
+        # forward by token: labels are not unique across components
+        self._cap_token = cap.get_token()
         # cap.add_metadata("probe.DN", identity)
         super(RelayService, self).__init__(cap)
 
@@ -51,30 +348,501 @@ class RelayService(mplane.scheduler.Service):
         pattern = re.compile("-\d+$")
         trunc_pos = pattern.search(spec.get_label())
         trunc_label = spec.get_label()[:trunc_pos.start()]
-        fwd_spec = self._client.invoke_capability(trunc_label, spec.when(), spec.parameter_values())
+        fwd_spec = self._client.invoke_capability(self._cap_token, spec.when(), spec.parameter_values())
         result = None
         pending = False
         while result is None:
             if check_interrupt() and not pending:
                 self._client.interrupt_capability(fwd_spec.get_token())
                 pending = True
-            sleep(1)
-            with self._lock:
-                if self._identity in self._messages:
-                    for msg in self._messages[self._identity]:
-                        if msg.get_token() == fwd_spec.get_token():
-                            if (isinstance(msg, mplane.model.Result) or
-                                isinstance(msg, mplane.model.Envelope)):
-                                print("Received result for " + trunc_label + " from " + self._identity)
-                            elif isinstance(msg, mplane.model.Exception):
-                                print("Received exception for " + trunc_label + " from " + self._identity)
-                            result = msg
-                            self._messages[self._identity].remove(msg)
-                            break
+            try:
+                result = self._pending.wait(self._identity, fwd_spec.get_token(),
+                                            RELAY_INTERRUPT_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                pass
 
+        if (isinstance(result, mplane.model.Result) or
+            isinstance(result, mplane.model.Envelope)):
+            print("Received result for " + trunc_label + " from " + self._identity)
+        elif isinstance(result, mplane.model.Exception):
+            print("Received exception for " + trunc_label + " from " + self._identity)
         result.set_token(spec.get_token())
         return result
 
+def _reduce_min(acc, val):
+    return val if acc is None or val < acc else acc
+
+def _reduce_max(acc, val):
+    return val if acc is None or val > acc else acc
+
+def _reduce_sum(acc, val):
+    return val if acc is None else acc + val
+
+def _reduce_count(acc, val):
+    return 1 if acc is None else acc + 1
+
+def _reduce_mean(acc, val, weight=1):
+    if acc is None:
+        return (val * weight, weight)
+    return (acc[0] + val * weight, acc[1] + weight)
+
+def _reduce_distinct(acc, val):
+    if acc is None:
+        acc = collections.OrderedDict()
+    acc[val] = None
+    return acc
+
+def _mean(acc):
+    if acc is None or acc[1] == 0:
+        return None
+    (total, count) = acc
+    if isinstance(total, int):
+        # keep integral columns integral
+        return int(round(total / count))
+    return total / count
+
+REDUCTIONS = {"min": (_reduce_min, None),
+              "max": (_reduce_max, None),
+              "sum": (_reduce_sum, None),
+              "count": (_reduce_count, lambda acc: acc or 0),
+              "mean": (_reduce_mean, _mean),
+              "distinct": (_reduce_distinct,
+                           lambda acc: None if acc is None else ",".join(map(str, acc)))}
+
+def _constraint_union(elem, constraints):
+    """
+    Returns the smallest constraint, as a string, allowing every value
+    one of the given constraint strings allows: the set of all values
+    if they are all sets, the range spanning them all otherwise
+
+    """
+    if mplane.model.CONSTRAINT_ALL in constraints:
+        return mplane.model.CONSTRAINT_ALL
+    values = set()
+    ranged = False
+    for constraint in constraints:
+        if constraint.find(mplane.model.RANGE_SEP) > 0:
+            ranged = True
+            values.update(map(elem.parse, constraint.split(mplane.model.RANGE_SEP)))
+        else:
+            values.update(map(elem.parse, constraint.split(mplane.model.SET_SEP)))
+    values = sorted(values)
+    if ranged:
+        return elem.unparse(values[0]) + mplane.model.RANGE_SEP + elem.unparse(values[-1])
+    return mplane.model.SET_SEP.join(map(elem.unparse, values))
+
+def _schema_providers(client, cap):
+    """
+    Returns the identities of the components offering
+    capabilities with the schema of the given one
+
+    """
+    identities = set()
+    for other in client.capabilities_matching_schema(cap):
+        try:
+            identities.add(client.identity_for(other.get_token()))
+        except KeyError:
+            pass
+    return identities
+
+def _reduced_column(column, op):
+    """
+    Returns the name of the element holding a reduction of a column:
+    the column, or the longest prefix of it, suffixed with the
+    reduction, e.g. delay.twoway.icmp.us.min or delay.twoway.icmp.count
+
+    """
+    parts = column.split(".")
+    for k in range(len(parts), 0, -1):
+        name = ".".join(parts[:k]) + "." + op
+        try:
+            mplane.model.element(name)
+        except KeyError:
+            continue
+        return name
+    raise ValueError("No element for the " + op + " of " + column)
+
+def _reduction_plan(columns, reductions, group_by):
+    """
+    Returns the (column index, reduction, reduced column name) of each
+    reduction of the given columns, and the indices of the columns
+    rows are grouped by
+
+    """
+    ops = []
+    for (i, column) in enumerate(columns):
+        for (pattern, names) in reductions:
+            if fnmatch.fnmatchcase(column, pattern):
+                names = [op.strip() for op in names.split(",")]
+                for op in names:
+                    if op not in REDUCTIONS:
+                        raise ValueError("Unknown reduction " + op + " for " + column)
+                    if len(names) == 1:
+                        ops.append((i, op, column))
+                    else:
+                        ops.append((i, op, _reduced_column(column, op)))
+                break
+    reduced = set(i for (i, op, name) in ops)
+    if group_by is None:
+        keys = [i for i in range(len(columns))
+                if i not in reduced and columns[i] != FANOUT_IDENTITY_COLUMN]
+    else:
+        keys = [columns.index(column) for column in group_by
+                if column in columns]
+    # rows merged across components list the components they came from
+    if (len(ops) > 0 and FANOUT_IDENTITY_COLUMN in columns):
+        i = columns.index(FANOUT_IDENTITY_COLUMN)
+        if i not in reduced and i not in keys:
+            ops.append((i, "distinct", FANOUT_IDENTITY_COLUMN))
+    return (ops, keys)
+
+def reduced_column_names(columns, reductions=DEFAULT_REDUCTIONS, group_by=None):
+    """
+    Returns the names of the result columns a ResultReducer merges
+    results with the given columns into
+
+    """
+    columns = list(columns)
+    (ops, keys) = _reduction_plan(columns, reductions, group_by)
+    if len(ops) == 0:
+        return columns
+    return [columns[i] for i in keys] + [name for (i, op, name) in ops]
+
+class ResultReducer(object):
+    """
+    Merges Results for a specification, as they arrive, into one
+    Result. Each result column whose name matches one of the globs in
+    reductions is reduced with the given operations (min, max, sum,
+    count, mean or distinct), over the rows having the same values in
+    the group_by columns; by default, these are all columns which are
+    not reduced, except probe.DN, so that rows merge across components.
+    A column with several reductions is split into one column for each
+    (delay.twoway.icmp.us into delay.twoway.icmp.us.min and so on).
+    Only one row is kept per group, however many are added. If no
+    column is reduced, rows are concatenated instead.
+
+    Means of means are weighted by the count column of the same
+    measure, if the result has one (e.g. delay.twoway.icmp.us.mean by
+    delay.twoway.icmp.count), so that they stay the mean of all
+    samples. Unless grouped by, probe.DN lists the components whose
+    rows were merged.
+
+    The merged columns are given by reduced_column_names(), which the
+    specification must have; columns names the columns of the
+    Results added, if they differ from those of the specification.
+
+    Columns a result lacks, or leaves null, are filled from the values
+    given to add(), e.g. the identity of the component it came from.
+
+    """
+    def __init__(self, spec, reductions=DEFAULT_REDUCTIONS, group_by=None,
+                 columns=None):
+        self._spec = spec
+        if columns is None:
+            columns = spec.result_column_names()
+        self._columns = list(columns)
+        (self._ops, self._keys) = _reduction_plan(self._columns, reductions, group_by)
+        self._updates = [REDUCTIONS[op][0] for (i, op, name) in self._ops]
+        self._weights = [self._count_column(name)
+                         if op == "mean" and name == self._columns[i] else None
+                         for (i, op, name) in self._ops]
+        self._groups = collections.OrderedDict()
+        self._rows = []
+        self._when = (None, None)
+
+    def _count_column(self, column):
+        """
+        Returns the index of the count column sharing the longest
+        prefix with the given column, or None if there is none
+
+        """
+        parts = column.split(".")
+        for k in range(len(parts) - 1, 0, -1):
+            count = ".".join(parts[:k]) + ".count"
+            if count != column and count in self._columns:
+                return self._columns.index(count)
+        return None
+
+    def add(self, msg, values=None):
+        """
+        Merges a Result, or the Results in an Envelope, given the
+        values of columns it lacks as a dict; other messages are ignored
+
+        """
+        if isinstance(msg, mplane.model.Envelope):
+            for imsg in msg.messages():
+                self.add(imsg, values)
+            return
+        elif not isinstance(msg, mplane.model.Result):
+            return
+
+        (start, end) = msg.when().datetimes()
+        (first, last) = self._when
+        if start is not None and (first is None or start < first):
+            first = start
+        if end is not None and (last is None or end > last):
+            last = end
+        self._when = (first, last)
+
+        count = msg.count_result_rows()
+        have = set(msg.result_column_names())
+        if values is None:
+            values = {}
+        columns = []
+        for column in self._columns:
+            if column not in have:
+                columns.append([values.get(column)] * count)
+            elif column in values:
+                columns.append([values[column] if val is None else val
+                                for val in msg.result_column_values(column)])
+            else:
+                columns.append(msg.result_column_values(column))
+
+        if len(self._ops) == 0:
+            self._rows.extend(zip(*columns))
+            return
+        for row in zip(*columns):
+            key = tuple(row[i] for i in self._keys)
+            accs = self._groups.get(key)
+            if accs is None:
+                accs = self._groups[key] = [None] * len(self._ops)
+            for (j, (i, op, name)) in enumerate(self._ops):
+                if row[i] is None:
+                    continue
+                weight = self._weights[j]
+                if weight is None or row[weight] is None:
+                    accs[j] = self._updates[j](accs[j], row[i])
+                else:
+                    accs[j] = self._updates[j](accs[j], row[i], row[weight])
+
+    def __len__(self):
+        """ Returns the number of rows of the merged result """
+        return len(self._groups) + len(self._rows)
+
+    def result(self):
+        """ Returns the merged Result of everything added so far """
+        res = mplane.model.Result(specification=self._spec)
+        if self._when[0] is not None:
+            res.set_when(mplane.model.When(a=self._when[0], b=self._when[1]))
+        if len(self._ops) == 0:
+            res.append_rows(self._rows, columns=self._columns)
+            return res
+        finals = [REDUCTIONS[op][1] for (i, op, name) in self._ops]
+        keyed = [self._columns[i] for i in self._keys]
+        reduced = [name for (i, op, name) in self._ops]
+        rows = []
+        for (key, accs) in self._groups.items():
+            rows.append(key + tuple(acc if final is None else final(acc)
+                                    for (acc, final) in zip(accs, finals)))
+        res.append_rows(rows, columns=keyed + reduced)
+        return res
+
+class FanoutService(mplane.scheduler.Service):
+    """
+    Relays a specification to every component offering a capability
+    with the schema of the given one, and merges their results into
+    one Result with a ResultReducer, as they arrive, with the identity
+    of the component each row came from in an extra probe.DN column.
+    Specifications are sent from the given executor, so up to its
+    number of workers at a time.
+
+    The aggregate capability accepts the parameter values any of these
+    components accepts; see update_capability().
+
+    While results are arriving, redeeming the specification returns
+    those merged so far, in an envelope bearing its token.
+
+    """
+
+    def __init__(self, cap, client, pending, executor,
+                 timeout=DEFAULT_FANOUT_TIMEOUT, reductions=DEFAULT_REDUCTIONS,
+                 group_by=None):
+        self.relay = True
+        self._schema = cap
+        self._client = client
+        self._pending = pending
+        self._executor = executor
+        self._timeout = timeout
+        self._reductions = reductions
+        self._group_by = group_by
+        self._lock = threading.Lock()
+        self._reducers = {}
+
+        # the aggregate capability differs from the relayed ones by its
+        # identity column, so the scheduler tells their specifications
+        # apart, and has the columns the results are reduced into
+        self._columns = list(cap.result_column_names())
+        if FANOUT_IDENTITY_COLUMN not in self._columns:
+            self._columns.append(FANOUT_IDENTITY_COLUMN)
+        d = cap.to_dict()
+        d[mplane.model.KEY_RESULTS] = reduced_column_names(self._columns,
+                                                           reductions, group_by)
+        agg_cap = mplane.model.Capability(dictval=d)
+        agg_cap.set_label(cap.get_label() + FANOUT_LABEL_SUFFIX)
+        agg_cap.set_token(agg_cap._default_token())
+        super(FanoutService, self).__init__(agg_cap)
+        self.update_capability()
+
+    def update_capability(self):
+        """
+        Widens the constraints of the aggregate capability to the union
+        of those of the capabilities it relays to, and labels it after
+        the label most of them have, whatever order they arrived in.
+        The capability keeps its token. Returns True if it changed.
+
+        """
+        caps = self._client.capabilities_matching_schema(self._schema)
+        if len(caps) == 0:
+            return False
+        agg_cap = self.capability()
+        changed = False
+
+        counts = collections.Counter(cap.get_label() for cap in caps)
+        label = min(counts, key=lambda label: (-counts[label], label))
+        if agg_cap.get_label() != label + FANOUT_LABEL_SUFFIX:
+            agg_cap.set_label(label + FANOUT_LABEL_SUFFIX)
+            changed = True
+
+        params = [cap.to_dict().get(mplane.model.KEY_PARAMETERS, {}) for cap in caps]
+        current = agg_cap.to_dict().get(mplane.model.KEY_PARAMETERS, {})
+        for (name, constraint) in current.items():
+            union = _constraint_union(mplane.model.element(name),
+                                      [p.get(name, mplane.model.CONSTRAINT_ALL)
+                                       for p in params])
+            if union != constraint:
+                agg_cap.add_parameter(name, constraint=union)
+                changed = True
+        return changed
+
+    def targets(self, spec):
+        """
+        Returns (capability, identity) for each component which
+        can run the specification
+
+        """
+        targets = []
+        for cap in self._client.capabilities_matching_schema(self._schema):
+            try:
+                identity = self._client.identity_for(cap.get_token())
+            except KeyError:
+                continue
+            if not spec.when().follows(cap.when()):
+                continue
+            if all(cap.can_set_parameter_value(k, v)
+                   for (k, v) in spec.parameter_values().items()):
+                targets.append((cap, identity))
+        return targets
+
+    def _invoke(self, cap, spec):
+        # components offering the same schema each get a specification
+        # token of their own, so that their results are told apart
+        token = spec._pv_hash(astr=spec.get_token() + cap.get_token())
+        return self._client.invoke_capability(cap.get_token(), spec.when(),
+                                              spec.parameter_values(),
+                                              token=token)
+
+    def _interrupt(self, token):
+        try:
+            self._client.interrupt_capability(token)
+        except Exception as e:
+            print("Cannot interrupt " + token + ": " + str(e))
+
+    def run(self, spec, check_interrupt):
+        targets = self.targets(spec)
+        if len(targets) == 0:
+            raise ValueError("No component offers " + self._schema.get_label())
+        print("Fanning " + spec.get_label() + " out to " +
+              str(len(targets)) + " components")
+
+        token = spec.get_token()
+        reducer = ResultReducer(spec, self._reductions, self._group_by,
+                                columns=self._columns)
+        with self._lock:
+            self._reducers[token] = reducer
+
+        # futures for sending the specifications, then for their results
+        waiting = {}
+        for (cap, identity) in targets:
+            waiting[self._executor.submit(self._invoke, cap, spec)] = (identity, None)
+
+        # relayed jobs are not interrupted at the end of their temporal
+        # scope, so components get the timeout past its end to answer
+        (start, end) = spec.when().datetimes()
+        deadline = float("inf")
+        if end is not None:
+            deadline = (time.monotonic() + self._timeout +
+                        max((end - datetime.utcnow()).total_seconds(), 0))
+
+        failed = []
+        replied = 0
+        interrupted = False
+        try:
+            while len(waiting) > 0:
+                now = time.monotonic()
+                if not interrupted and check_interrupt():
+                    interrupted = True
+                    deadline = min(deadline, now + self._timeout)
+                    for (identity, fwd_token) in waiting.values():
+                        if fwd_token is not None:
+                            self._executor.submit(self._interrupt, fwd_token)
+                elif now > deadline:
+                    for (identity, fwd_token) in waiting.values():
+                        failed.append(identity + ": no result")
+                        if fwd_token is not None:
+                            self._pending.discard(identity, fwd_token)
+                    break
+
+                (done, not_done) = concurrent.futures.wait(
+                        waiting, min(RELAY_INTERRUPT_INTERVAL, max(deadline - now, 0)),
+                        concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (identity, fwd_token) = waiting.pop(future)
+                    if future.exception() is not None:
+                        failed.append(identity + ": " + str(future.exception()))
+                    elif fwd_token is None:
+                        # sent; now wait for its result, from the identity
+                        # it will come with, which is that of the connection
+                        # the reply came in on rather than of the capability
+                        fwd_token = future.result().get_token()
+                        try:
+                            identity = self._client.identity_for(fwd_token, receipt=True)
+                        except KeyError:
+                            pass
+                        waiting[self._pending.future(identity, fwd_token)] = \
+                            (identity, fwd_token)
+                    else:
+                        self._pending.discard(identity, fwd_token)
+                        msg = future.result()
+                        if isinstance(msg, mplane.model.Exception):
+                            failed.append(identity + ": " + msg._errmsg)
+                        else:
+                            replied += 1
+                            with self._lock:
+                                reducer.add(msg, {FANOUT_IDENTITY_COLUMN: identity})
+        finally:
+            with self._lock:
+                del self._reducers[token]
+
+        for failure in failed:
+            print("Fan-out of " + spec.get_label() + " failed at " + failure)
+        if replied == 0:
+            raise ValueError("No results: " + "; ".join(failed))
+        print("Received results for " + spec.get_label() + " from " +
+              str(replied) + " of " + str(len(targets)) + " components")
+        return reducer.result()
+
+    def partial_reply(self, spec):
+        with self._lock:
+            reducer = self._reducers.get(spec.get_token())
+            if reducer is None or len(reducer) == 0:
+                return None
+            res = reducer.result()
+        env = mplane.model.Envelope(token=spec.get_token(),
+                                    label=spec.get_label(),
+                                    when=spec.when())
+        env.append_message(res)
+        return env
+
 class BaseSupervisor(object):
     
     def __init__(self, config):
@@ -82,11 +850,28 @@ class BaseSupervisor(object):
         self.config = config
         # boot the model
         mplane.model.initialize_registry(self.config["component"]["registry_uri"])
+        mplane.model.set_token_digest(self.config.get("component", "token_digest",
+                                                      fallback=mplane.model.DIGEST_MD5))
         tls_state = mplane.tls.TlsState(config)
 
         self.from_cli = queue.Queue()
-        self._lock = threading.RLock()
-        self._spec_messages = dict()
+        self._pending = PendingResultTable()
+        self._caps_lock = threading.Lock()
+        self._fanouts = {}
+        self._reductions = DEFAULT_REDUCTIONS
+        self._group_by = None
+        if self.config.has_section("reductions"):
+            reductions = [(k, v) for (k, v) in self.config.items("reductions")
+                          if k != "group_by"]
+            if reductions or not self.config.has_option("reductions", "group_by"):
+                self._reductions = reductions
+            if self.config.has_option("reductions", "group_by"):
+                self._group_by = [column.strip() for column in
+                                  self.config["reductions"]["group_by"].split(",")
+                                  if column.strip()]
+        self._fanout_executor = concurrent.futures.ThreadPoolExecutor(
+                self.config.getint("supervisor", "fanout_concurrency",
+                                   fallback=DEFAULT_FANOUT_CONCURRENCY))
         self._io_loop = tornado.ioloop.IOLoop.instance()
         if self.config["client"]["workflow"] == "component-initiated":
             self.cli_workflow = "component-initiated"
@@ -97,7 +882,11 @@ class BaseSupervisor(object):
         elif self.config["client"]["workflow"] == "client-initiated":
             self.cli_workflow = "client-initiated"
             self._client = mplane.client.HttpInitiatorClient(tls_state=tls_state, supervisor=True,
-                                                             exporter=self.from_cli)
+                                                             exporter=self.from_cli,
+                                                             message_format=mplane.utils.message_format(
+                                                                 self.config, "client"),
+                                                             compression=mplane.utils.HttpCompression.from_config(
+                                                                 self.config, "client"))
             self._urls = self.config["client"]["component-urls"].split(",")
         else:
             raise ValueError("workflow setting in " + args.CONF + " can only be 'client-initiated' or 'component-initiated'")
@@ -122,70 +911,95 @@ class BaseSupervisor(object):
             t_poll = Thread(target=self.poll_in_background)
             t_poll.daemon = True
             t_poll.start()
-        while True:
-            if not self.from_cli.empty():
-                [msg, identity] = self.from_cli.get()
-                self.handle_message(msg, identity)
+
+        # handle messages from components as they arrive
+        self._dispatcher = Dispatcher(self.from_cli, self.handle_message,
+                                      self.config.getint("supervisor", "dispatch_workers",
+                                                         fallback=DEFAULT_DISPATCH_WORKERS))
+        stats_interval = self.config.getfloat("supervisor", "stats_interval",
+                                              fallback=0)
+        if stats_interval > 0:
+            while True:
+                sleep(stats_interval)
+                print("Dispatcher: %(handled)d handled (%(rate).1f/s), "
+                      "%(failed)d failed, queue %(queue_depth)d "
+                      "(max %(max_queue_depth)d)" % self._dispatcher.stats())
+        else:
+            self._dispatcher.join()
+
+    def stats(self):
+        """ Returns the counters of the message dispatcher """
+        return self._dispatcher.stats()
 
     def handle_message(self, msg, identity):
         if isinstance(msg, mplane.model.Capability):
-            if [msg.get_label(), identity] not in self._caps:
+            with self._caps_lock:
+                if [msg.get_label(), identity] in self._caps:
+                    return
                 self._caps.append([msg.get_label(), identity])
-                serv = RelayService(msg, identity, self._client,
-                                    self._lock, self._spec_messages)
-                self._component.scheduler.add_service(serv)
-                if self.comp_workflow == "component-initiated":
-                    self._component.register_to_client([serv.capability()])
+            serv = RelayService(msg, identity, self._client, self._pending)
+            self._component.scheduler.add_service(serv)
+            if self.comp_workflow == "component-initiated":
+                self._component.register_to_client([serv.capability()])
+            self._add_fanout(msg)
 
         elif isinstance(msg, mplane.model.Receipt):
             pass
             
         elif (isinstance(msg, mplane.model.Result) or
             isinstance(msg, mplane.model.Exception)):
-            with self._lock:
-                mplane.utils.add_value_to(self._spec_messages, identity, msg)
+            self._pending.complete(identity, msg)
             
         elif isinstance(msg, mplane.model.Withdrawal):
             # not yet implemented
             pass
 
         elif isinstance(msg, mplane.model.Envelope):
-            for imsg in msg.messages():
-                if isinstance(imsg, mplane.model.Result):
-                    mplane.utils.add_value_to(self._spec_messages, identity, msg)
-                    break
-                else:
+            if msg.get_token() is not None:
+                # results of a multi-job specification
+                self._pending.complete(identity, msg)
+            else:
+                for imsg in msg.messages():
                     self.handle_message(imsg, identity)
         else:
             raise ValueError("Internal error: unknown message "+repr(msg))
 
+    def _add_fanout(self, cap):
+        """
+        Offers a capability relaying specifications to all components
+        with the schema of the given capability, once there are two of
+        them, or widens the one offered to the new capability
+        """
+        with self._caps_lock:
+            serv = self._fanouts.get(cap._schema_hash())
+            if serv is not None:
+                if not serv.update_capability():
+                    return
+            elif len(_schema_providers(self._client, cap)) < 2:
+                return
+            else:
+                try:
+                    serv = FanoutService(cap, self._client, self._pending,
+                                         self._fanout_executor,
+                                         self.config.getfloat("supervisor", "fanout_timeout",
+                                                              fallback=DEFAULT_FANOUT_TIMEOUT),
+                                         self._reductions, self._group_by)
+                except (KeyError, ValueError) as e:
+                    print("Cannot fan " + cap.get_label() + " out: " + str(e))
+                    return
+                self._fanouts[cap._schema_hash()] = serv
+                self._component.scheduler.add_service(serv)
+        # registering again replaces the capability, which keeps its token
+        if self.comp_workflow == "component-initiated":
+            self._component.register_to_client([serv.capability()])
+
     def listen_in_background(self):
         """ Start the listening server """
         self._io_loop.start()
 
     def poll_in_background(self):
         """ Periodically poll components """
-        while True:
-            for url in self._urls:
-                try:
-                    self._client.retrieve_capabilities(url)
-                except:
-                    print(str(url) + " unreachable. Retrying in 5 seconds")
-
-            # poll for results
-            for label in self._client.receipt_labels():
-                self._client.result_for(label)
-
-            for token in self._client.receipt_tokens():
-                self._client.result_for(token)
-
-            for label in self._client.result_labels():
-                self._client.result_for(label)
-
-            for token in self._client.result_tokens():
-                self._client.result_for(token)
-
-            sleep(5)
+        ComponentPoller.from_config(self._client, self._urls, self.config).run()
 
 if __name__ == "__main__":
     # look for TLS configuration
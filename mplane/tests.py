@@ -26,6 +26,7 @@ from mplane import azn
 from mplane import tls
 from mplane import model
 from mplane import utils
+from mplane import scheduler
 import configparser
 from os import path
 
@@ -176,6 +177,39 @@ def test_TLSState_extract_local_identity():
     assert_equal(local_identity, forged_identity)
 
 
+def test_TLSState_pool_stats():
+    config = get_config(config_path_no_tls)
+    config.read_dict({"connections": {"max_connections": "4"}})
+    state = tls.TlsState(config=config)
+    pool = state.pool_for("http", host, port)
+    assert_true(state.pool_for(None, host, port) is pool)
+    assert_equal(pool.pool.maxsize, 4)
+    assert_equal(state.pool_stats(),
+                 {("http", host, port): {"requests": 0, "connections": 0,
+                                         "reused": 0, "idle": 0}})
+    assert_equal(state._get_pool_manager().pools._maxsize, tls.DEFAULT_MAX_POOLS)
+    # a supervisor keeps a pool for each of its components
+    config.read_dict({"client": {"component-urls": ",".join(
+        "http://10.0.%d.%d:8888/" % (i // 250, i % 250) for i in range(1500))}})
+    state = tls.TlsState(config=config)
+    assert_equal(state._get_pool_manager().pools._maxsize, 1501)
+
+def test_TLSState_peer_identity_cache():
+    peer = urllib3.util.url.parse_url("https://127.0.0.1:1")
+    # a cached identity needs no handshake
+    tls_with_file._peer_identities[(peer.host, peer.port)] = "org.example.peer"
+    assert_equal(tls_with_file.extract_peer_identity(peer), "org.example.peer")
+    tls_with_file.forget_peer_identity(peer)
+    assert_raises(OSError, tls_with_file.extract_peer_identity, peer)
+    assert_equal(tls_with_file_no_tls.extract_response_identity(None, peer), tls.DUMMY_DN)
+    # a new connection refreshes the identity of its peer
+    tls_with_file._handshake_seen((peer.host, peer.port),
+                                  {"subject": ((("organizationName", "org"),),
+                                               (("commonName", "new"),))})
+    assert_equal(tls_with_file.extract_peer_identity(peer), "org.new")
+    tls_with_file.forget_peer_identity(peer)
+
+
 s_cert = utils.search_path(path.join(conf_dir, "Supervisor-SSB.crt"))
 s_key = utils.search_path(path.join(conf_dir, "Supervisor-SSB-plaintext.key"))
 s_ca_chain = utils.search_path(path.join(conf_dir, "root-ca.crt"))
@@ -222,6 +256,1098 @@ def test_peer_identity():
         print("\nWaiting for Tornado to stop...")
         time.sleep(0.5)
 
+###
+### scheduler.py tests
+###
+
+def test_TimerDispatcher_order():
+    dispatcher = scheduler.TimerDispatcher()
+    fired = []
+    done = threading.Event()
+    dispatcher.schedule(0.2, fired.append, "late")
+    dispatcher.schedule(0.05, fired.append, "early")
+    cancelled = dispatcher.schedule(0.1, fired.append, "cancelled")
+    dispatcher.cancel(cancelled)
+    dispatcher.schedule(0.3, done.set)
+    assert_true(done.wait(2))
+    assert_equal(fired, ["early", "late"])
+    assert_equal(dispatcher.pending(), 0)
+    dispatcher.stop()
+
+
+def test_TimerDispatcher_single_thread():
+    dispatcher = scheduler.TimerDispatcher()
+    # threads of earlier tests may still be exiting
+    before = set(threading.enumerate())
+    for i in range(500):
+        dispatcher.schedule(60, lambda: None)
+    assert_equal(len(set(threading.enumerate()) - before), 1)
+    assert_equal(dispatcher.pending(), 500)
+    dispatcher.stop()
+
+def test_TimerDispatcher_cancel_compacts():
+    dispatcher = scheduler.TimerDispatcher()
+    # rescheduling a long timer does not keep the cancelled ones
+    entry = dispatcher.schedule(3600, lambda: None)
+    for i in range(1000):
+        dispatcher.cancel(entry)
+        entry = dispatcher.schedule(3600, lambda: None)
+    assert_equal(dispatcher.pending(), 1)
+    assert_true(len(dispatcher._heap) <= 2)
+    fired = threading.Event()
+    dispatcher.cancel(dispatcher.schedule(0, lambda: None))
+    dispatcher.schedule(0.01, fired.set)
+    assert_true(fired.wait(2))
+    dispatcher.stop()
+
+def test_Job_cancels_interrupt_timer():
+    model.initialize_registry()
+    cap = model.Capability(label="test-blocking", when="now ... future")
+    cap.add_parameter("destination.ip4")
+    gate = threading.Event()
+    gate.set()
+    dispatcher = scheduler.TimerDispatcher()
+    executor = scheduler.JobExecutor(pool_size=1)
+    jobs = []
+    for i in range(10):
+        spec = model.Specification(capability=cap, when="now + 1h")
+        spec.set_parameter_value("destination.ip4", "10.0.0.%d" % (i + 1))
+        job = scheduler.Job(_BlockingService(cap, gate), spec,
+                            dispatcher=dispatcher, executor=executor)
+        job.schedule()
+        jobs.append(job)
+    for i in range(100):
+        if all(job.finished() for job in jobs):
+            break
+        time.sleep(0.01)
+    # jobs done before the end of their scope leave no timer behind
+    assert_true(all(job.finished() for job in jobs))
+    assert_equal(dispatcher.pending(), 0)
+    assert_true(len(dispatcher._heap) <= 5)
+    dispatcher.stop()
+
+class _BlockingService(scheduler.Service):
+    def __init__(self, cap, gate):
+        super(_BlockingService, self).__init__(cap)
+        self.gate = gate
+
+    def run(self, spec, check_interrupt):
+        self.gate.wait(5)
+        return model.Result(specification=spec)
+
+
+def test_JobExecutor_max_concurrency():
+    model.initialize_registry()
+    cap = model.Capability(label="test-blocking")
+    cap.add_parameter("destination.ip4")
+    gate = threading.Event()
+    service = _BlockingService(cap, gate)
+    service.set_max_concurrency(1)
+    executor = scheduler.JobExecutor(pool_size=4)
+    jobs = []
+    for dst in ("10.0.0.1", "10.0.0.2", "10.0.0.3"):
+        spec = model.Specification(capability=cap)
+        spec.set_parameter_value("destination.ip4", dst)
+        job = scheduler.Job(service, spec, executor=executor)
+        jobs.append(job)
+        executor.submit(job)
+    time.sleep(0.2)
+    assert_equal(executor.running(service), 1)
+    assert_equal(executor.queue_position(jobs[0]), 0)
+    assert_equal(executor.queue_position(jobs[2]), 2)
+    assert_equal(jobs[2].get_reply().get_queue_position(), 2)
+    rcpt = model.parse_json(model.unparse_json(jobs[2].get_reply()))
+    assert_equal(rcpt.get_queue_position(), 2)
+    gate.set()
+    time.sleep(0.2)
+    assert_true(all(job.finished() for job in jobs))
+    assert_equal(executor.queue_length(), 0)
+
+def test_Job_add_done_callback():
+    model.initialize_registry()
+    cap = model.Capability(label="test-blocking")
+    cap.add_parameter("destination.ip4")
+    gate = threading.Event()
+    spec = model.Specification(capability=cap)
+    spec.set_parameter_value("destination.ip4", "10.0.0.1")
+    executor = scheduler.JobExecutor(pool_size=1)
+    job = scheduler.Job(_BlockingService(cap, gate), spec, executor=executor)
+    done = []
+    job.add_done_callback(done.append)
+    executor.submit(job)
+    time.sleep(0.1)
+    assert_equal(done, [])
+    gate.set()
+    time.sleep(0.1)
+    assert_equal(done, [job])
+    # callbacks added once the job is done are called immediately
+    job.add_done_callback(done.append)
+    assert_equal(done, [job, job])
+
+def test_Scheduler_submit_job():
+    model.initialize_registry()
+    gate = threading.Event()
+    gate.set()
+    sched = scheduler.Scheduler()
+    services = []
+    for (label, param, when) in (("test-ip4-past", "destination.ip4", "past ... 2000-01-01"),
+                                 ("test-ip4", "destination.ip4", "now ... future"),
+                                 ("test-ip6", "destination.ip6", "now ... future")):
+        cap = model.Capability(label=label, when=when)
+        cap.add_parameter(param)
+        service = _BlockingService(cap, gate)
+        services.append(service)
+        sched.add_service(service)
+    spec = model.Specification(capability=services[1].capability())
+    spec.set_parameter_value("destination.ip4", "10.0.0.1")
+    reply = sched.submit_job(None, spec)
+    assert_true(isinstance(reply, model.Receipt))
+    assert_equal(sched.job_for_message(reply).service, services[1])
+    cap = model.Capability(label="test-none")
+    cap.add_parameter("source.ip4")
+    spec = model.Specification(capability=cap)
+    spec.set_parameter_value("source.ip4", "10.0.0.1")
+    assert_true(isinstance(sched.submit_job(None, spec), model.Exception))
+
+def test_Scheduler_add_service_concurrently():
+    import concurrent.futures
+    model.initialize_registry()
+    gate = threading.Event()
+    gate.set()
+    sched = scheduler.Scheduler()
+    def add(i):
+        cap = model.Capability(label="test-add-%d" % i)
+        cap.add_parameter("destination.ip4", "10.0.%d.1" % i)
+        sched.add_service(_BlockingService(cap, gate))
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        added = executor.map(add, range(200))
+        # listing capabilities never sees the cache changing under it
+        while len(sched.capability_keys()) < 200:
+            for key in sched.capability_keys():
+                sched.capability_for_key(key)
+        list(added)
+    assert_equal(len(sched.services), 200)
+    assert_equal(sum(map(len, sched._service_index.values())), 200)
+
+class _SleepingAsyncService(scheduler.AsyncService):
+    async def run(self, spec):
+        import asyncio
+        res = model.Result(specification=spec)
+        try:
+            await asyncio.sleep(float(spec.get_parameter_value("duration.s")))
+            res.set_result_value("octets.ip", 1)
+        except asyncio.CancelledError:
+            res.set_result_value("octets.ip", 0)
+        return res
+
+
+def test_AsyncService():
+    model.initialize_registry()
+    cap = model.Capability(label="test-async")
+    cap.add_parameter("duration.s")
+    cap.add_result_column("octets.ip")
+    executor = scheduler.JobExecutor(pool_size=1)
+    service = _SleepingAsyncService(cap)
+    jobs = []
+    for duration in ("0.1", "10"):
+        spec = model.Specification(capability=cap)
+        spec.set_parameter_value("duration.s", duration)
+        job = scheduler.Job(service, spec, executor=executor)
+        jobs.append(job)
+        executor.submit(job)
+    # a thread-based job runs next to the coroutines
+    gate = threading.Event()
+    gate.set()
+    blocking_cap = model.Capability(label="test-blocking")
+    blocking_cap.add_parameter("destination.ip4")
+    spec = model.Specification(capability=blocking_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.0.1")
+    blocking_job = scheduler.Job(_BlockingService(blocking_cap, gate), spec,
+                                 executor=executor)
+    executor.submit(blocking_job)
+    time.sleep(0.3)
+    assert_true(jobs[0].finished())
+    assert_false(jobs[1].finished())
+    assert_true(blocking_job.finished())
+    jobs[1].interrupt()
+    time.sleep(0.1)
+    assert_true(jobs[1].finished())
+    assert_equal(jobs[1].result._resultcolumns["octets.ip"][0], 0)
+    assert_equal(executor.running(), 0)
+
+class _ProcessService(scheduler.Service):
+    def run(self, spec, check_interrupt):
+        import os
+        while not check_interrupt():
+            time.sleep(0.01)
+        res = model.Result(specification=spec)
+        res.set_result_value("octets.ip", os.getpid())
+        return res
+
+def test_Statement_pickle():
+    import pickle
+    model.initialize_registry()
+    cap = model.Capability(label="test-pickle", when="now ... future / 1s")
+    cap.add_parameter("destination.ip4", "10.0.0.1,10.0.0.2")
+    cap.add_metadata("System_type", "test")
+    cap.add_result_column("delay.twoway.icmp.us")
+    spec = model.Specification(capability=cap)
+    spec.set_parameter_value("destination.ip4", "10.0.0.2")
+    res = model.Result(specification=spec)
+    res.set_when("2017-01-01 ... 2017-01-01 00:01:00")
+    res.set_result_value("delay.twoway.icmp.us", 42)
+    res.set_result_value("delay.twoway.icmp.us", 43, 1)
+    for stmt in (cap, spec, res):
+        copy = pickle.loads(pickle.dumps(stmt))
+        assert_equal(type(copy), type(stmt))
+        assert_equal(model.unparse_json(copy), model.unparse_json(stmt))
+        assert_equal(copy.when().period(), stmt.when().period())
+
+def test_Statement_hash_cache():
+    model.initialize_registry()
+    cap = model.Capability(label="test-hash")
+    cap.add_parameter("destination.ip4")
+    spec = model.Specification(capability=cap)
+    spec.set_parameter_value("destination.ip4", "10.0.0.1")
+    token = spec.get_token()
+    schema = spec._schema_hash()
+    assert_equal(spec._pv_hash(), token)
+    spec.set_parameter_value("destination.ip4", "10.0.0.2")
+    assert_true(spec._pv_hash() != token)
+    spec.add_result_column("octets.ip")
+    assert_true(spec._schema_hash() != schema)
+    schema = spec._schema_hash()
+    assert_equal(model.Specification(dictval=spec.to_dict())._schema_hash(),
+                 schema)
+    model.set_token_digest(model.DIGEST_BLAKE2B)
+    try:
+        assert_equal(model.token_digest(), "blake2b")
+        assert_equal(len(spec._schema_hash()), len(schema))
+        assert_true(spec._schema_hash() != schema)
+    finally:
+        model.set_token_digest()
+    assert_equal(spec._schema_hash(), schema)
+    # salted hashes are not cached, so the cache stays bounded
+    salted = [spec._mpcv_hash(astr="probe-%d" % i) for i in range(100)]
+    assert_equal(len(set(salted)), 100)
+    assert_equal(spec._mpcv_hash(astr="probe-0"), salted[0])
+    assert_true(len(spec._hashes) <= 4)
+
+def test_Statement_copy_on_write():
+    model.initialize_registry()
+    cap = model.Capability(label="test-cow", when="now ... future")
+    cap.add_parameter("destination.ip4")
+    cap.add_metadata("System_type", "test")
+    cap.add_result_column("octets.ip")
+    spec = model.Specification(capability=cap)
+    assert_true(spec._resultcolumns is cap._resultcolumns)
+    spec.set_parameter_value("destination.ip4", "10.0.0.1")
+    rcpt = model.Receipt(specification=spec)
+    assert_true(rcpt._params is spec._params)
+    res = model.Result(specification=spec)
+    res.set_result_value("octets.ip", 1)
+    spec.set_parameter_value("destination.ip4", "10.0.0.2")
+    spec.add_metadata("System_ID", "test-1")
+    assert_equal(cap.get_parameter_value("destination.ip4"), None)
+    assert_equal(rcpt.get_parameter_value("destination.ip4").exploded, "10.0.0.1")
+    assert_equal(res.get_parameter_value("destination.ip4").exploded, "10.0.0.1")
+    assert_equal(cap.count_metadata(), 1)
+    assert_equal(cap.count_result_rows(), 0)
+    assert_equal(spec.count_result_rows(), 0)
+    assert_equal(res.count_result_rows(), 1)
+    # each subspecification is a distinct statement
+    spec.set_when("repeat now + 1m / 10s { now + 5s }")
+    subspecs = spec.subspec_iterator()
+    first = next(subspecs)
+    second = next(subspecs)
+    assert_true(first is not second)
+    assert_true(first.when() != second.when())
+    assert_true(first.get_token() != second.get_token())
+
+def test_ResultColumn_storage():
+    from datetime import datetime
+    from ipaddress import ip_address
+    model.initialize_registry()
+    cap = model.Capability(label="test-columns")
+    for col in ("octets.ip", "cpuload", "start", "source.ip4", "source.interface"):
+        cap.add_result_column(col)
+    res = model.Result(specification=model.Specification(capability=cap))
+    res.set_when("2017-01-01 ... 2017-01-01 00:01:00")
+    t0 = datetime(2017, 1, 1, 0, 0, 0, 123456)
+    values = {"octets.ip": [1, None, 2**40],
+              "cpuload": [0.5, None, 1.25],
+              "start": [t0, datetime(2017, 1, 1), datetime(1960, 1, 1)],
+              "source.ip4": [ip_address("10.0.0.1"), None, ip_address("2001:db8::1")],
+              "source.interface": ["eth0", None, "eth1"]}
+    for (name, vals) in values.items():
+        res.set_result_value(name, vals[0], 0)
+        res.set_result_value(name, vals[2], 2)
+        if vals[1] is not None:
+            res.set_result_value(name, vals[1], 1)
+    for (name, vals) in values.items():
+        col = res._resultcolumns[name]
+        assert_equal(len(col), 3)
+        assert_equal(list(col), vals)
+        assert_equal(col[-1], vals[2])
+        assert_equal(col[0:2], vals[0:2])
+    assert_false(isinstance(res._resultcolumns["octets.ip"]._vals, list))
+    assert_false(isinstance(res._resultcolumns["source.ip4"]._vals, list))
+    res2 = model.parse_json(model.unparse_json(res))
+    for (name, vals) in values.items():
+        assert_equal(list(res2._resultcolumns[name]), vals)
+    # values which do not fit the typed storage fall back to a list
+    col = res._resultcolumns["octets.ip"]
+    col[1] = 2**70
+    assert_true(isinstance(col._vals, list))
+    assert_equal(list(col), [1, 2**70, 2**40])
+    del res._resultcolumns["source.ip4"][0]
+    assert_equal(list(res._resultcolumns["source.ip4"]),
+                 [None, ip_address("2001:db8::1")])
+
+def test_Result_append_rows():
+    from datetime import datetime
+    from ipaddress import ip_address
+    model.initialize_registry()
+    cap = model.Capability(label="test-append")
+    for col in ("start", "source.ip4", "octets.ip", "cpuload"):
+        cap.add_result_column(col)
+    res = model.Result(specification=model.Specification(capability=cap))
+    t0 = datetime(2017, 1, 1)
+    res.append_rows([(t0, ip_address("10.0.0.1"), 1, 0.5),
+                     (t0, ip_address("10.0.0.2"), 2, 1.5)])
+    res.append_rows([(3, "10.0.0.3")], columns=["octets.ip", "source.ip4"])
+    res.extend_column("cpuload", [2.5])
+    assert_equal(res.count_result_rows(), 3)
+    assert_equal(list(res._resultcolumns["octets.ip"]), [1, 2, 3])
+    assert_equal(list(res._resultcolumns["source.ip4"]),
+                 [ip_address("10.0.0.1"), ip_address("10.0.0.2"),
+                  ip_address("10.0.0.3")])
+    assert_equal(list(res._resultcolumns["start"]), [t0, t0])
+    assert_equal(list(res._resultcolumns["cpuload"]), [0.5, 1.5, 2.5])
+    # rows are appended after the longest column; nulls fill the gap
+    res.extend_column("octets.ip", ["4"])
+    res.append_rows([(None, 5)], columns=["source.ip4", "octets.ip"])
+    assert_equal(list(res._resultcolumns["octets.ip"]), [1, 2, 3, 4, 5])
+    assert_equal(res._resultcolumns["source.ip4"][4], None)
+    assert_raises(ValueError, res.append_rows, [(1,)], ["packets.ip"])
+    assert_raises(ValueError, res.append_rows, [(1, 2)], ["octets.ip"])
+
+def test_Result_lazy_decode():
+    from ipaddress import ip_address
+    model.initialize_registry()
+    cap = model.Capability(label="test-lazy")
+    cap.add_result_column("octets.ip")
+    cap.add_result_column("source.ip4")
+    res = model.Result(specification=model.Specification(capability=cap))
+    res.set_when("2017-01-01 ... 2017-01-02")
+    res.append_rows([(1, "10.0.0.1"), (2, "10.0.0.2")])
+    d = res.to_dict()
+    d[model.KEY_RESULTVALUES][1][0] = "02"
+    res2 = model.message_from_dict(d)
+    cols = res2._resultcolumns
+    # undecoded values are passed through when serialized again
+    assert_true(cols["source.ip4"]._raw is not None)
+    assert_equal(res2.count_result_rows(), 2)
+    assert_equal(res2.to_dict()[model.KEY_RESULTVALUES],
+                 d[model.KEY_RESULTVALUES])
+    # decoding a column by reading it does not modify it
+    assert_equal(list(cols["octets.ip"]), [1, 2])
+    assert_true(cols["source.ip4"]._raw is not None)
+    assert_true(res2._result_rows() is d[model.KEY_RESULTVALUES])
+    # modified results are serialized from the decoded values
+    cols["source.ip4"][1] = "10.0.0.3"
+    assert_equal(res2.to_dict()[model.KEY_RESULTVALUES],
+                 [["1", "10.0.0.1"], ["2", "10.0.0.3"]])
+    assert_equal(list(cols["source.ip4"])[0], ip_address("10.0.0.1"))
+
+def test_iter_unparse_json():
+    model.initialize_registry()
+    cap = model.Capability(label="test-stream")
+    cap.add_parameter("destination.ip4", "10.0.0.1")
+    cap.add_result_column("octets.ip")
+    cap.add_result_column("source.ip4")
+    res = model.Result(specification=model.Specification(capability=cap))
+    res.set_parameter_value("destination.ip4", "10.0.0.1")
+    res.set_when("2017-01-01 ... 2017-01-02")
+    res.append_rows([(i, "10.0.0.%d" % (i % 200)) for i in range(2500)])
+    res.extend_column("octets.ip", [2500])
+    env = model.Envelope()
+    env.append_message(cap)
+    env.append_message(res)
+    for msg in (res, env, cap, model.Envelope()):
+        chunks = list(model.iter_unparse_json(msg, chunk_size=4096))
+        assert_equal("".join(chunks), model.unparse_json(msg))
+    # rows are written a batch at a time
+    chunks = list(model.iter_unparse_json(res, chunk_size=1))
+    assert_equal(len([chunk for chunk in chunks if len(chunk) > 10000]), 3)
+    res2 = model.parse_json(model.unparse_json(res))
+    assert_equal("".join(model.iter_unparse_json(res2)),
+                 model.unparse_json(res))
+    # compact mode
+    for msg in (res, env, cap):
+        compact = model.unparse_json(msg, compact=True)
+        assert_equal("".join(model.iter_unparse_json(msg, compact=True)),
+                     compact)
+        assert_false("\n" in compact)
+        assert_true(len(compact) < len(model.unparse_json(msg)))
+        assert_equal(model.unparse_json(model.parse_json(compact)),
+                     model.unparse_json(msg))
+        assert_equal(model.unparse_json(
+                        model.parse_json_stream([compact.encode("utf-8")])),
+                     model.unparse_json(msg))
+
+def test_message_media_type():
+    assert_true(utils.is_mplane_json("application/x-mplane+json"))
+    assert_true(utils.is_mplane_json("Application/X-mPlane+JSON; format=compact"))
+    assert_false(utils.is_mplane_json("application/json"))
+    assert_false(utils.is_mplane_json(None))
+    assert_true(utils.is_mplane_message(utils.MPLANE_CBOR_TYPE))
+    assert_equal(utils.parse_media_type(
+                    utils.message_media_type(utils.FORMAT_COMPACT_JSON)),
+                 ("application/x-mplane+json", {"format": "compact"}))
+    assert_equal(utils.reply_format(
+        "text/html, application/x-mplane+json;format=compact;q=0.9"),
+        utils.FORMAT_COMPACT_JSON)
+    assert_equal(utils.reply_format("application/x-mplane+json, "
+                                    "application/x-mplane+cbor"),
+                 utils.FORMAT_CBOR)
+    assert_equal(utils.reply_format("application/x-mplane+json"),
+                 utils.FORMAT_JSON)
+    assert_equal(utils.reply_format(
+        "application/x-mplane+json; format=compact; q=0"), utils.FORMAT_JSON)
+    assert_equal(utils.reply_format(None), utils.FORMAT_JSON)
+
+def test_cbor():
+    from datetime import datetime
+    from ipaddress import ip_address
+    from mplane import cbor
+    model.initialize_registry()
+    cap = model.Capability(label="test-cbor")
+    cap.add_parameter("destination.ip4", "10.0.0.1")
+    for col in ("start", "octets.ip", "source.ip4", "cpuload", "source.interface"):
+        cap.add_result_column(col)
+    res = model.Result(specification=model.Specification(capability=cap))
+    res.set_parameter_value("destination.ip4", "10.0.0.1")
+    res.set_when("2017-01-01 ... 2017-01-02")
+    res.append_rows([(datetime(2017, 1, 1, 0, 0, i, i), i, "10.0.0.%d" % i,
+                      i / 7, "eth0") for i in range(50)])
+    res.extend_column("source.ip4", ["2001:db8::1"])
+    env = model.Envelope()
+    env.append_message(cap)
+    env.append_message(res)
+    data = model.unparse_cbor(env)
+    assert_true(len(data) < len(model.unparse_json(env, compact=True)))
+    env2 = utils.parse_message(data, utils.MPLANE_CBOR_TYPE)
+    assert_equal(model.unparse_json(env2), model.unparse_json(env))
+    res2 = list(env2.messages())[1]
+    assert_equal(res2._resultcolumns["source.ip4"][50], ip_address("2001:db8::1"))
+    # the pure Python codec writes and reads the same encoding
+    cbor2 = cbor.cbor2
+    try:
+        cbor.cbor2 = None
+        assert_equal(model.unparse_cbor(env), data)
+        assert_equal(model.unparse_json(model.parse_cbor(data)),
+                     model.unparse_json(env))
+        assert_equal(cbor.loads(bytes.fromhex("9f01bf6161f5ff5f4101ff7f6161ffff")),
+                     [1, {"a": True}, b"\x01", "a"])
+        assert_equal(cbor.loads(cbor.dumps(-2**70)), -2**70)
+        assert_raises(ValueError, cbor.loads, data[:-1])
+    finally:
+        cbor.cbor2 = cbor2
+
+def test_HttpCompression():
+    import gzip
+    config = configparser.ConfigParser()
+    config.read_string("[component]\ncompression_level = 9\n")
+    compression = utils.HttpCompression.from_config(config, "component")
+    assert_equal((compression.level, compression.threshold), (9, 1024))
+    transform = compression.transform()
+    assert_equal((transform.GZIP_LEVEL, transform.MIN_LENGTH), (9, 1024))
+    assert_raises(ValueError, utils.HttpCompression, 10)
+    # request bodies are only compressed once the peer accepts it
+    body = b"x" * 2000
+    headers = {}
+    assert_equal(compression.encode_request(body, headers, "peer", 80), body)
+    assert_equal(headers, {"Accept-Encoding": "gzip"})
+    class Response(object):
+        headers = {"Accept-Encoding": "gzip"}
+    compression.learn(Response(), "peer", 80)
+    headers = {}
+    assert_equal(gzip.decompress(compression.encode_request(body, headers, "peer", 80)), body)
+    assert_equal(headers["Content-Encoding"], "gzip")
+    headers = {}
+    assert_equal(compression.encode_request(b"x", headers, "peer", 80), b"x")
+    assert_false("Content-Encoding" in headers)
+    headers = {}
+    assert_equal(utils.HttpCompression(0).encode_request(body, headers, "peer", 80), body)
+    assert_equal(headers, {})
+    # only the most recent peers are remembered
+    compression = utils.HttpCompression(max_peers=2)
+    for port in (80, 81, 80, 82):
+        compression.learn(Response(), "peer", port)
+    assert_equal(list(compression._peers), [("peer", 80), ("peer", 82)])
+    Response.headers = {}
+    compression.learn(Response(), "peer", 80)
+    assert_equal(list(compression._peers), [("peer", 82)])
+
+def test_SpecificationHandler_long_poll():
+    import asyncio
+    import tornado.httpclient
+    from mplane import client
+    model.initialize_registry()
+    config = configparser.ConfigParser()
+    config.read_string("[client]\nlisten-port = 18891\nlong_poll_wait = 5\n")
+    cap = model.Capability(label="test-long-poll")
+    cap.add_result_column("octets.ip")
+    url = "http://127.0.0.1:18891/" + client.DEFAULT_SPECIFICATION_PATH
+
+    async def poll():
+        listener = client.HttpListenerClient(config, tls_with_file_no_tls,
+                                             io_loop=tornado.ioloop.IOLoop.current())
+        http = tornado.httpclient.AsyncHTTPClient()
+        # without a wait preference, the poll is answered right away
+        res = await http.fetch(url)
+        assert_equal(len(model.parse_json(res.body.decode("utf-8"))), 0)
+        # otherwise, it is held until a specification is queued
+        spec = model.Specification(capability=cap)
+        threading.Timer(0.2, listener._push_outgoing,
+                        (tls.DUMMY_DN, spec)).start()
+        start = time.time()
+        res = await http.fetch(url, headers={"Prefer": "wait=30"})
+        assert_true(0.1 < time.time() - start < 2)
+        assert_equal(res.headers["Preference-Applied"], "wait=5")
+        env = model.parse_json(res.body.decode("utf-8"))
+        assert_equal([msg.get_label() for msg in env.messages()], ["test-long-poll"])
+        assert_equal(listener._outgoing_waiters, {})
+
+    asyncio.run(poll())
+    assert_equal(utils.preferred_wait("respond-async, wait=10"), 10)
+    assert_equal(utils.preferred_wait("respond-async"), None)
+
+class _Response(object):
+    def __init__(self, status):
+        self.status = status
+        self.data = b""
+
+def test_ResultUplink():
+    from mplane import component
+    model.initialize_registry()
+    cap = model.Capability(label="test-uplink")
+    cap.add_result_column("octets.ip")
+    gate = threading.Event()
+    posts = []
+    reports = []
+    def post(msg):
+        gate.wait()
+        posts.append(msg)
+        # the first post fails, and is retried
+        return _Response(503 if len(posts) == 1 else 200)
+    uplink = component.ResultUplink(post, lambda replies, res: reports.append(len(replies)),
+                                    batch_size=4, queue_rows=10, backoff=0.01)
+    results = []
+    for i in range(12):
+        res = model.Result(specification=model.Specification(capability=cap))
+        res.set_label("test-uplink-%d" % i)
+        res.set_when("2017-01-01 ... 2017-01-02")
+        res.extend_column("octets.ip", range(i % 3 + 1))
+        results.append(res)
+        uplink.put(res)
+    # replies beyond the memory limit wait in the spill file
+    assert_true(uplink.spilled() > 0)
+    assert_equal(uplink.pending(), 12)
+    gate.set()
+    for i in range(100):
+        if uplink.pending() == 0:
+            break
+        time.sleep(0.01)
+    assert_equal(uplink.pending(), 0)
+    assert_equal(sum(reports), 12)
+    assert_true(len(reports) < 12)
+    sent = []
+    for msg in posts[1:]:
+        if isinstance(msg, model.Envelope):
+            sent.extend(msg.messages())
+        else:
+            sent.append(msg)
+    assert_equal([msg.get_label() for msg in sent],
+                 [res.get_label() for res in results])
+    assert_equal([list(msg._resultcolumns["octets.ip"]) for msg in sent],
+                 [list(res._resultcolumns["octets.ip"]) for res in results])
+
+def test_ResultUplink_failures():
+    from mplane import component
+    model.initialize_registry()
+    cap = model.Capability(label="test-uplink")
+    cap.add_result_column("octets.ip")
+    posts = []
+    reports = []
+    def post(msg):
+        posts.append(msg.get_label())
+        if msg.get_label() == "bad":
+            raise ValueError("cannot unparse")
+        return _Response(503 if msg.get_label() == "down" else 200)
+    uplink = component.ResultUplink(post, lambda replies, res: reports.append(replies),
+                                    batch_size=1, backoff=0.01, max_retries=2)
+    for label in ("bad", "down", "good"):
+        res = model.Result(specification=model.Specification(capability=cap))
+        res.set_label(label)
+        uplink.put(res)
+    for i in range(200):
+        if uplink.pending() == 0:
+            break
+        time.sleep(0.01)
+    # neither an error nor a peer which keeps failing stops the sender
+    assert_equal(posts, ["bad", "down", "down", "down", "good"])
+    assert_equal([replies[0].get_label() for replies in reports], ["good"])
+    # an empty envelope is reported by its own label
+    component.InitiatorHttpComponent._report_replies(
+        None, [model.Envelope(label="empty")], _Response(200))
+
+def test_PendingResultTable():
+    from concurrent.futures import TimeoutError
+    from mplane import supervisor
+    model.initialize_registry()
+    cap = model.Capability(label="test-relay")
+    cap.add_result_column("octets.ip")
+    pending = supervisor.PendingResultTable()
+    results = []
+    for i in range(2):
+        spec = model.Specification(capability=cap)
+        spec.set_when("2017-01-01 ... 2017-01-0%d" % (i + 2))
+        results.append(model.Result(specification=spec))
+    # a result arriving first is kept for its waiter
+    pending.complete("probe", results[0])
+    assert_true(pending.wait("probe", results[0].get_token()) is results[0])
+    # a waiter is woken as soon as its result arrives
+    threading.Timer(0.1, pending.complete, ("probe", results[1])).start()
+    start = time.time()
+    assert_true(pending.wait("probe", results[1].get_token(), 5) is results[1])
+    assert_true(time.time() - start < 1)
+    assert_raises(TimeoutError, pending.wait, "other", results[1].get_token(), 0.01)
+    pending.discard("other", results[1].get_token())
+    assert_equal(len(pending), 0)
+    # unawaited messages are only kept within bounds
+    pending = supervisor.PendingResultTable(ttl=60, max_early=1)
+    pending.complete("probe", results[0])
+    pending.complete("probe", results[1])
+    pending.complete("probe", model.Exception(errmsg="no token"))
+    assert_equal(len(pending), 1)
+    assert_raises(TimeoutError, pending.wait, "probe", results[0].get_token(), 0.01)
+    assert_true(pending.wait("probe", results[1].get_token(), 0) is results[1])
+    pending = supervisor.PendingResultTable(ttl=0)
+    pending.complete("probe", results[0])
+    assert_equal(len(pending), 0)
+
+def test_Dispatcher():
+    import queue
+    from mplane import supervisor
+    messages = queue.Queue()
+    handled = []
+    def handler(msg, identity):
+        if msg is None:
+            raise ValueError("no message")
+        handled.append((msg, identity))
+    for i in range(10):
+        messages.put([i, "probe"])
+    messages.put([None, "probe"])
+    dispatcher = supervisor.Dispatcher(messages, handler, workers=2)
+    for i in range(100):
+        if dispatcher.stats()["handled"] == 11:
+            break
+        time.sleep(0.01)
+    stats = dispatcher.stats()
+    assert_equal((stats["handled"], stats["failed"], stats["queue_depth"]), (11, 1, 0))
+    assert_true(stats["max_queue_depth"] > 1)
+    assert_equal(sorted(msg for (msg, identity) in handled), list(range(10)))
+
+def test_ResultReducer():
+    from mplane import supervisor
+    model.initialize_registry()
+    cap = model.Capability(label="test-reduce")
+    for column in ("probe.DN", "delay.twoway.icmp.us.min",
+                   "delay.twoway.icmp.us.mean", "delay.twoway.icmp.us.max",
+                   "delay.twoway.icmp.count", "bytes.forward"):
+        cap.add_result_column(column)
+    spec = model.Specification(capability=cap)
+    per_probe = supervisor.ResultReducer(spec, group_by=("probe.DN",))
+    overall = supervisor.ResultReducer(spec)
+    for day in range(1, 4):
+        for (probe, delay, count) in (("probe-1", 10, 4), ("probe-2", 20, 16)):
+            res = model.Result(specification=spec)
+            res.set_when("2017-01-0%d ... 2017-01-0%d" % (day, day + 1))
+            res.append_rows([(delay - day, delay, delay + day, count, 1000)] * 100,
+                            columns=list(spec.result_column_names())[1:])
+            env = model.Envelope()
+            env.append_message(res)
+            for reducer in (per_probe, overall):
+                reducer.add(env, {"probe.DN": probe})
+    # one row per group, however many were added
+    assert_equal(len(per_probe), 2)
+    assert_equal(len(overall), 1)
+    res = per_probe.result()
+    assert_equal(res.result_column_values("probe.DN"), ["probe-1", "probe-2"])
+    assert_equal(res.result_column_values("delay.twoway.icmp.us.min"), [7, 17])
+    assert_equal(res.result_column_values("delay.twoway.icmp.us.max"), [13, 23])
+    assert_equal(res.result_column_values("bytes.forward"), [300000, 300000])
+    # by default, rows of different components merge, and means are
+    # weighted by the count of their samples
+    res = overall.result()
+    assert_equal(res.result_column_values("probe.DN"), ["probe-1,probe-2"])
+    assert_equal(res.result_column_values("delay.twoway.icmp.us.mean"), [18])
+    assert_equal(res.result_column_values("delay.twoway.icmp.count"), [6000])
+    assert_equal(res.when().datetimes()[1].day, 4)
+
+    # without reductions, rows are concatenated
+    concat = supervisor.ResultReducer(spec, reductions=())
+    concat.add(per_probe.result())
+    concat.add(overall.result())
+    assert_equal(concat.result().count_result_rows(), 3)
+    assert_raises(ValueError, supervisor.ResultReducer, spec, (("bytes.*", "median"),))
+
+def test_HttpInitiatorClient_releases_connection():
+    from mplane import client
+    model.initialize_registry()
+    class FakeResponse(object):
+        status = 200
+        headers = {}
+        released = False
+        def getheader(self, name):
+            return "application/x-mplane+json"
+        def stream(self, amt):
+            yield b'{"result": "measure", '
+            raise urllib3.exceptions.ProtocolError("connection reset")
+        def drain_conn(self):
+            pass
+        def release_conn(self):
+            self.released = True
+    res = FakeResponse()
+    class FakePool(object):
+        def urlopen(self, *args, **kwargs):
+            return res
+    class FakeTlsState(object):
+        def pool_for(self, scheme, host, port):
+            return FakePool()
+        def forged_identity(self):
+            return None
+        def extract_response_identity(self, response, url):
+            return "probe-1"
+    initiator = client.HttpInitiatorClient(FakeTlsState(),
+                                           default_url="http://127.0.0.1:1/")
+    cap = model.Capability(label="test-release")
+    # a reply failing half-way through still hands the connection back
+    assert_raises(urllib3.exceptions.ProtocolError, initiator.send_message, cap)
+    assert_true(res.released)
+
+def test_BaseClient_multijob_export():
+    import queue
+    from mplane import client
+    model.initialize_registry()
+    exported = queue.Queue()
+    sup = client.BaseClient(tls_state=None, supervisor=True, exporter=exported)
+    cap = model.Capability(label="test-multijob", when="now ... future")
+    cap.add_result_column("delay.twoway.icmp.us")
+    spec = model.Specification(capability=cap, when="2017-01-01 ... 2017-01-02")
+    sup.handle_message(model.Receipt(specification=spec), "probe-1")
+    exported.get_nowait()
+    env = model.Envelope(token=spec.get_token(), when=spec.when())
+    env.append_message(model.Result(specification=spec))
+    # the envelope closing a multijob is exported once
+    sup.handle_message(env, "probe-1")
+    assert_true(exported.get_nowait()[0] is env)
+    assert_true(exported.empty())
+    assert_true(sup.result_for(spec.get_token()) is env)
+
+def test_BaseClient_concurrent_invocations():
+    import concurrent.futures
+    from mplane import client
+    model.initialize_registry()
+    class LabelClient(client.BaseClient):
+        _ssn = 0
+        def invoke_capability(self, cap_tol, when, params, relabel=None):
+            return self._spec_for(cap_tol, when, params, relabel)[1]
+    labels = LabelClient(tls_state=None)
+    cap = model.Capability(label="test-labels", when="now ... future")
+    cap.add_result_column("delay.twoway.icmp.us")
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        executor.map(lambda identity: labels.handle_message(
+            model.parse_json(model.unparse_json(cap)), identity),
+                     ["probe-%d" % i for i in range(50)])
+        specs = list(executor.map(lambda i: labels.invoke_capability(
+            "test-labels", "now ... future", {}), range(200)))
+    assert_equal(len(labels.capabilities_matching_schema(cap)), 50)
+    assert_equal(len(set(spec.get_label() for spec in specs)), 200)
+
+def test_FanoutService():
+    import concurrent.futures
+    from mplane import client, supervisor
+    model.initialize_registry()
+    pending = supervisor.PendingResultTable()
+    release = threading.Event()
+    sent = []
+    silent = set()
+    class FakeClient(client.BaseClient):
+        _ssn = 0
+        def invoke_capability(self, cap_tol, when, params, relabel=None, token=None):
+            (cap, spec) = self._spec_for(cap_tol, when, params, relabel, token)
+            sent.append(spec.get_token())
+            identity = self.identity_for(cap.get_token())
+            if identity == "probe-3":
+                # replies come with the identity of their connection
+                identity = "probe-3.example"
+                self.handle_message(model.Receipt(specification=spec), identity)
+            res = model.Result(specification=spec)
+            res.set_when("2017-01-01 ... 2017-01-02")
+            if identity == "probe-2":
+                res = model.Exception(token=spec.get_token(), errmsg="busy")
+            elif identity == "probe-1":
+                res.append_rows([(10,), (20,)])
+            else:
+                res.append_rows([(30,)])
+            def reply():
+                if identity == "probe-3.example":
+                    release.wait(5)
+                if identity not in silent:
+                    pending.complete(identity, res)
+            threading.Thread(target=reply).start()
+            return spec
+    fake = FakeClient(tls_state=None)
+    for (identity, last) in (("probe-1", 9), ("probe-2", 9), ("probe-3", 2)):
+        cap = model.Capability(label="test-fanout", when="now ... future")
+        cap.add_parameter("destination.ip4", "10.0.0.1 ... 10.0.0.%d" % last)
+        cap.add_result_column("delay.twoway.icmp.us")
+        fake.handle_message(cap, identity)
+    # identical capabilities of different components get tokens of their own
+    assert_equal(len(fake.capabilities_matching_schema(cap)), 3)
+    cap = fake.capabilities_matching_schema(cap)[0]
+    serv = supervisor.FanoutService(cap, fake, pending,
+                                    concurrent.futures.ThreadPoolExecutor(4))
+    agg = serv.capability()
+    assert_equal(agg.get_label(), "test-fanout-fanout")
+    assert_true(agg._schema_hash() != cap._schema_hash())
+
+    spec = model.Specification(capability=agg)
+    spec.set_when("now ... future")
+    spec.set_parameter_value("destination.ip4", "10.0.0.1")
+    assert_equal(len(serv.targets(spec)), 3)
+    spec.set_parameter_value("destination.ip4", "10.0.0.5")
+    assert_equal(sorted(identity for (c, identity) in serv.targets(spec)),
+                 ["probe-1", "probe-2"])
+    spec.set_parameter_value("destination.ip4", "10.0.0.1")
+
+    replies = []
+    job = threading.Thread(target=lambda: replies.append(serv.run(spec, lambda: False)))
+    job.start()
+    # the results of probe-1 are available before probe-3 replies
+    for i in range(100):
+        partial = serv.partial_reply(spec)
+        if partial is not None:
+            break
+        time.sleep(0.01)
+    assert_true(isinstance(partial, model.Envelope))
+    assert_equal(partial.get_token(), spec.get_token())
+    release.set()
+    job.join(5)
+    res = replies[0]
+    assert_equal(res.get_token(), spec.get_token())
+    # the delays of all components are reduced into one row
+    columns = ("probe.DN", "delay.twoway.icmp.us.min", "delay.twoway.icmp.us.mean",
+               "delay.twoway.icmp.us.max", "delay.twoway.icmp.count")
+    rows = list(zip(*[res.result_column_values(column) for column in columns]))
+    assert_equal(rows, [("probe-1,probe-3.example", 10, 20, 30, 3)])
+    assert_true(serv.partial_reply(spec) is None)
+    # each component got a specification token of its own
+    assert_equal(len(set(sent)), 3)
+
+    # or into one row per component
+    serv = supervisor.FanoutService(cap, fake, pending,
+                                    concurrent.futures.ThreadPoolExecutor(4),
+                                    group_by=("probe.DN",))
+    assert_equal(serv.capability()._schema_hash(), agg._schema_hash())
+    res = serv.run(spec, lambda: False)
+    rows = sorted(zip(*[res.result_column_values(column) for column in columns]))
+    assert_equal(rows, [("probe-1", 10, 15, 20, 2), ("probe-3.example", 30, 30, 30, 1)])
+
+    # components not answering by the end of the scope plus the
+    # timeout fail, even if the job is never interrupted
+    silent.add("probe-3.example")
+    serv = supervisor.FanoutService(cap, fake, pending,
+                                    concurrent.futures.ThreadPoolExecutor(4),
+                                    timeout=0.2)
+    spec.set_when("now + 1s")
+    started = time.monotonic()
+    res = serv.run(spec, lambda: False)
+    assert_true(time.monotonic() - started < 5)
+    assert_equal(res.result_column_values("probe.DN"), ["probe-1"])
+    assert_equal(res.result_column_values("delay.twoway.icmp.count"), [2])
+    assert_equal(len(pending._futures), 0)
+
+    # the aggregate capability widens to the constraints of new components,
+    # and keeps the label most components have, and its token
+    token = serv.capability().get_token()
+    assert_equal(serv.capability().get_label(), "test-fanout-fanout")
+    wide = model.Capability(label="test-wide", when="now ... future")
+    wide.add_parameter("destination.ip4", "10.0.1.1 ... 10.0.1.5")
+    wide.add_result_column("delay.twoway.icmp.us")
+    fake.handle_message(wide, "probe-4")
+    assert_true(serv.update_capability())
+    assert_false(serv.update_capability())
+    agg = serv.capability()
+    assert_equal(agg.get_token(), token)
+    assert_equal(agg.get_label(), "test-fanout-fanout")
+    assert_true(agg.can_set_parameter_value("destination.ip4", "10.0.1.5"))
+    assert_false(agg.can_set_parameter_value("destination.ip4", "10.0.1.6"))
+    assert_equal(supervisor._constraint_union(model.element("destination.ip4"),
+                                              ["10.0.0.2,10.0.0.1", "10.0.0.3"]),
+                 "10.0.0.1,10.0.0.2,10.0.0.3")
+
+def test_BaseSupervisor_add_fanout():
+    import concurrent.futures
+    from mplane import client, supervisor
+    model.initialize_registry()
+    class FakeComponent(object):
+        scheduler = scheduler.Scheduler()
+    sup = supervisor.BaseSupervisor.__new__(supervisor.BaseSupervisor)
+    sup.config = configparser.ConfigParser()
+    sup.config.add_section("supervisor")
+    sup.comp_workflow = "client-initiated"
+    sup._component = FakeComponent()
+    sup._client = client.BaseClient(tls_state=None)
+    sup._pending = supervisor.PendingResultTable()
+    sup._caps_lock = threading.Lock()
+    sup._fanouts = {}
+    sup._reductions = supervisor.DEFAULT_REDUCTIONS
+    sup._group_by = None
+    sup._fanout_executor = concurrent.futures.ThreadPoolExecutor(1)
+    for identity in ("probe-1", "probe-1", "probe-2"):
+        cap = model.Capability(label="test-fanout-" + identity, when="now ... future")
+        cap.add_parameter("destination.ip4")
+        cap.add_result_column("delay.twoway.icmp.us")
+        sup._client.handle_message(cap, identity)
+        sup._add_fanout(cap)
+        # a schema only one component offers is not fanned out
+        assert_equal(len(sup._fanouts), 0 if identity == "probe-1" else 1)
+    assert_equal(len(sup._component.scheduler.services), 1)
+
+def test_ComponentPoller():
+    import threading
+    from mplane import supervisor
+    model.initialize_registry()
+    class FakeClient(object):
+        def __init__(self):
+            self._receipts = {}
+            self.polled = []
+            self.redeemed = []
+            self.release = threading.Event()
+        def receipts(self):
+            return tuple(self._receipts.values())
+        def retrieve_capabilities(self, url, timeout=None):
+            self.polled.append(url)
+            if url == "slow":
+                self.release.wait(5)
+            elif url == "down":
+                raise ConnectionError("refused")
+        def result_for(self, token, timeout=None):
+            self.redeemed.append(token)
+    client = FakeClient()
+    cap = model.Capability(label="test-poller", when="now ... future")
+    cap.add_result_column("delay.twoway.icmp.us")
+    tokens = {}
+    for (name, when) in (("open", "now ... future"),
+                         ("later", "now + 1h"),
+                         ("done", "2017-01-01 ... 2017-01-02")):
+        spec = model.Specification(capability=cap, when=when)
+        tokens[spec.get_token()] = name
+        client._receipts[spec.get_token()] = model.Receipt(specification=spec)
+    poller = supervisor.ComponentPoller(client, ["slow", "down", "up"],
+                                        interval=60, concurrency=4, max_backoff=100)
+    poller.poll()
+    poller.poll()
+    # even once it is due again, a running poll is not repeated
+    poller._next_poll["slow"] = 0
+    poller.poll()
+    for i in range(100):
+        if len(client.polled) == 3 and len(client.redeemed) == 2:
+            break
+        time.sleep(0.01)
+    # the slow component neither blocks the others nor gets polled twice
+    assert_equal(sorted(client.polled), ["down", "slow", "up"])
+    assert_equal(sorted(tokens[token] for token in client.redeemed), ["done", "open"])
+    assert_equal(poller._failures["down"], 1)
+    assert_true(poller._next_poll["down"] - time.monotonic() > 100 - 1)
+    client.release.set()
+
+def test_MessageParser():
+    model.initialize_registry()
+    cap = model.Capability(label="test-pull-é")
+    cap.add_result_column("octets.ip")
+    cap.add_result_column("source.ip4")
+    res = model.Result(specification=model.Specification(capability=cap))
+    res.set_when("2017-01-01 ... 2017-01-02")
+    res.append_rows([(i, "10.0.0.%d" % (i % 200)) for i in range(3000)])
+    res.extend_column("octets.ip", [3000])
+    env = model.Envelope()
+    env.append_message(cap)
+    env.append_message(res)
+    text = model.unparse_json(env).encode("utf-8")
+    for size in (7, 4096):
+        parser = model.MessageParser()
+        for i in range(0, len(text), size):
+            parser.feed(text[i:i+size])
+        env2 = parser.close()
+        assert_equal(model.unparse_json(env2), model.unparse_json(env))
+    # rows are decoded into the columns' storage as they are parsed
+    res2 = list(env2.messages())[1]
+    assert_true(res2._resultcolumns["source.ip4"]._raw is None)
+    assert_equal(res2._resultcolumns["source.ip4"][3000], None)
+    assert_equal(model.parse_json_stream([text]).get_label(), None)
+    assert_raises(ValueError, model.parse_json_stream, [text[:-10]])
+    assert_raises(ValueError, model.parse_json_stream, [text + b"{}"])
+
+def test_ResultColumn_to_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return
+    model.initialize_registry()
+    cap = model.Capability(label="test-numpy")
+    cap.add_result_column("octets.ip")
+    cap.add_result_column("cpuload")
+    res = model.Result(specification=model.Specification(capability=cap))
+    for i in range(4):
+        res.set_result_value("octets.ip", i * 10, i)
+    res.set_result_value("cpuload", 0.5, 3)
+    octets = res._resultcolumns["octets.ip"].to_numpy()
+    assert_equal(octets.dtype, numpy.int64)
+    assert_equal(list(octets), [0, 10, 20, 30])
+    cpuload = res._resultcolumns["cpuload"].to_numpy()
+    assert_true(isinstance(cpuload, numpy.ma.MaskedArray))
+    assert_equal(list(cpuload.mask), [True, True, True, False])
+    assert_equal(cpuload[3], 0.5)
+
+def test_JobExecutor_run_in_process():
+    import os
+    model.initialize_registry()
+    cap = model.Capability(label="test-process")
+    cap.add_parameter("destination.ip4")
+    cap.add_result_column("octets.ip")
+    service = _ProcessService(cap)
+    service.set_run_in_process()
+    spec = model.Specification(capability=cap)
+    spec.set_parameter_value("destination.ip4", "10.0.0.1")
+    executor = scheduler.JobExecutor(pool_size=2, process_pool_size=1)
+    job = scheduler.Job(service, spec, executor=executor)
+    executor.submit(job)
+    time.sleep(0.5)
+    assert_false(job.finished())
+    job.interrupt()
+    for i in range(100):
+        if job.finished():
+            break
+        time.sleep(0.1)
+    assert_true(job.finished())
+    assert_true(job.result._resultcolumns["octets.ip"][0] != os.getpid())
+    assert_equal(job.result.get_token(), spec.get_token())
+
 #
 # utils tests
 #
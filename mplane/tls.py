@@ -35,13 +35,75 @@
 
 import urllib3
 import ssl
-import functools
 import tornado.httpserver
-from socket import socket
+import socket
+import threading
 import mplane.utils
 
 DUMMY_DN = "Dummy.Distinguished.Name"
 
+# enough for a supervisor polling and fanning out to hundreds of components
+DEFAULT_MAX_POOLS = 1000
+DEFAULT_MAX_CONNECTIONS = 10
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.5
+
+class _ResumingSocket(ssl.SSLSocket):
+    """
+    SSLSocket which hands its TLS session back to its context when
+    closed, as TLS 1.3 session tickets arrive after the handshake.
+    """
+
+    def close(self):
+        self.context._remember(self)
+        super().close()
+
+class _ResumingContext(ssl.SSLContext):
+    """
+    Client SSLContext which resumes the last TLS session with each
+    peer address, and passes the (host, port) and certificate of the
+    peer of each new connection to on_handshake, if set.
+    """
+    sslsocket_class = _ResumingSocket
+
+    def __init__(self, *args, **kwargs):
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self.on_handshake = None
+
+    def wrap_socket(self, sock, *args, session=None, server_hostname=None, **kwargs):
+        if session is None:
+            with self._sessions_lock:
+                session = self._sessions.get(_peer_address(sock))
+        ssock = super().wrap_socket(sock, *args, session=session,
+                                    server_hostname=server_hostname, **kwargs)
+        self._remember(ssock)
+        peer = _peer_address(ssock)
+        if self.on_handshake is not None and peer is not None:
+            try:
+                cert = ssock.getpeercert()
+            except ValueError:
+                # not connected, or handshake not done yet
+                cert = None
+            if cert:
+                self.on_handshake((server_hostname or peer[0], peer[1]), cert)
+        return ssock
+
+    def _remember(self, ssock):
+        try:
+            (peer, session) = (_peer_address(ssock), ssock.session)
+        except (OSError, ValueError):
+            return
+        if peer is not None and session is not None:
+            with self._sessions_lock:
+                self._sessions[peer] = session
+
+def _peer_address(sock):
+    try:
+        return sock.getpeername()[:2]
+    except OSError:
+        return None
+
 class TlsState:
     
     def __init__(self, config, forged_identity=None):
@@ -57,31 +119,78 @@ class TlsState:
         
         # load cert and get DN
         self._identity = self.extract_local_identity(forged_identity)
-    
-    @functools.lru_cache()
+
+        # one client context for all connections, so TLS sessions
+        # can be resumed; created on first use
+        self._client_context = None
+        self._server_context = None
+
+        # identities of peers by (host, port)
+        self._peer_identities = {}
+        self._peer_lock = threading.Lock()
+
+        # connection pools, by scheme, host and port
+        self._config = config
+        self._pool_manager = None
+
+    def _get_pool_manager(self):
+        with self._peer_lock:
+            if self._pool_manager is not None:
+                return self._pool_manager
+        config = self._config
+        socket_options = list(urllib3.connection.HTTPConnection.default_socket_options)
+        if config.getboolean("connections", "keepalive", fallback=True):
+            socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        pool_kw = {}
+        if self._keyfile:
+            try:
+                pool_kw["ssl_context"] = self.client_context()
+            except ssl.SSLError:
+                # leave it to each connection to fail
+                pool_kw.update(key_file=self._keyfile,
+                               cert_file=self._certfile,
+                               ca_certs=self._cafile)
+        # by default, keep a pool for each component a client polls
+        max_pools = DEFAULT_MAX_POOLS
+        if config.has_option("client", "component-urls"):
+            max_pools = max(max_pools,
+                            len(config["client"]["component-urls"].split(",")) + 1)
+        manager = urllib3.PoolManager(
+                num_pools=config.getint("connections", "max_pools", fallback=max_pools),
+                maxsize=config.getint("connections", "max_connections", fallback=DEFAULT_MAX_CONNECTIONS),
+                block=config.getboolean("connections", "block", fallback=False),
+                retries=urllib3.Retry(
+                    total=config.getint("connections", "retries", fallback=DEFAULT_RETRIES),
+                    backoff_factor=config.getfloat("connections", "retry_backoff",
+                                                     fallback=DEFAULT_RETRY_BACKOFF)),
+                socket_options=socket_options,
+                **pool_kw)
+        with self._peer_lock:
+            if self._pool_manager is None:
+                self._pool_manager = manager
+            return self._pool_manager
+
     def pool_for(self, scheme, host, port):
         """
         Given a URL (from which a scheme and host can be extracted),
         return a connection pool (potentially with TLS state) 
         which can be used to connect to the URL.
+
+        Pools are kept per scheme, host and port for the
+        max_pools most recently used ones, and keep up to
+        max_connections connections open (see the connections
+        section of the configuration).
         """
-        
         if scheme is None:
             if self._keyfile:
-                return urllib3.HTTPSConnectionPool(host, port,
-                                                    key_file=self._keyfile,
-                                                    cert_file=self._certfile,
-                                                    ca_certs=self._cafile)
+                scheme = "https"
             else:
-                return urllib3.HTTPConnectionPool(host, port)
-        elif scheme == "http":
-            return urllib3.HTTPConnectionPool(host, port)
+                scheme = "http"
+        if scheme == "http":
+            return self._get_pool_manager().connection_from_host(host, port, scheme)
         elif scheme == "https":
             if self._keyfile:
-                return urllib3.HTTPSConnectionPool(host, port,
-                                                    key_file=self._keyfile,
-                                                    cert_file=self._certfile,
-                                                    ca_certs=self._cafile)
+                return self._get_pool_manager().connection_from_host(host, port, scheme)
             else:
                 raise ValueError("SSL requested without providing certificate")
                 exit(1)
@@ -91,6 +200,33 @@ class TlsState:
         else:
             raise ValueError("Unsupported scheme "+scheme)
 
+    def pool_stats(self):
+        """
+        Returns connection reuse statistics of the current pools, as a
+        dictionary of (scheme, host, port) to a dictionary with the
+        number of requests, of connections opened, of requests
+        on reused connections, and of idle connections.
+        """
+        stats = {}
+        with self._peer_lock:
+            manager = self._pool_manager
+        if manager is None:
+            return stats
+        for key in manager.pools.keys():
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            # the pool queue is padded with None up to its size
+            idle = 0
+            if pool.pool is not None:
+                idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            stats[(pool.scheme, pool.host, pool.port)] = {
+                "requests": pool.num_requests,
+                "connections": pool.num_connections,
+                "reused": max(pool.num_requests - pool.num_connections, 0),
+                "idle": idle}
+        return stats
+
     def forged_identity(self):
         if not self._keyfile:
             return self._identity
@@ -110,7 +246,21 @@ class TlsState:
         else:
             return None
 
-
+    def server_context(self):
+        """
+        Returns an SSLContext for the HTTPServer of this TLS state
+        (as its ssl_options), or None without TLS. Unlike the
+        dictionary of get_ssl_options(), which makes tornado build a
+        context per connection, it lets clients resume TLS sessions.
+        """
+        with self._peer_lock:
+            if self._keyfile and self._server_context is None:
+                context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH,
+                                                     cafile=self._cafile)
+                context.load_cert_chain(self._certfile, self._keyfile)
+                context.verify_mode = ssl.CERT_REQUIRED
+                self._server_context = context
+            return self._server_context
 
     def extract_local_identity(self, forged_identity = None):
         """
@@ -136,35 +286,90 @@ class TlsState:
                 identity = forged_identity
         return identity
     
+    def client_context(self):
+        """
+        Returns the SSLContext shared by the client side
+        connections of this TLS state, or None without TLS
+        """
+        with self._peer_lock:
+            if self._keyfile and self._client_context is None:
+                context = _ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(cafile=self._cafile)
+                context.load_cert_chain(self._certfile, self._keyfile)
+                context.on_handshake = self._handshake_seen
+                self._client_context = context
+            return self._client_context
+
     def extract_peer_identity(self, url_or_req):
         """
         Extract an identity from a Tornado's 
-        HTTPRequest, or from a Urllib3's Url
+        HTTPRequest, or from a Urllib3's Url.
+        Identities of Urls are cached per host and port, and
+        refreshed by every new connection to them.
         """
         if self._keyfile:
             if isinstance(url_or_req,  urllib3.util.url.Url):
-                # extract DN from the certificate retrieved from the url.
-                # Unfortunately, there seems to be no way to do this using urllib3,
-                # thus ssl library is being used
-                s = socket()
-                c = ssl.wrap_socket(s,cert_reqs=ssl.CERT_REQUIRED, 
-                                    keyfile=self._keyfile, 
-                                    certfile=self._certfile, 
-                                    ca_certs=self._cafile)
-                c.connect((url_or_req.host, url_or_req.port))
-                cert = c.getpeercert()
-                c.close()
+                key = (url_or_req.host, url_or_req.port)
+                with self._peer_lock:
+                    identity = self._peer_identities.get(key)
+                if identity is None:
+                    # extract DN from the certificate retrieved from the url.
+                    identity = _identity_from_cert(self._peer_certificate(key))
+                    with self._peer_lock:
+                        self._peer_identities[key] = identity
+                return identity
             elif isinstance(url_or_req, tornado.httpserver.HTTPRequest):
-                cert = url_or_req.get_ssl_certificate()
+                return _identity_from_cert(url_or_req.get_ssl_certificate())
             else:
                 raise ValueError("Passed argument is not a urllib3.util.url.Url or tornado.httpserver.HTTPRequest")
-            
-            identity = ""
-            for elem in cert.get('subject'):
-                if identity == "":
-                    identity = identity + str(elem[0][1])
-                else: 
-                    identity = identity + "." + str(elem[0][1])
         else:
-            identity = DUMMY_DN
-        return identity
+            return DUMMY_DN
+
+    def extract_response_identity(self, response, url):
+        """
+        Extract the identity of the peer at url which sent a urllib3
+        response read with preload_content=False, from the connection
+        it came in on; this also refreshes the cached identity of the
+        url, as the connection may be a new one.
+        """
+        if not self._keyfile:
+            return DUMMY_DN
+        sock = getattr(getattr(response, "connection", None), "sock", None)
+        if isinstance(sock, ssl.SSLSocket):
+            cert = sock.getpeercert()
+            if cert:
+                identity = _identity_from_cert(cert)
+                with self._peer_lock:
+                    self._peer_identities[(url.host, url.port)] = identity
+                return identity
+        return self.extract_peer_identity(url)
+
+    def _handshake_seen(self, key, cert):
+        identity = _identity_from_cert(cert)
+        with self._peer_lock:
+            self._peer_identities[key] = identity
+
+    def forget_peer_identity(self, url):
+        """
+        Drops the cached identity of the peer at url, e.g.
+        after a connection error
+        """
+        with self._peer_lock:
+            self._peer_identities.pop((url.host, url.port), None)
+
+    def _peer_certificate(self, key):
+        # the context resumes the last session with the peer if any
+        with socket.create_connection(key) as s:
+            with self.client_context().wrap_socket(s) as c:
+                return c.getpeercert()
+
+def _identity_from_cert(cert):
+    identity = ""
+    for elem in cert.get('subject'):
+        if identity == "":
+            identity = identity + str(elem[0][1])
+        else: 
+            identity = identity + "." + str(elem[0][1])
+    return identity
@@ -22,6 +22,9 @@ import os.path
 import re
 import mplane.model
 import json
+import gzip
+import collections
+import threading
 
 def read_setting(filepath, param):
     """
@@ -110,4 +113,239 @@ def split_stmt_list(msg):
     return stmts
 
 def versiontuple(version_string):
-    return tuple(map(int, (version_string.split("."))))
\ No newline at end of file
+    return tuple(map(int, (version_string.split("."))))
+
+
+MPLANE_JSON_TYPE = "application/x-mplane+json"
+MPLANE_CBOR_TYPE = "application/x-mplane+cbor"
+
+# message formats: indented JSON, compact JSON (also the value of the
+# format parameter of its media type), and CBOR
+FORMAT_JSON = "json"
+FORMAT_COMPACT_JSON = "compact"
+FORMAT_CBOR = "cbor"
+MESSAGE_FORMATS = (FORMAT_JSON, FORMAT_COMPACT_JSON, FORMAT_CBOR)
+
+def parse_media_type(value):
+    """
+    Splits a media type, as in a Content-Type header or an entry of an
+    Accept header, into the lowercased type and a dict of its parameters
+
+    """
+    parts = value.split(";")
+    params = {}
+    for part in parts[1:]:
+        (name, _, val) = part.partition("=")
+        params[name.strip().lower()] = val.strip().strip('"')
+    return (parts[0].strip().lower(), params)
+
+def is_mplane_json(content_type):
+    """
+    Checks if a Content-Type header denotes an mPlane JSON message,
+    in either format
+
+    """
+    return content_type is not None and \
+           parse_media_type(content_type)[0] == MPLANE_JSON_TYPE
+
+def is_mplane_cbor(content_type):
+    """
+    Checks if a Content-Type header denotes an mPlane CBOR message
+
+    """
+    return content_type is not None and \
+           parse_media_type(content_type)[0] == MPLANE_CBOR_TYPE
+
+def is_mplane_message(content_type):
+    """
+    Checks if a Content-Type header denotes an mPlane message
+    in any format
+
+    """
+    return is_mplane_json(content_type) or is_mplane_cbor(content_type)
+
+def message_media_type(fmt=FORMAT_JSON):
+    """
+    Returns the media type of mPlane messages in the given format
+
+    """
+    if fmt == FORMAT_CBOR:
+        return MPLANE_CBOR_TYPE
+    elif fmt == FORMAT_COMPACT_JSON:
+        return MPLANE_JSON_TYPE + "; format=" + FORMAT_COMPACT_JSON
+    return MPLANE_JSON_TYPE
+
+def reply_format(accept):
+    """
+    Returns the message format to reply in, given the Accept header
+    of a request: CBOR or compact JSON if accepted, indented JSON
+    otherwise
+
+    """
+    fmt = FORMAT_JSON
+    if accept is None:
+        return fmt
+    for entry in accept.split(","):
+        (mtype, params) = parse_media_type(entry)
+        if params.get("q") in ("0", "0.0", "0.00", "0.000"):
+            continue
+        if mtype == MPLANE_CBOR_TYPE:
+            return FORMAT_CBOR
+        if mtype == MPLANE_JSON_TYPE and \
+           params.get("format") == FORMAT_COMPACT_JSON:
+            fmt = FORMAT_COMPACT_JSON
+    return fmt
+
+def message_format(config, section):
+    """
+    Reads the format to send messages in from the message_format
+    key of a config section; indented JSON by default
+
+    """
+    fmt = config.get(section, "message_format", fallback=FORMAT_JSON)
+    if fmt not in MESSAGE_FORMATS:
+        raise ValueError("message_format in section " + section +
+                         " can only be one of " + ", ".join(MESSAGE_FORMATS))
+    return fmt
+
+def unparse_message(msg, fmt=FORMAT_JSON):
+    """
+    Encodes an mPlane message in the given format, as bytes
+
+    """
+    if fmt == FORMAT_CBOR:
+        return mplane.model.unparse_cbor(msg)
+    return mplane.model.unparse_json(
+        msg, compact=(fmt == FORMAT_COMPACT_JSON)).encode("utf-8")
+
+def parse_message(data, content_type):
+    """
+    Decodes an mPlane message from bytes, in the format
+    given by a Content-Type header
+
+    """
+    if is_mplane_cbor(content_type):
+        return mplane.model.parse_cbor(data)
+    return mplane.model.parse_json(data.decode("utf-8"))
+
+def preferred_wait(prefer):
+    """
+    Returns the seconds of the wait preference in a Prefer
+    header (RFC 7240), or None if there is none.
+
+    """
+    if prefer is None:
+        return None
+    for pref in prefer.split(","):
+        (name, _, value) = pref.split(";")[0].partition("=")
+        if name.strip().lower() == "wait":
+            try:
+                return max(int(value.strip().strip('"')), 0)
+            except ValueError:
+                return None
+    return None
+
+DEFAULT_COMPRESSION_LEVEL = 6
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+# peers whose acceptance of compressed requests is remembered,
+# as many as mplane.tls keeps connection pools for
+DEFAULT_COMPRESSION_MAX_PEERS = 1000
+
+class HttpCompression(object):
+    """
+    Gzip compression of mPlane messages over HTTP, at the given level
+    (0 disables it) for bodies of at least threshold bytes.
+
+    Servers compress responses to requests with an Accept-Encoding
+    of gzip, and announce that they accept compressed requests with
+    an Accept-Encoding header in their responses (RFC 7694). Clients
+    ask for compressed responses, and compress request bodies to the
+    max_peers peers which most recently announced it.
+
+    """
+    def __init__(self, level=DEFAULT_COMPRESSION_LEVEL,
+                 threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 max_peers=DEFAULT_COMPRESSION_MAX_PEERS):
+        if not 0 <= level <= 9:
+            raise ValueError("compression_level must be between 0 and 9")
+        self.level = level
+        self.threshold = threshold
+        # (host, port) of peers accepting compressed requests,
+        # least recently heard from first
+        self._peers = collections.OrderedDict()
+        self._max_peers = max_peers
+        self._peers_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, section):
+        """
+        Reads compression_level and compression_threshold
+        from a config section, and the number of peers to
+        remember from max_pools in the connections section
+
+        """
+        return cls(config.getint(section, "compression_level",
+                                 fallback=DEFAULT_COMPRESSION_LEVEL),
+                   config.getint(section, "compression_threshold",
+                                 fallback=DEFAULT_COMPRESSION_THRESHOLD),
+                   config.getint("connections", "max_pools",
+                                 fallback=DEFAULT_COMPRESSION_MAX_PEERS))
+
+    def transform(self):
+        """
+        Returns a tornado output transform compressing responses;
+        use with a HTTPServer created with decompress_request=True
+
+        """
+        # only servers need tornado
+        import tornado.web
+        compression = self
+
+        class MPlaneGZipContentEncoding(tornado.web.GZipContentEncoding):
+            GZIP_LEVEL = max(compression.level, 1)
+            MIN_LENGTH = compression.threshold
+
+            def __init__(self, request):
+                super().__init__(request)
+                self._gzipping = self._gzipping and compression.level > 0
+
+            def _compressible_type(self, ctype):
+                return ctype in (MPLANE_JSON_TYPE, MPLANE_CBOR_TYPE) or \
+                       super()._compressible_type(ctype)
+
+            def transform_first_chunk(self, status_code, headers, chunk, finishing):
+                headers["Accept-Encoding"] = "gzip"
+                return super().transform_first_chunk(status_code, headers,
+                                                     chunk, finishing)
+
+        return MPlaneGZipContentEncoding
+
+    def encode_request(self, body, headers, host, port):
+        """
+        Adds compression headers to the headers of a request to a
+        peer, and returns its body, compressed if the peer accepts it
+
+        """
+        if self.level > 0:
+            headers["Accept-Encoding"] = "gzip"
+            if body is not None and len(body) >= self.threshold and \
+               (host, port) in self._peers:
+                headers["Content-Encoding"] = "gzip"
+                return gzip.compress(body, self.level)
+        return body
+
+    def learn(self, response, host, port):
+        """
+        Notes whether the peer which sent a response
+        accepts compressed requests
+
+        """
+        key = (host, port)
+        with self._peers_lock:
+            if "gzip" in (response.headers.get("Accept-Encoding") or ""):
+                self._peers[key] = True
+                self._peers.move_to_end(key)
+                if len(self._peers) > self._max_peers:
+                    self._peers.popitem(last=False)
+            else:
+                self._peers.pop(key, None)